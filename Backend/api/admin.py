@@ -21,14 +21,20 @@ class WeatherCacheAdmin(admin.ModelAdmin):
     is_valid_status.boolean = True
     is_valid_status.short_description = "Fresh Data"
 
+    def save_model(self, request, obj, form, change):
+        # Pre-rendered bodies would no longer match an edited payload; they are rebuilt on next read
+        obj.body = obj.body_gzip = obj.body_br = None
+        super().save_model(request, obj, form, change)
+
 @admin.register(SearchHistory)
 class SearchHistoryAdmin(admin.ModelAdmin):
     list_display = ('user', 'city_name_queried', 'timestamp', 'get_status')
     search_fields = ('user__username', 'city_name_queried')
     list_filter = ('timestamp',)
+    raw_id_fields = ('weather',)
 
     def get_status(self, obj):
-        if obj.response_data:
-            return obj.response_data.get('cod', '200')
+        if obj.snapshot:
+            return obj.snapshot.get('cod', '200')
         return 'N/A'
     get_status.short_description = "API Status"
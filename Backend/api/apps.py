@@ -1,5 +1,27 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
 
 
 class ApiConfig(AppConfig):
     name = "api"
+
+    def ready(self):
+        from core.logs import start_queue_listeners
+        from .authentication import invalidate_user_status
+        from .db import configure_connection
+        from .metrics import install_query_timer, metrics_enabled
+        from .models import User
+        from .profiling import install_query_capture, profiling_enabled
+
+        # LOGGING is configured before apps are loaded, so all its handlers exist by now
+        start_queue_listeners()
+
+        connection_created.connect(configure_connection, dispatch_uid='api.db.configure_connection')
+        if metrics_enabled():
+            connection_created.connect(install_query_timer, dispatch_uid='api.metrics.install_query_timer')
+        if profiling_enabled():
+            connection_created.connect(install_query_capture, dispatch_uid='api.profiling.install_query_capture')
+        # Deactivation or a password change cuts off this worker's cached token status at once
+        post_save.connect(invalidate_user_status, sender=User, dispatch_uid='api.authentication.user_saved')
+        post_delete.connect(invalidate_user_status, sender=User, dispatch_uid='api.authentication.user_deleted')
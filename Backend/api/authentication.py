@@ -0,0 +1,119 @@
+import threading
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.utils.functional import cached_property
+from django.utils.translation import gettext_lazy as _
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTStatelessUserAuthentication
+from rest_framework_simplejwt.models import TokenUser as BaseTokenUser
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+from .models import User
+
+# What the token itself cannot tell: whether the account may still use it.
+# password_hash is only kept when SIMPLE_JWT['CHECK_REVOKE_TOKEN'] is on.
+UserStatus = namedtuple('UserStatus', ['is_active', 'password_hash'])
+
+
+class TokenUser(BaseTokenUser):
+    """
+    simplejwt's TokenUser with the id claim (a string in the token) converted to the User model's
+    primary key type, so it matches the ids of loaded Users (cache keys, history rows, throttles).
+    SIMPLE_JWT['TOKEN_USER_CLASS'].
+    """
+
+    @cached_property
+    def id(self):
+        return User._meta.get_field(api_settings.USER_ID_FIELD).to_python(self.token[api_settings.USER_ID_CLAIM])
+
+
+class UserStatusCache:
+    """
+    Per-process TTL cache of each user's UserStatus (None for deleted users), read with one
+    indexed query on a miss.
+
+    Deactivating a user or changing their password takes effect at once in the process that
+    saved it (the User signals invalidate the entry), and within WEATHER_AUTH_STATUS_TTL
+    seconds in every other worker.
+    """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        ttl = getattr(settings, 'WEATHER_AUTH_STATUS_TTL', 30)
+        now = time.monotonic()
+        entry = self._entries.get(user_id)
+        if entry is not None and entry[0] > now:
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        status = self.load(user_id)
+        if ttl > 0:
+            with self._lock:
+                if len(self._entries) >= self.max_entries:
+                    # Oldest insertion first; live entries only cost a query to reload
+                    self._entries.pop(next(iter(self._entries)), None)
+                self._entries[user_id] = (now + ttl, status)
+        return status
+
+    @staticmethod
+    def load(user_id):
+        row = User.objects.filter(**{api_settings.USER_ID_FIELD: user_id}).values_list(
+            'is_active', 'password'
+        ).first()
+        if row is None:
+            return None
+        is_active, password = row
+        return UserStatus(is_active, get_md5_hash_password(password) if api_settings.CHECK_REVOKE_TOKEN else None)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+            self.hits = 0
+            self.misses = 0
+
+
+user_status_cache = UserStatusCache()
+
+
+def invalidate_user_status(sender, instance, **kwargs):
+    """
+    post_save/post_delete receiver for User.
+    """
+    user_status_cache.invalidate(getattr(instance, api_settings.USER_ID_FIELD))
+
+
+class StatelessJWTAuthentication(JWTStatelessUserAuthentication):
+    """
+    JWTAuthentication without the User query on every request: request.user is a TokenUser
+    built from the validated token (user id, and username for tokens issued with it).
+    The checks JWTAuthentication makes on the loaded User (deleted, inactive, password changed)
+    are made against user_status_cache instead.
+
+    For read paths that only need the user's id (weather lookups, history writes by user_id);
+    views that use request.user as a model instance keep JWTAuthentication.
+    """
+
+    def get_user(self, validated_token):
+        user = super().get_user(validated_token)
+        status = user_status_cache.get(user.pk)
+        if status is None:
+            raise AuthenticationFailed(_("User not found"), code="user_not_found")
+        if api_settings.CHECK_USER_IS_ACTIVE and not status.is_active:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+        if api_settings.CHECK_REVOKE_TOKEN and validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) != status.password_hash:
+            raise AuthenticationFailed(_("The user's password has been changed."), code="password_changed")
+        return user
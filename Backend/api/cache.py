@@ -0,0 +1,678 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field, replace
+from datetime import datetime, timedelta
+from typing import Optional
+
+import requests
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .db import retry_on_lock
+from .models import WeatherCache, build_lookup_key
+from .rendering import prerender_enabled, render_body, compress_body
+from .clients import _as_requests_response
+
+
+def cache_ttl():
+    """
+    Freshness window shared by every tier (same boundary as WeatherCache.is_valid).
+    """
+    return timedelta(minutes=getattr(settings, 'WEATHER_CACHE_MINUTES', 60))
+
+
+def stale_while_revalidate_window():
+    """
+    How long past expiry an entry may still be served while it is refreshed in the background.
+    """
+    return timedelta(minutes=getattr(settings, 'WEATHER_CACHE_STALE_WHILE_REVALIDATE_MINUTES', 0))
+
+
+def stale_if_error_window():
+    """
+    How long past expiry an entry may still be served when the upstream provider fails.
+    """
+    return timedelta(minutes=getattr(settings, 'WEATHER_CACHE_STALE_IF_ERROR_MINUTES', 0))
+
+
+def stale_retention():
+    """
+    Tiers keep expired entries this long so they remain available for stale serving.
+    """
+    return max(stale_while_revalidate_window(), stale_if_error_window())
+
+
+# Cache outcome of a weather lookup, reported to clients in the X-Cache-Status header
+CACHE_HIT = 'HIT'
+CACHE_MISS = 'MISS'
+CACHE_STALE = 'STALE'
+CACHE_STALE_IF_ERROR = 'STALE-IF-ERROR'
+
+
+def make_cache_key(city, state=None, country=None):
+    """
+    Normalized (city, state, country) tuple used to address every cache tier.
+    """
+    return (
+        city.strip().upper(),
+        state.strip().upper() if state else '',
+        country.strip().upper() if country else '',
+    )
+
+
+def key_digest(key):
+    """
+    Stable hash of a cache key, safe for every cache backend (e.g. memcached rejects spaces).
+    """
+    return hashlib.sha1('|'.join(key).encode('utf-8')).hexdigest()
+
+
+@dataclass
+class CacheEntry:
+    """
+    A weather payload together with the metadata needed to judge its freshness.
+    """
+    data: dict
+    updated_at: datetime
+    city: str
+    state: Optional[str]
+    country: str
+    # Pre-rendered JSON response and its compressed variants ({'gzip': ..., 'br': ...})
+    body: Optional[bytes] = None
+    encoded_bodies: dict = field(default_factory=dict)
+
+    @property
+    def expires_at(self):
+        return self.updated_at + cache_ttl()
+
+    @property
+    def is_fresh(self):
+        return timezone.now() < self.expires_at
+
+    @property
+    def age(self):
+        return timezone.now() - self.updated_at
+
+    def is_usable(self, max_stale):
+        """
+        Fresh, or expired for no longer than `max_stale`.
+        """
+        return timezone.now() < self.expires_at + max_stale
+
+    def prerendered(self):
+        """
+        This entry with its response body rendered and compressed (a no-op if it already is).
+        """
+        if self.body is not None:
+            return self
+        body = render_body(self.data)
+        return replace(self, body=body, encoded_bodies=compress_body(body))
+
+    @classmethod
+    def from_model(cls, obj):
+        encoded_bodies = {}
+        if obj.body_br is not None:
+            encoded_bodies['br'] = bytes(obj.body_br)
+        if obj.body_gzip is not None:
+            encoded_bodies['gzip'] = bytes(obj.body_gzip)
+        return cls(
+            data=obj.data,
+            updated_at=obj.updated_at,
+            city=obj.city,
+            state=obj.state,
+            country=obj.country,
+            # BinaryField may come back as a memoryview (e.g. PostgreSQL)
+            body=bytes(obj.body) if obj.body is not None else None,
+            encoded_bodies=encoded_bodies,
+        )
+
+
+# --- Tiers ---
+
+class BaseCacheTier:
+    """
+    A single level of the weather cache. Tiers are ordered fastest first.
+    """
+    name = None
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, entry):
+        raise NotImplementedError
+
+    def get_version(self, key):
+        """
+        (updated_at, location) of the entry for `key`, or None; `location` is the entry's own
+        (city, state, country). Tiers that can read them without the payload override this.
+        """
+        entry = self.get(key)
+        if entry is None:
+            return None
+        return entry.updated_at, make_cache_key(entry.city, entry.state, entry.country)
+
+    def get_many(self, keys):
+        """
+        {key: entry} for the keys found in this tier.
+        """
+        found = {}
+        for key in keys:
+            entry = self.get(key)
+            if entry is not None:
+                found[key] = entry
+        return found
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+    # Async variants default to running the sync implementation in a worker thread
+    async def aget(self, key):
+        return await sync_to_async(self.get)(key)
+
+    async def aset(self, key, entry):
+        return await sync_to_async(self.set)(key, entry)
+
+
+class LocalMemoryTier(BaseCacheTier):
+    """
+    Per-process bounded LRU. Entries are dropped once they pass their freshness boundary
+    (plus the stale retention window, when stale serving is enabled).
+    """
+    name = 'local'
+
+    def __init__(self, max_entries=None):
+        if max_entries is None:
+            max_entries = getattr(settings, 'WEATHER_CACHE_LOCAL_MAX_ENTRIES', 1024)
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if not entry.is_usable(stale_retention()):
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        if self.max_entries <= 0:
+            return entry
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    # Pure in-memory and never blocks on I/O, so safe to call directly from the event loop
+    async def aget(self, key):
+        return self.get(key)
+
+    async def aset(self, key, entry):
+        return self.set(key, entry)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SharedCacheTier(BaseCacheTier):
+    """
+    Django cache-framework tier, shared between workers when the alias points at a shared backend.
+    """
+    name = 'shared'
+    key_prefix = 'weather'
+
+    def __init__(self, alias=None):
+        self.alias = alias or getattr(settings, 'WEATHER_CACHE_SHARED_ALIAS', 'default')
+
+    @property
+    def backend(self):
+        return caches[self.alias]
+
+    def make_key(self, key):
+        return f"{self.key_prefix}:{key_digest(key)}"
+
+    def get(self, key):
+        return self.backend.get(self.make_key(key))
+
+    def timeout_for(self, entry):
+        return (entry.expires_at + stale_retention() - timezone.now()).total_seconds()
+
+    def set(self, key, entry):
+        timeout = self.timeout_for(entry)
+        if timeout > 0:
+            self.backend.set(self.make_key(key), entry, timeout=timeout)
+        return entry
+
+    def get_many(self, keys):
+        backend_keys = {self.make_key(key): key for key in keys}
+        return {backend_keys[k]: entry for k, entry in self.backend.get_many(list(backend_keys)).items()}
+
+    async def aget(self, key):
+        return await self.backend.aget(self.make_key(key))
+
+    async def aset(self, key, entry):
+        timeout = self.timeout_for(entry)
+        if timeout > 0:
+            await self.backend.aset(self.make_key(key), entry, timeout=timeout)
+        return entry
+
+    def delete(self, key):
+        self.backend.delete(self.make_key(key))
+
+
+class DatabaseTier(BaseCacheTier):
+    """
+    Durable last tier backed by the WeatherCache table.
+    """
+    name = 'database'
+
+    def get(self, key):
+        city, state, country = key
+        cached_entry = WeatherCache.objects.get_valid_cache(city, state, country, grace=stale_retention())
+        if cached_entry:
+            return CacheEntry.from_model(cached_entry)
+        return None
+
+    @retry_on_lock
+    def set(self, key, entry):
+        # Store under the canonical names carried by the entry, not the requested key
+        weather_obj, created = WeatherCache.objects.update_or_create(
+            lookup_key=build_lookup_key(entry.city, entry.state, entry.country),
+            defaults={
+                'city': entry.city,
+                'state': entry.state,
+                'country': entry.country,
+                'data': entry.data,
+                'body': entry.body,
+                'body_gzip': entry.encoded_bodies.get('gzip'),
+                'body_br': entry.encoded_bodies.get('br'),
+                'updated_at': entry.updated_at,
+            }
+        )
+        return CacheEntry.from_model(weather_obj)
+
+    def get_version(self, key):
+        city, state, country = key
+        version = WeatherCache.objects.get_valid_version(city, state, country)
+        if version is None:
+            return None
+        updated_at, *location = version
+        return updated_at, make_cache_key(*location)
+
+    def get_many(self, keys):
+        found = WeatherCache.objects.get_valid_cache_many(list(keys))
+        return {key: CacheEntry.from_model(obj) for key, obj in found.items()}
+
+    async def aget(self, key):
+        city, state, country = key
+        cached_entry = await WeatherCache.objects.aget_valid_cache(city, state, country, grace=stale_retention())
+        if cached_entry:
+            return CacheEntry.from_model(cached_entry)
+        return None
+
+    @retry_on_lock
+    async def aset(self, key, entry):
+        weather_obj, created = await WeatherCache.objects.aupdate_or_create(
+            lookup_key=build_lookup_key(entry.city, entry.state, entry.country),
+            defaults={
+                'city': entry.city,
+                'state': entry.state,
+                'country': entry.country,
+                'data': entry.data,
+                'body': entry.body,
+                'body_gzip': entry.encoded_bodies.get('gzip'),
+                'body_br': entry.encoded_bodies.get('br'),
+                'updated_at': entry.updated_at,
+            }
+        )
+        return CacheEntry.from_model(weather_obj)
+
+
+# --- Negative cache ---
+
+def negative_ttl(status_code):
+    """
+    Seconds to remember an upstream error response: long for "city not found", short for
+    provider errors (5xx, 429), nothing for anything else.
+    """
+    if status_code == 404:
+        return getattr(settings, 'WEATHER_NEGATIVE_CACHE_NOT_FOUND_SECONDS', 300)
+    if status_code == 429 or status_code >= 500:
+        return getattr(settings, 'WEATHER_NEGATIVE_CACHE_ERROR_SECONDS', 5)
+    return 0
+
+
+@dataclass
+class NegativeEntry:
+    """
+    An upstream error response, replayed instead of calling upstream again until `expires_at`.
+    """
+    status_code: int
+    reason: str
+    content: bytes
+    expires_at: float
+
+    def as_error(self):
+        """
+        The error the provider call raised, so callers (and stale-if-error) handle it alike.
+        """
+        response = _as_requests_response(
+            self.status_code, self.reason, {'Content-Type': 'application/json'}, '', self.content,
+        )
+        return requests.exceptions.HTTPError(f"{self.status_code} {self.reason} (negative cache)", response=response)
+
+
+class NegativeCache:
+    """
+    Remembers upstream error responses per cache key, in the same Django cache as SharedCacheTier.
+
+    Consulted only after every tier missed, so a stored entry always wins over an error, and
+    writing an entry forgets the error for its key. Expiry is checked on read as well, so a
+    lenient backend can never replay an error past its TTL.
+    """
+    key_prefix = 'weather-negative'
+
+    def __init__(self, alias=None):
+        self.alias = alias or getattr(settings, 'WEATHER_CACHE_SHARED_ALIAS', 'default')
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    @property
+    def backend(self):
+        return caches[self.alias]
+
+    def make_key(self, key):
+        return f"{self.key_prefix}:{key_digest(key)}"
+
+    def _entry_for(self, error):
+        response = getattr(error, 'response', None)
+        if response is None:
+            return None
+        ttl = negative_ttl(response.status_code)
+        if ttl <= 0:
+            return None
+        return NegativeEntry(response.status_code, response.reason or '', response.content or b'', time.time() + ttl), ttl
+
+    def _checked(self, entry):
+        if entry is not None and entry.expires_at <= time.time():
+            entry = None
+        self._count('hits' if entry is not None else 'misses')
+        return entry
+
+    def get(self, key):
+        return self._checked(self.backend.get(self.make_key(key)))
+
+    def remember(self, key, error):
+        """
+        Store `error` (a RequestException) for `key` if its response status is worth remembering.
+        """
+        stored = self._entry_for(error)
+        if stored is not None:
+            entry, ttl = stored
+            self.backend.set(self.make_key(key), entry, timeout=ttl)
+            self._count('not_found' if entry.status_code == 404 else 'errors')
+
+    def forget(self, key):
+        self.backend.delete(self.make_key(key))
+
+    async def aget(self, key):
+        return self._checked(await self.backend.aget(self.make_key(key)))
+
+    async def aremember(self, key, error):
+        stored = self._entry_for(error)
+        if stored is not None:
+            entry, ttl = stored
+            await self.backend.aset(self.make_key(key), entry, timeout=ttl)
+            self._count('not_found' if entry.status_code == 404 else 'errors')
+
+    async def aforget(self, key):
+        await self.backend.adelete(self.make_key(key))
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def reset_stats(self):
+        with self._lock:
+            # hits/misses: lookups before an upstream call; not_found/errors: responses stored
+            self._stats = {'hits': 0, 'misses': 0, 'not_found': 0, 'errors': 0}
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+# --- Tiered Cache ---
+
+class TieredWeatherCache:
+    """
+    Read-through / write-through cache over an ordered list of tiers.
+
+    A hit in a slower tier back-fills the faster tiers above it, and `set` writes
+    the slowest (durable) tier first so faster tiers only ever hold persisted data.
+    Hits and misses are counted per tier so the local LRU can be sized from real traffic.
+    Upstream errors are remembered separately, in `negative` (a NegativeCache).
+    """
+
+    def __init__(self, tiers, negative=None):
+        self.tiers = list(tiers)
+        self.negative = negative if negative is not None else NegativeCache()
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    @classmethod
+    def from_settings(cls):
+        tier_paths = getattr(settings, 'WEATHER_CACHE_TIERS', [
+            'api.cache.LocalMemoryTier',
+            'api.cache.SharedCacheTier',
+            'api.cache.DatabaseTier',
+        ])
+        return cls([import_string(path)() for path in tier_paths])
+
+    def get(self, city, state=None, country=None, max_stale=None):
+        """
+        Freshest entry for the location. Fresh hits return from the first tier that has one;
+        with `max_stale`, an entry expired for at most that long is returned if no tier is fresh.
+        """
+        key = make_cache_key(city, state, country)
+        stale_entry = None
+        for index, tier in enumerate(self.tiers):
+            entry = tier.get(key)
+            if entry is not None and entry.is_fresh:
+                self._record(tier.name, hit=True)
+                if index:
+                    entry = self._prepare(entry)
+                for upper_tier in self.tiers[:index]:
+                    upper_tier.set(key, entry)
+                return entry
+            stale_entry = self._fresher_stale(stale_entry, entry, max_stale)
+            self._record(tier.name, hit=False)
+        return stale_entry
+
+    def get_shared(self, city, state=None, country=None):
+        """
+        Fresh entry from the shared (cache framework) tiers only, or None. Cheap enough to poll
+        while another worker fetches the location: the local tier cannot see that worker's
+        result and the Database tier would be queried by every waiter. Not counted in the tier stats.
+        """
+        key = make_cache_key(city, state, country)
+        for tier in self.tiers:
+            if isinstance(tier, SharedCacheTier):
+                entry = tier.get(key)
+                if entry is not None and entry.is_fresh:
+                    return self._prepare(entry)
+        return None
+
+    @staticmethod
+    def _fresher_stale(current, entry, max_stale):
+        if entry is None or max_stale is None or not entry.is_usable(max_stale):
+            return current
+        if current is None or entry.updated_at > current.updated_at:
+            return entry
+        return current
+
+    @staticmethod
+    def _prepare(entry):
+        """
+        Render the response body once, when the entry is written (or promoted from a tier that
+        predates pre-rendering), so hits never re-encode the payload.
+        """
+        return entry.prerendered() if prerender_enabled() else entry
+
+    def set(self, city, state, country, entry):
+        key = make_cache_key(city, state, country)
+        entry = self._prepare(entry)
+        for tier in reversed(self.tiers):
+            entry = tier.set(key, entry)
+        self.negative.forget(key)
+        return entry
+
+    def get_version(self, city, state=None, country=None):
+        """
+        (updated_at, location) of the fresh entry for the location, or None; `location` is the
+        entry's own key, which may differ from the requested spelling. Used to answer conditional
+        requests; the Database tier reads only the timestamp and names. Not counted in the tier stats.
+        """
+        key = make_cache_key(city, state, country)
+        for tier in self.tiers:
+            version = tier.get_version(key)
+            if version is not None and timezone.now() < version[0] + cache_ttl():
+                return version
+        return None
+
+    def get_many(self, locations):
+        """
+        Bulk lookup for many (city, state, country) locations: each tier is asked once
+        for the keys still missing. Returns {normalized key: entry} for fresh hits only.
+        """
+        missing = list(dict.fromkeys(make_cache_key(*location) for location in locations))
+        found = {}
+        for index, tier in enumerate(self.tiers):
+            if not missing:
+                break
+            hits = {key: entry for key, entry in tier.get_many(missing).items() if entry.is_fresh}
+            for key, entry in hits.items():
+                for upper_tier in self.tiers[:index]:
+                    upper_tier.set(key, entry)
+            found.update(hits)
+            with self._lock:
+                self._stats[tier.name]['hits'] += len(hits)
+                self._stats[tier.name]['misses'] += len(missing) - len(hits)
+            missing = [key for key in missing if key not in hits]
+        return found
+
+    async def aget(self, city, state=None, country=None, max_stale=None):
+        key = make_cache_key(city, state, country)
+        stale_entry = None
+        for index, tier in enumerate(self.tiers):
+            entry = await tier.aget(key)
+            if entry is not None and entry.is_fresh:
+                self._record(tier.name, hit=True)
+                if index:
+                    entry = self._prepare(entry)
+                for upper_tier in self.tiers[:index]:
+                    await upper_tier.aset(key, entry)
+                return entry
+            stale_entry = self._fresher_stale(stale_entry, entry, max_stale)
+            self._record(tier.name, hit=False)
+        return stale_entry
+
+    async def aset(self, city, state, country, entry):
+        key = make_cache_key(city, state, country)
+        entry = self._prepare(entry)
+        for tier in reversed(self.tiers):
+            entry = await tier.aset(key, entry)
+        await self.negative.aforget(key)
+        return entry
+
+    def delete(self, city, state=None, country=None):
+        key = make_cache_key(city, state, country)
+        for tier in self.tiers:
+            tier.delete(key)
+
+    def clear(self):
+        for tier in self.tiers:
+            tier.clear()
+
+    # --- Observability ---
+
+    def _record(self, tier_name, hit):
+        with self._lock:
+            self._stats[tier_name]['hits' if hit else 'misses'] += 1
+
+    def record_stale(self, cache_status):
+        """
+        Count a response served from an expired entry (CACHE_STALE or CACHE_STALE_IF_ERROR).
+        """
+        with self._lock:
+            self._stale_served[cache_status] = self._stale_served.get(cache_status, 0) + 1
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats = {tier.name: {'hits': 0, 'misses': 0} for tier in self.tiers}
+            self._stale_served = {}
+        self.negative.reset_stats()
+
+    def stats(self):
+        """
+        Per-tier lookup counters and hit ratio, in tier order.
+        """
+        with self._lock:
+            snapshot = {name: dict(counts) for name, counts in self._stats.items()}
+            stale_served = dict(self._stale_served)
+        for tier in self.tiers:
+            counts = snapshot[tier.name]
+            lookups = counts['hits'] + counts['misses']
+            counts['hit_ratio'] = round(counts['hits'] / lookups, 4) if lookups else None
+            if isinstance(tier, LocalMemoryTier):
+                counts['size'] = len(tier)
+                counts['max_entries'] = tier.max_entries
+        snapshot['stale_served'] = stale_served
+        snapshot['negative'] = self.negative.stats()
+        return snapshot
+
+
+_weather_cache = None
+_weather_cache_lock = threading.Lock()
+
+
+def get_weather_cache():
+    """
+    Process-wide TieredWeatherCache built from settings on first use.
+    """
+    global _weather_cache
+    if _weather_cache is None:
+        with _weather_cache_lock:
+            if _weather_cache is None:
+                _weather_cache = TieredWeatherCache.from_settings()
+    return _weather_cache
+
+
+def reset_weather_cache():
+    """
+    Drop the process-wide cache so the next call rebuilds it (e.g. after settings change).
+    """
+    global _weather_cache
+    with _weather_cache_lock:
+        _weather_cache = None
@@ -0,0 +1,353 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+
+from .metrics import upstream_request_seconds
+from .profiling import record_upstream
+from .quota import INTERACTIVE, UpstreamQuotaExceeded, get_upstream_quota
+
+logger = logging.getLogger(__name__)
+
+
+def upstream_error_status(e):
+    """
+    Status label of an upstream call that got no response.
+    """
+    return 'timeout' if isinstance(e, requests.exceptions.Timeout) else 'connection_error'
+
+
+def record_upstream_call(started, status):
+    """
+    Time one upstream attempt (started at perf_counter `started`) for /metrics and, if the
+    request is being profiled, its profile.
+    """
+    seconds = time.perf_counter() - started
+    upstream_request_seconds.observe(seconds, status)
+    record_upstream(status, seconds)
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """
+    Raised without calling upstream while the provider's circuit breaker is open.
+    """
+
+
+class CircuitBreaker:
+    """
+    Classic closed -> open -> half-open breaker.
+
+    After `failure_threshold` consecutive failures the circuit opens and calls fail fast
+    for `reset_timeout` seconds. Then a single trial call is let through (half-open):
+    success closes the circuit, failure opens it again.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    def allow_request(self):
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    return False
+                self._state = self.HALF_OPEN
+                self._trial_in_flight = False
+            # Half-open: only one trial call at a time
+            if self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    logger.warning(f"Circuit opened after {self._failures} consecutive upstream failures")
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    def release(self):
+        """
+        End an admitted call without a verdict on the provider: frees the half-open trial slot.
+        """
+        with self._lock:
+            self._trial_in_flight = False
+
+
+@contextmanager
+def breaker_outcome(breaker, retry_statuses):
+    """
+    Records how a call admitted by `breaker` ended, on every exit path, so a half-open trial
+    can never stay in flight. Success, and error responses outside `retry_statuses` (a 404
+    still proves the provider is healthy), close the circuit; any other provider error
+    (timeouts, broken connections, truncated bodies, 5xx, ...) counts as a failure. Errors on
+    our side say nothing about the provider and only release the call: an exhausted call budget,
+    or cancellation (an ASGI client disconnecting mid-call).
+    """
+    try:
+        yield
+    except UpstreamQuotaExceeded:
+        breaker.release()
+        raise
+    except requests.exceptions.HTTPError as e:
+        if e.response is not None and e.response.status_code not in retry_statuses:
+            breaker.record_success()
+        else:
+            breaker.record_failure()
+        raise
+    except requests.exceptions.RequestException:
+        breaker.record_failure()
+        raise
+    except BaseException:
+        breaker.release()
+        raise
+    else:
+        breaker.record_success()
+
+
+class OpenWeatherMapClient:
+    """
+    Pooled, resilient HTTP client for the OpenWeatherMap current-weather API.
+
+    - One keep-alive `requests.Session` with a bounded connection pool, shared by all threads.
+    - Connect/read timeouts on every call, so a hung provider cannot pin a worker.
+    - Bounded retries with full-jitter exponential backoff for transient failures
+      (connection errors, timeouts, 429 and 5xx); all calls are idempotent GETs.
+    - A circuit breaker that fails fast with CircuitOpenError while the provider is down.
+    - Every attempt is admitted by the upstream quota governor first (api.quota); a retry the
+      budget cannot cover ends the call like an exhausted retry.
+    """
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, base_url=None, api_key=None, connect_timeout=None, read_timeout=None,
+                 max_retries=None, backoff_base=None, backoff_max=None, pool_size=None, breaker=None):
+        self.base_url = base_url or settings.WEATHER_API_BASE_URL
+        self.api_key = api_key or settings.WEATHER_API_KEY
+        self.timeout = (
+            connect_timeout if connect_timeout is not None else getattr(settings, 'WEATHER_API_CONNECT_TIMEOUT', 3.05),
+            read_timeout if read_timeout is not None else getattr(settings, 'WEATHER_API_READ_TIMEOUT', 10),
+        )
+        self.max_retries = max_retries if max_retries is not None else getattr(settings, 'WEATHER_API_MAX_RETRIES', 2)
+        self.backoff_base = backoff_base if backoff_base is not None else getattr(settings, 'WEATHER_API_BACKOFF_BASE', 0.25)
+        self.backoff_max = backoff_max if backoff_max is not None else getattr(settings, 'WEATHER_API_BACKOFF_MAX', 2.0)
+        self.breaker = breaker or CircuitBreaker(
+            failure_threshold=getattr(settings, 'WEATHER_CIRCUIT_FAILURE_THRESHOLD', 5),
+            reset_timeout=getattr(settings, 'WEATHER_CIRCUIT_RESET_SECONDS', 30),
+        )
+
+        pool_size = pool_size or getattr(settings, 'WEATHER_API_POOL_SIZE', 20)
+        self.session = requests.Session()
+        # Retries are handled here (with jitter and breaker accounting), not by urllib3
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def backoff(self, attempt):
+        """
+        Full-jitter exponential backoff: uniform(0, min(max, base * 2^attempt)).
+        """
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def can_retry(self, attempt, priority):
+        return attempt < self.max_retries and get_upstream_quota().try_acquire(priority)[0]
+
+    def get_current_weather(self, params, priority=INTERACTIVE):
+        """
+        GET the current weather for `params` (q=... or lat/lon). Returns the decoded JSON.
+        Raises requests.HTTPError for non-retryable (or exhausted) error responses, and
+        UpstreamQuotaExceeded when the call budget has no room for `priority`.
+        """
+        # The breaker is asked first, so a call it refuses spends no call budget
+        # (an admitted call refused by the budget only releases the breaker)
+        if not self.breaker.allow_request():
+            raise CircuitOpenError("Upstream weather provider circuit is open; failing fast.")
+
+        params = dict(params, appid=self.api_key)
+        with breaker_outcome(self.breaker, self.RETRY_STATUSES):
+            get_upstream_quota().acquire(priority)
+            attempt = 0
+            while True:
+                started = time.perf_counter()
+                try:
+                    response = self.session.get(self.base_url, params=params, timeout=self.timeout)
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                    record_upstream_call(started, upstream_error_status(e))
+                    if not self.can_retry(attempt, priority):
+                        raise
+                    logger.warning(f"Upstream call failed ({e.__class__.__name__}), retry {attempt + 1}/{self.max_retries}")
+                else:
+                    record_upstream_call(started, response.status_code)
+                    if response.status_code not in self.RETRY_STATUSES or not self.can_retry(attempt, priority):
+                        response.raise_for_status()
+                        return response.json()
+                    logger.warning(f"Upstream returned {response.status_code}, retry {attempt + 1}/{self.max_retries}")
+                    response.close()
+
+                time.sleep(self.backoff(attempt))
+                attempt += 1
+
+    def close(self):
+        self.session.close()
+
+
+def _as_requests_response(status_code, reason, headers, url, content):
+    """
+    Build a requests.Response so callers handle errors from both clients alike.
+    """
+    response = requests.Response()
+    response.status_code = status_code
+    response.reason = reason
+    response.headers.update(headers)
+    response.url = url
+    response._content = content
+    return response
+
+
+class AsyncOpenWeatherMapClient:
+    """
+    Non-blocking counterpart of OpenWeatherMapClient built on aiohttp.
+
+    Same timeouts, retry policy and circuit breaker (the breaker instance is shared with the
+    sync client, so both paths agree on whether the provider is down). Errors are raised as
+    the same `requests` exception types so views handle both clients identically.
+    """
+    RETRY_STATUSES = OpenWeatherMapClient.RETRY_STATUSES
+
+    def __init__(self, sync_client):
+        import aiohttp
+
+        self._aiohttp = aiohttp
+        self.base_url = sync_client.base_url
+        self.api_key = sync_client.api_key
+        self.max_retries = sync_client.max_retries
+        self.backoff = sync_client.backoff
+        self.breaker = sync_client.breaker
+        connect_timeout, read_timeout = sync_client.timeout
+        # Must be created inside the running event loop it will be used on
+        self.session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout),
+            connector=aiohttp.TCPConnector(limit=getattr(settings, 'WEATHER_API_ASYNC_POOL_SIZE', 100)),
+        )
+
+    async def can_retry(self, attempt, priority):
+        return attempt < self.max_retries and (await get_upstream_quota().atry_acquire(priority))[0]
+
+    async def get_current_weather(self, params, priority=INTERACTIVE):
+        if not self.breaker.allow_request():
+            raise CircuitOpenError("Upstream weather provider circuit is open; failing fast.")
+
+        params = dict(params, appid=self.api_key)
+        with breaker_outcome(self.breaker, self.RETRY_STATUSES):
+            await get_upstream_quota().aacquire(priority)
+            attempt = 0
+            while True:
+                started = time.perf_counter()
+                try:
+                    async with self.session.get(self.base_url, params=params) as response:
+                        content = await response.read()
+                        upstream = _as_requests_response(
+                            response.status, response.reason, response.headers, str(response.url), content
+                        )
+                except asyncio.TimeoutError as e:
+                    record_upstream_call(started, 'timeout')
+                    if not await self.can_retry(attempt, priority):
+                        raise requests.exceptions.Timeout(str(e)) from e
+                    logger.warning(f"Upstream call failed (Timeout), retry {attempt + 1}/{self.max_retries}")
+                except self._aiohttp.ClientError as e:
+                    record_upstream_call(started, 'connection_error')
+                    if not await self.can_retry(attempt, priority):
+                        raise requests.exceptions.ConnectionError(str(e)) from e
+                    logger.warning(f"Upstream call failed ({e.__class__.__name__}), retry {attempt + 1}/{self.max_retries}")
+                else:
+                    record_upstream_call(started, upstream.status_code)
+                    if upstream.status_code not in self.RETRY_STATUSES or not await self.can_retry(attempt, priority):
+                        upstream.raise_for_status()
+                        return upstream.json()
+                    logger.warning(f"Upstream returned {upstream.status_code}, retry {attempt + 1}/{self.max_retries}")
+
+                await asyncio.sleep(self.backoff(attempt))
+                attempt += 1
+
+    async def aclose(self):
+        await self.session.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+# aiohttp sessions are bound to the event loop it was first used on, so keep one per loop
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_weather_client():
+    """
+    Process-wide client so the connection pool and circuit state are shared by all requests.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = OpenWeatherMapClient()
+    return _client
+
+
+def get_async_weather_client():
+    """
+    Async client for the running event loop, sharing the process-wide circuit breaker.
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = AsyncOpenWeatherMapClient(get_weather_client())
+        _async_clients[loop] = client
+    return client
+
+
+async def aclose_async_weather_client():
+    """
+    Close the running loop's async client (call on ASGI lifespan shutdown or before the loop ends).
+    """
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+def reset_weather_client():
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+        _client = None
+        _async_clients.clear()
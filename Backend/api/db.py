@@ -0,0 +1,87 @@
+import asyncio
+import functools
+import logging
+import random
+import time
+
+from django.conf import settings
+from django.db import OperationalError, connection
+
+logger = logging.getLogger(__name__)
+
+# SQLite busy/locked errors, and PostgreSQL serialization failures and deadlocks
+LOCK_ERROR_MESSAGES = ('database is locked', 'database table is locked', 'database is busy')
+LOCK_ERROR_SQLSTATES = {'40001', '40P01'}
+
+
+def configure_connection(sender, connection, **kwargs):
+    """
+    connection_created receiver: applies WEATHER_SQLITE_PRAGMAS to every new SQLite connection.
+    Journal mode and auto_vacuum are stored in the database file; the rest are per connection,
+    which is why persistent connections (CONN_MAX_AGE) matter here.
+    """
+    if connection.vendor != 'sqlite':
+        return
+    pragmas = getattr(settings, 'WEATHER_SQLITE_PRAGMAS', {})
+    with connection.cursor() as cursor:
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+
+
+def is_lock_error(e):
+    """
+    True for errors that only mean another writer held the lock: retrying the statement may succeed.
+    """
+    if not isinstance(e, OperationalError):
+        return False
+    cause = e.__cause__
+    sqlstate = getattr(cause, 'sqlstate', None) or getattr(cause, 'pgcode', None)
+    if sqlstate in LOCK_ERROR_SQLSTATES:
+        return True
+    message = str(e).lower()
+    return any(text in message for text in LOCK_ERROR_MESSAGES)
+
+
+def lock_retry_delays(attempts=None, base_delay=None):
+    """
+    Jittered exponential backoff between attempts, in seconds (attempts - 1 delays).
+    """
+    attempts = attempts or getattr(settings, 'WEATHER_DB_LOCK_RETRIES', 3)
+    base_delay = base_delay if base_delay is not None else getattr(settings, 'WEATHER_DB_LOCK_RETRY_DELAY', 0.05)
+    return [base_delay * 2 ** attempt * random.uniform(0.5, 1.5) for attempt in range(attempts - 1)]
+
+
+def retry_on_lock(func):
+    """
+    Retry a write when the database reports lock contention that outlasted the busy timeout.
+
+    Only the outermost transaction can be retried: inside an atomic block the error has already
+    broken the enclosing transaction, so it is re-raised for the block's owner to handle.
+    Works for plain and async functions.
+    """
+    if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            for delay in lock_retry_delays():
+                try:
+                    return await func(*args, **kwargs)
+                except OperationalError as e:
+                    if not is_lock_error(e):
+                        raise
+                    logger.warning(f"Database locked in {func.__qualname__}, retrying in {delay * 1000:.0f}ms")
+                await asyncio.sleep(delay)
+            return await func(*args, **kwargs)
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        for delay in lock_retry_delays():
+            try:
+                return func(*args, **kwargs)
+            except OperationalError as e:
+                if not is_lock_error(e) or connection.in_atomic_block:
+                    raise
+                logger.warning(f"Database locked in {func.__qualname__}, retrying in {delay * 1000:.0f}ms")
+            time.sleep(delay)
+        return func(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,120 @@
+import atexit
+import logging
+import threading
+from collections import Counter
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from .models import WeatherCache
+
+logger = logging.getLogger(__name__)
+
+
+class DemandTracker:
+    """
+    Lightweight per-process request counter for weather locations.
+
+    Requests only bump an in-memory Counter, keyed by the canonical location of the entry they
+    were served. A background thread adds the accumulated counts to WeatherCache.hit_count
+    (and last_accessed_at) every `flush_interval` seconds. The prefetch scheduler and the
+    retention sweeper rank entries by these columns.
+    """
+
+    def __init__(self, flush_interval=None):
+        self.flush_interval = flush_interval
+        self._counts = Counter()
+        self._last_seen = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._stopped = None
+        self._thread_lock = threading.Lock()
+
+    def get_flush_interval(self):
+        if self.flush_interval is not None:
+            return self.flush_interval
+        return getattr(settings, 'WEATHER_DEMAND_FLUSH_SECONDS', 30)
+
+    def record(self, key):
+        """
+        Count one request for `key`. Never touches the database.
+        """
+        self._ensure_started()
+        now = timezone.now()
+        with self._lock:
+            self._counts[key] += 1
+            self._last_seen[key] = now
+
+    def pending(self):
+        with self._lock:
+            return dict(self._counts)
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._thread_lock:
+            if self._thread is None:
+                self._stopped = threading.Event()
+                self._thread = threading.Thread(target=self._run, args=(self._stopped,), name='demand-tracker',
+                                                daemon=True)
+                self._thread.start()
+
+    def _run(self, stopped):
+        while True:
+            stopping = stopped.wait(self.get_flush_interval())
+            try:
+                self.flush()
+            finally:
+                connection.close()
+            if stopping:
+                return
+
+    def stop(self, timeout=None):
+        """
+        Flush once more and end the background thread, waiting up to `timeout` seconds for it
+        (e.g. before the database goes away in tests). A later record() starts a new one.
+        """
+        with self._thread_lock:
+            thread, self._thread = self._thread, None
+            if thread is None:
+                return
+            self._stopped.set()
+        thread.join(timeout)
+
+    def flush(self):
+        """
+        Persist the accumulated counts. Returns the number of keys written.
+        """
+        with self._flush_lock:
+            with self._lock:
+                counts, self._counts = self._counts, Counter()
+                last_seen, self._last_seen = self._last_seen, {}
+
+            written, failed, error = 0, 0, None
+            for key, count in counts.items():
+                city, state, country = key
+                try:
+                    WeatherCache.objects.record_hits(city, state, country, count, last_seen[key])
+                    written += 1
+                except Exception as e:
+                    # Demand data is advisory: a failing key only loses its own counts
+                    failed, error = failed + 1, e
+            if failed:
+                logger.warning(f"Error flushing {failed} of {len(counts)} demand counters: {error}")
+            return written
+
+
+demand_tracker = DemandTracker()
+
+
+def _flush_at_exit():
+    try:
+        demand_tracker.flush()
+        connection.close()
+    except Exception:
+        pass
+
+
+atexit.register(_flush_at_exit)
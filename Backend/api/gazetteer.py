@@ -0,0 +1,367 @@
+import bisect
+import csv
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+import unicodedata
+from array import array
+from collections import namedtuple
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+City = namedtuple('City', ['name', 'state', 'country', 'population', 'lat', 'lon'])
+
+MAGIC = b'WGAZ0002'
+# magic, source mtime (ns) and size, n_keys, n_records, n_prefixes, top_k, then the start of each
+# section and the end of the file
+HEADER = struct.Struct('<8s2Q14I')
+SECTIONS = (
+    'key_offsets', 'key_records', 'key_population', 'record_offsets', 'prefix_offsets', 'prefix_top',
+    'key_blob', 'record_blob', 'prefix_blob',
+)
+NO_RECORD = 0xFFFFFFFF
+
+
+class GazetteerError(Exception):
+    """
+    The index file is missing, corrupt or was built for another platform.
+    """
+
+
+class UnknownCityError(Exception):
+    """
+    Raised for a city the gazetteer does not know (with WEATHER_GAZETTEER_REJECT_UNKNOWN), so the
+    request is answered locally instead of with the provider's 404.
+    """
+
+    def __init__(self, city, suggestions=()):
+        super().__init__(f"Unknown city: {city}")
+        self.city = city
+        self.suggestions = list(suggestions)
+
+
+def normalize_name(name):
+    """
+    Index key of a place name: accents stripped, punctuation to spaces, whitespace collapsed,
+    upper-cased ("São  Paulo" and "sao-paulo" both give "SAO PAULO").
+    """
+    decomposed = unicodedata.normalize('NFKD', name or '')
+    stripped = ''.join(c if c.isalnum() else ' ' for c in decomposed if not unicodedata.combining(c))
+    return ' '.join(stripped.upper().split())
+
+
+def read_seed(path):
+    """
+    Cities from the bundled TSV (api/data/cities.tsv): name, ascii_name, alternate_names
+    (comma separated), country, state, population, lat, lon. Lines starting with # are comments.
+    """
+    with open(path, encoding='utf-8', newline='') as f:
+        for row in csv.reader(f, delimiter='\t', quoting=csv.QUOTE_NONE):
+            if not row or row[0].startswith('#'):
+                continue
+            name, ascii_name, alternate_names, country, state, population, lat, lon = row
+            yield name, [ascii_name] + alternate_names.split(','), country, state, int(population or 0), float(lat), float(lon)
+
+
+def read_geonames(path, admin1_path=None, min_population=0, alternate_names=False):
+    """
+    Cities from a GeoNames dump (cities500.txt, cities1000.txt, ...; https://download.geonames.org/export/dump/).
+    State names come from admin1CodesASCII.txt if given, else the raw admin1 code is kept.
+    Alternate names are many and multilingual, so they are only indexed if asked for.
+    """
+    states = {}
+    if admin1_path:
+        with open(admin1_path, encoding='utf-8', newline='') as f:
+            for row in csv.reader(f, delimiter='\t', quoting=csv.QUOTE_NONE):
+                states[row[0]] = row[1]
+    with open(path, encoding='utf-8', newline='') as f:
+        for row in csv.reader(f, delimiter='\t', quoting=csv.QUOTE_NONE):
+            population = int(row[14] or 0)
+            if population < min_population:
+                continue
+            names = [row[2]] + (row[3].split(',') if alternate_names else [])
+            state = states.get(f"{row[8]}.{row[10]}", row[10])
+            yield row[1], names, row[8], state, population, float(row[4]), float(row[5])
+
+
+def source_stamp(path):
+    """
+    (mtime in ns, size) of a source file, stored in the index header to tell when it changed.
+    """
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def build_index(cities, path, top_k=20, scan_limit=256, stamp=(0, 0)):
+    """
+    Compile `cities` ((name, other names, country, state, population, lat, lon) tuples) into the
+    index file at `path`. Returns the number of cities. `stamp` is the source_stamp of the seed
+    the cities came from, (0, 0) for other sources (which get_gazetteer then never rebuilds).
+
+    Every distinct normalized name of a city is a key, once on its own and once prefixed with
+    the country ("IN:PATNA"), so prefix and exact queries with or without a country are all a
+    binary search over one sorted array. Prefixes matching more than `scan_limit` keys get their
+    `top_k` most populous cities precomputed; shorter ranges are ranked at query time.
+    The file is written next to `path` and renamed into place, so readers never see half of it.
+    """
+    records = []
+    keys = []
+    for name, other_names, country, state, population, lat, lon in cities:
+        record_id = len(records)
+        population = min(int(population), NO_RECORD - 1)
+        records.append('\t'.join((name, state, country, str(population), repr(lat), repr(lon))).encode('utf-8'))
+        for key in {normalize_name(n) for n in [name, *other_names]} - {''}:
+            keys.append((key.encode('utf-8'), record_id, population))
+            keys.append((f"{country.upper()}:{key}".encode('utf-8'), record_id, population))
+    keys.sort(key=lambda k: (k[0], -k[2]))
+
+    prefixes = []
+    runs = [(0, len(keys))]
+    level = 1
+    while runs:
+        large_runs = []
+        for start, end in runs:
+            run_start = start
+            for i in range(start + 1, end + 1):
+                if i < end and keys[i][0][:level] == keys[run_start][0][:level]:
+                    continue
+                prefix = keys[run_start][0][:level]
+                if i - run_start > scan_limit and len(prefix) == level:
+                    large_runs.append((run_start, i))
+                    ranked = sorted(range(run_start, i), key=lambda j: -keys[j][2])
+                    top = list(dict.fromkeys(keys[j][1] for j in ranked))[:top_k]
+                    prefixes.append((prefix, top + [NO_RECORD] * (top_k - len(top))))
+                run_start = i
+        runs = large_runs
+        level += 1
+    prefixes.sort()
+
+    def offsets(blobs):
+        result = array('I', [0])
+        for blob in blobs:
+            result.append(result[-1] + len(blob))
+        return result
+
+    sections = {
+        'key_offsets': offsets(k[0] for k in keys),
+        'key_records': array('I', (k[1] for k in keys)),
+        'key_population': array('I', (k[2] for k in keys)),
+        'record_offsets': offsets(records),
+        'prefix_offsets': offsets(p[0] for p in prefixes),
+        'prefix_top': array('I', (record_id for p in prefixes for record_id in p[1])),
+        'key_blob': b''.join(k[0] for k in keys),
+        'record_blob': b''.join(records),
+        'prefix_blob': b''.join(p[0] for p in prefixes),
+    }
+    if sys.byteorder != 'little':
+        for section in sections.values():
+            if isinstance(section, array):
+                section.byteswap()
+
+    starts = []
+    position = HEADER.size
+    for name in SECTIONS:
+        starts.append(position)
+        position += len(memoryview(sections[name]).cast('B'))
+    header = HEADER.pack(MAGIC, *stamp, len(keys), len(records), len(prefixes), top_k, *starts, position)
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(header)
+        for name in SECTIONS:
+            f.write(sections[name])
+    os.replace(tmp_path, path)
+    return len(records)
+
+
+class Gazetteer:
+    """
+    Read-only view of a compiled index file (see build_index).
+
+    The file is memory-mapped, so every worker process on the host shares the same page-cache
+    pages and opening it costs nothing up front. Queries are binary searches over the sorted
+    key array (about 20 probes for 400k keys) plus, for short prefixes, one lookup in the
+    precomputed top-cities table; nothing is parsed except the records returned.
+    """
+
+    def __init__(self, path):
+        if sys.byteorder != 'little' or array('I').itemsize != 4:
+            raise GazetteerError("The gazetteer index needs a little-endian platform with 32-bit unsigned ints.")
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+        if len(self._view) < HEADER.size:
+            self.close()
+            raise GazetteerError(f"Truncated gazetteer index: {path}")
+        fields = HEADER.unpack_from(self._view)
+        magic, self.stamp, bounds = fields[0], fields[1:3], fields[7:]
+        self.n_keys, self.n_records, self.n_prefixes, self.top_k = fields[3:7]
+        if magic != MAGIC or bounds[-1] != len(self._view):
+            self.close()
+            raise GazetteerError(f"Not a gazetteer index (or built by another version): {path}")
+        section = dict(zip(SECTIONS, zip(bounds, bounds[1:])))
+        self._key_offsets = self._view[slice(*section['key_offsets'])].cast('I')
+        self._key_records = self._view[slice(*section['key_records'])].cast('I')
+        self._key_population = self._view[slice(*section['key_population'])].cast('I')
+        self._record_offsets = self._view[slice(*section['record_offsets'])].cast('I')
+        self._prefix_offsets = self._view[slice(*section['prefix_offsets'])].cast('I')
+        self._prefix_top = self._view[slice(*section['prefix_top'])].cast('I')
+        self._key_blob = self._view[slice(*section['key_blob'])]
+        self._record_blob = self._view[slice(*section['record_blob'])]
+        self._prefix_blob = self._view[slice(*section['prefix_blob'])]
+        self._keys = range(self.n_keys)
+
+    def __len__(self):
+        return self.n_records
+
+    def _key(self, index):
+        return bytes(self._key_blob[self._key_offsets[index]:self._key_offsets[index + 1]])
+
+    def _prefix(self, index):
+        return bytes(self._prefix_blob[self._prefix_offsets[index]:self._prefix_offsets[index + 1]])
+
+    def record(self, record_id):
+        raw = bytes(self._record_blob[self._record_offsets[record_id]:self._record_offsets[record_id + 1]])
+        name, state, country, population, lat, lon = raw.decode('utf-8').split('\t')
+        return City(name, state, country, int(population), float(lat), float(lon))
+
+    @staticmethod
+    def _target(name, country):
+        key = normalize_name(name)
+        if not key:
+            return None
+        if country:
+            key = f"{country.strip().upper()}:{key}"
+        return key.encode('utf-8')
+
+    def _ranked(self, start, end, limit):
+        ranked = sorted(range(start, end), key=lambda i: -self._key_population[i])
+        return list(dict.fromkeys(self._key_records[i] for i in ranked))[:limit]
+
+    def complete(self, prefix, country=None, limit=10):
+        """
+        Up to `limit` (at most top_k) cities whose name, or any alternate name, starts with
+        `prefix`, most populous first. `country` is an optional ISO 3166 alpha-2 code.
+        """
+        target = self._target(prefix, country)
+        if target is None:
+            return []
+        limit = min(limit, self.top_k)
+        start = bisect.bisect_left(self._keys, target, key=self._key)
+        # No UTF-8 sequence contains 0xFF, so this sorts after every key starting with target
+        end = bisect.bisect_left(self._keys, target + b'\xff', lo=start, key=self._key)
+        if end - start <= 0:
+            return []
+
+        index = bisect.bisect_left(range(self.n_prefixes), target, key=self._prefix)
+        if index < self.n_prefixes and self._prefix(index) == target:
+            top = self._prefix_top[index * self.top_k:(index + 1) * self.top_k]
+            record_ids = [record_id for record_id in top if record_id != NO_RECORD][:limit]
+        else:
+            record_ids = self._ranked(start, end, limit)
+        return [self.record(record_id) for record_id in record_ids]
+
+    def lookup(self, name, country=None):
+        """
+        Cities named exactly `name` (after normalization, alternate names included), most populous first.
+        """
+        target = self._target(name, country)
+        if target is None:
+            return []
+        start = bisect.bisect_left(self._keys, target, key=self._key)
+        end = bisect.bisect_right(self._keys, target, lo=start, key=self._key)
+        return [self.record(record_id) for record_id in self._ranked(start, end, end - start)]
+
+    def suggest(self, name, country=None, limit=5):
+        """
+        Completions of the longest leading part of `name` that has any (for "did you mean").
+        """
+        key = normalize_name(name)
+        for length in range(len(key), 1, -1):
+            suggestions = self.complete(key[:length], country, limit)
+            if suggestions:
+                return suggestions
+        return []
+
+    def close(self):
+        for attr in ('_key_offsets', '_key_records', '_key_population', '_record_offsets', '_prefix_offsets',
+                     '_prefix_top', '_key_blob', '_record_blob', '_prefix_blob', '_view'):
+            view = self.__dict__.pop(attr, None)
+            if view is not None:
+                view.release()
+        self._mmap.close()
+
+
+def gazetteer_source():
+    return getattr(settings, 'WEATHER_GAZETTEER_SOURCE', settings.BASE_DIR / 'api' / 'data' / 'cities.tsv')
+
+
+def gazetteer_index_path():
+    return getattr(settings, 'WEATHER_GAZETTEER_INDEX', settings.BASE_DIR / 'gazetteer.idx')
+
+
+_gazetteer = None
+_gazetteer_lock = threading.Lock()
+_gazetteer_unavailable = False
+
+
+def _open_index(path, source):
+    """
+    The Gazetteer at `path`, first (re)built from the seed at `source` if the index is missing,
+    unreadable (e.g. written by an older version) or was built from a different version of the seed.
+    Indexes built from other sources (stamp (0, 0), see build_gazetteer), or deployed without
+    the seed, are used as they are.
+    """
+    stamp = source_stamp(source) if os.path.exists(source) else None
+    if not os.path.exists(path):
+        reason = 'missing'
+    else:
+        try:
+            gazetteer = Gazetteer(path)
+        except GazetteerError as e:
+            logger.warning(f"{e}; rebuilding it from the seed (build_gazetteer makes a full one)")
+            reason = 'unreadable'
+        else:
+            if stamp is None or gazetteer.stamp in ((0, 0), stamp):
+                return gazetteer
+            gazetteer.close()
+            reason = 'stale'
+    count = build_index(read_seed(source), path, stamp=stamp)
+    logger.info(f"Built gazetteer index {path} with {count} cities from the seed (index was {reason})")
+    return Gazetteer(path)
+
+
+def get_gazetteer():
+    """
+    Process-wide Gazetteer over WEATHER_GAZETTEER_INDEX, or None if it is disabled or cannot be
+    opened (callers then skip validation). An index missing or out of date with
+    WEATHER_GAZETTEER_SOURCE (the bundled seed) is built from it on first use; build a full one
+    with `python manage.py build_gazetteer`.
+    """
+    global _gazetteer, _gazetteer_unavailable
+    if _gazetteer is not None or _gazetteer_unavailable:
+        return _gazetteer
+    if not getattr(settings, 'WEATHER_GAZETTEER_ENABLED', True):
+        return None
+    with _gazetteer_lock:
+        if _gazetteer is None and not _gazetteer_unavailable:
+            try:
+                _gazetteer = _open_index(str(gazetteer_index_path()), gazetteer_source())
+            except (OSError, ValueError, GazetteerError) as e:
+                logger.warning(f"City gazetteer unavailable, not validating cities: {e}")
+                _gazetteer_unavailable = True
+    return _gazetteer
+
+
+def reset_gazetteer():
+    global _gazetteer, _gazetteer_unavailable
+    with _gazetteer_lock:
+        if _gazetteer is not None:
+            _gazetteer.close()
+        _gazetteer = None
+        _gazetteer_unavailable = False
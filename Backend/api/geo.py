@@ -0,0 +1,82 @@
+import math
+
+from django.conf import settings
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE_LAT = math.pi * EARTH_RADIUS_KM / 180
+
+
+def grid_degrees():
+    """
+    Size of the grid cell request coordinates are snapped to (0.01 degrees is about 1.1 km).
+    """
+    return getattr(settings, 'WEATHER_GEO_GRID_DEGREES', 0.01)
+
+
+def search_radius_km():
+    """
+    A cached entry this close to the requested point answers a coordinate lookup.
+    """
+    return getattr(settings, 'WEATHER_GEO_RADIUS_KM', 5.0)
+
+
+def snap_to_grid(lat, lon, cell=None):
+    """
+    (lat, lon) rounded to the nearest grid point, so nearby requests share one upstream query
+    and one coalescing key. Longitude is wrapped into [-180, 180).
+    """
+    cell = cell or grid_degrees()
+    # The outer round() only strips float noise (0.30000000000000004)
+    lat = round(round(lat / cell) * cell, 6)
+    lon = round((round(lon / cell) * cell + 180) % 360 - 180, 6)
+    return max(-90.0, min(90.0, lat)), lon
+
+
+def grid_label(lat, lon):
+    """
+    Cache key `state` of an entry fetched for the grid point (lat, lon), e.g. "@25.61,85.14".
+    Keeps it in a row of its own, apart from the city search row of the place the provider names.
+    """
+    return f"@{lat},{lon}"
+
+
+def parse_grid_label(state):
+    """
+    (lat, lon) of a grid_label, or None for a real state.
+    """
+    if not state or not state.startswith('@'):
+        return None
+    lat, lon = state[1:].split(',')
+    return float(lat), float(lon)
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """
+    Great-circle distance between two points in kilometres.
+    """
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def bounding_box(lat, lon, radius_km):
+    """
+    Degree ranges enclosing the circle of `radius_km` around (lat, lon):
+    ((min_lat, max_lat), [(min_lon, max_lon), ...]). The longitude range is split in two where
+    it crosses the antimeridian, and covers everything near the poles.
+    """
+    dlat = radius_km / KM_PER_DEGREE_LAT
+    lat_range = (max(-90.0, lat - dlat), min(90.0, lat + dlat))
+    cos_lat = math.cos(math.radians(max(abs(lat_range[0]), abs(lat_range[1]))))
+    if cos_lat < 1e-6 or radius_km / (KM_PER_DEGREE_LAT * cos_lat) >= 180:
+        return lat_range, [(-180.0, 180.0)]
+
+    dlon = radius_km / (KM_PER_DEGREE_LAT * cos_lat)
+    low, high = lon - dlon, lon + dlon
+    if low < -180:
+        return lat_range, [(low + 360, 180.0), (-180.0, high)]
+    if high > 180:
+        return lat_range, [(low, 180.0), (-180.0, high - 360)]
+    return lat_range, [(low, high)]
@@ -0,0 +1,248 @@
+import atexit
+import logging
+import queue
+import threading
+from collections import namedtuple
+from functools import reduce
+from operator import or_
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .db import retry_on_lock
+from .models import SearchHistory, WeatherCache, history_snapshot
+
+logger = logging.getLogger(__name__)
+
+# data=None marks a repeat search that only needs its timestamp bumped (answered with 304)
+HistoryRecord = namedtuple('HistoryRecord', ['user_id', 'city', 'lookup_key', 'data'])
+
+DROP_NEWEST = 'drop_newest'
+DROP_OLDEST = 'drop_oldest'
+BLOCK = 'block'
+
+
+class HistoryWriter:
+    """
+    Write-behind buffer for SearchHistory.
+
+    Requests only put a record on a bounded in-process queue. A background thread drains it
+    every `flush_interval` seconds (sooner once `batch_size` records are waiting), collapses
+    repeats of the same (user, city) and writes each batch with one bulk upsert.
+
+    When the queue is full the drop policy decides: drop the new record, drop the oldest
+    queued one, or block the request for up to `block_timeout` seconds (then drop the new one).
+    History is best-effort, so drops are counted and logged rather than raised.
+    """
+
+    def __init__(self, max_size=None, flush_interval=None, batch_size=None, drop_policy=None, block_timeout=None):
+        self.max_size = max_size if max_size is not None else getattr(settings, 'WEATHER_HISTORY_QUEUE_SIZE', 10000)
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size if batch_size is not None else getattr(settings, 'WEATHER_HISTORY_BATCH_SIZE', 500)
+        self.drop_policy = drop_policy or getattr(settings, 'WEATHER_HISTORY_DROP_POLICY', DROP_OLDEST)
+        self.block_timeout = block_timeout if block_timeout is not None else getattr(settings, 'WEATHER_HISTORY_BLOCK_TIMEOUT', 0.05)
+        self._queue = queue.Queue(maxsize=self.max_size)
+        self._wakeup = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._stopped = None
+        self._thread_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {'enqueued': 0, 'written': 0, 'dropped': 0, 'failed': 0, 'flushes': 0}
+        self._dropped_reported = 0
+
+    def get_flush_interval(self):
+        if self.flush_interval is not None:
+            return self.flush_interval
+        return getattr(settings, 'WEATHER_HISTORY_FLUSH_SECONDS', 2)
+
+    def enqueue(self, user_id, city, lookup_key, data, block=True):
+        """
+        Queue a history write for the WeatherCache entry `lookup_key` (payload `data`, reduced to a snapshot
+        by the writer). Never touches the database. Returns False if the record was dropped.
+        Async callers pass block=False so a full queue cannot stall the event loop.
+        """
+        self._ensure_started()
+        record = HistoryRecord(user_id, city, lookup_key, data)
+        try:
+            if self.drop_policy == BLOCK and block:
+                self._queue.put(record, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(record)
+        except queue.Full:
+            if self.drop_policy != DROP_OLDEST or not self._replace_oldest(record):
+                self._count('dropped')
+                return False
+        self._count('enqueued')
+        if self._queue.qsize() >= self.batch_size:
+            self._wakeup.set()
+        return True
+
+    def _replace_oldest(self, record):
+        try:
+            self._queue.get_nowait()
+            self._count('dropped')
+            self._queue.put_nowait(record)
+            return True
+        except (queue.Empty, queue.Full):
+            return False
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        with self._stats_lock:
+            return dict(self._stats, pending=self.pending())
+
+    def _count(self, name, amount=1):
+        with self._stats_lock:
+            self._stats[name] += amount
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._thread_lock:
+            if self._thread is None:
+                self._stopped = threading.Event()
+                self._thread = threading.Thread(target=self._run, args=(self._stopped,), name='history-writer',
+                                                daemon=True)
+                self._thread.start()
+
+    def _run(self, stopped):
+        while True:
+            self._wakeup.wait(self.get_flush_interval())
+            self._wakeup.clear()
+            stopping = stopped.is_set()
+            try:
+                self.flush()
+            finally:
+                connection.close()
+            if stopping:
+                return
+
+    def stop(self, timeout=None):
+        """
+        Write what is queued and end the background thread, waiting up to `timeout` seconds for it
+        (e.g. before the database goes away in tests). A later enqueue() starts a new one.
+        """
+        with self._thread_lock:
+            thread, self._thread = self._thread, None
+            if thread is None:
+                return
+            self._stopped.set()
+            self._wakeup.set()
+        thread.join(timeout)
+
+    def flush(self):
+        """
+        Drain the queue and write everything in it. Returns the number of records taken off the queue.
+        """
+        with self._flush_lock:
+            records = []
+            while True:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            for start in range(0, len(records), self.batch_size):
+                self._write(records[start:start + self.batch_size])
+
+            dropped = self.stats()['dropped']
+            if dropped > self._dropped_reported:
+                logger.warning(f"Search history queue full: dropped {dropped - self._dropped_reported} records")
+                self._dropped_reported = dropped
+            return len(records)
+
+    def _write(self, records):
+        # Collapse repeats of the same search; a full record is never downgraded to a bare touch
+        latest = {}
+        for record in records:
+            key = (record.user_id, record.city)
+            if record.data is None and key in latest:
+                continue
+            latest[key] = record
+        upserts = [record for record in latest.values() if record.data is not None]
+        touches = [record for record in latest.values() if record.data is None]
+
+        try:
+            try:
+                self._commit(upserts, touches)
+                failed = 0
+            except IntegrityError:
+                # One bad record (e.g. its user was deleted since the search) fails the whole
+                # batch: write the records one by one so only that user's are lost
+                failed = self._commit_each(upserts, touches)
+        except Exception as e:
+            # History is best-effort; never let one bad batch stop the writer
+            self._count('failed', len(records))
+            logger.warning(f"Error writing {len(records)} search history records: {e}")
+            return
+        self._count('failed', failed)
+        self._count('written', len(records) - failed)
+        self._count('flushes')
+
+    @classmethod
+    def _commit_each(cls, upserts, touches):
+        """
+        Fallback for a batch that violated a constraint: each upsert in its own transaction.
+        Returns the number of records that could not be written.
+        """
+        failed = 0
+        for record in upserts:
+            try:
+                cls._commit([record], [])
+            except IntegrityError as e:
+                failed += 1
+                logger.warning(f"Error writing search history record for user {record.user_id}: {e}")
+        # Bumping timestamps cannot violate a constraint
+        cls._commit([], touches)
+        return failed
+
+    @classmethod
+    @retry_on_lock
+    def _commit(cls, upserts, touches):
+        with transaction.atomic():
+            cls._upsert(upserts, touches)
+
+    @staticmethod
+    def _upsert(upserts, touches):
+        if upserts:
+            # One query resolves every referenced cache entry
+            weather_ids = dict(WeatherCache.objects.filter(
+                lookup_key__in={record.lookup_key for record in upserts}
+            ).values_list('lookup_key', 'pk'))
+            # One INSERT ... ON CONFLICT (user, city) DO UPDATE for the whole batch
+            SearchHistory.objects.bulk_create(
+                [
+                    SearchHistory(
+                        user_id=record.user_id,
+                        city_name_queried=record.city,
+                        weather_id=weather_ids.get(record.lookup_key),
+                        snapshot=history_snapshot(record.data),
+                    )
+                    for record in upserts
+                ],
+                update_conflicts=True,
+                unique_fields=['user', 'city_name_queried'],
+                update_fields=['weather', 'snapshot', 'timestamp'],
+            )
+        if touches:
+            SearchHistory.objects.filter(reduce(or_, (
+                Q(user_id=record.user_id, city_name_queried=record.city) for record in touches
+            ))).update(timestamp=timezone.now())
+
+
+history_writer = HistoryWriter()
+
+
+def _flush_at_exit():
+    try:
+        history_writer.flush()
+        connection.close()
+    except Exception:
+        pass
+
+
+atexit.register(_flush_at_exit)
@@ -0,0 +1,48 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.gazetteer import (
+    Gazetteer, build_index, gazetteer_index_path, gazetteer_source, read_geonames, read_seed, source_stamp,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Compile the city gazetteer used for /api/cities/ autocomplete and city validation "
+        "into its memory-mapped index, from the bundled seed TSV or a GeoNames dump."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--source', default=str(gazetteer_source()),
+                            help='Seed TSV (name, ascii_name, alternate_names, country, state, population, lat, lon).')
+        parser.add_argument('--geonames',
+                            help='GeoNames dump instead of the seed, e.g. cities1000.txt (~150k cities) or cities500.txt (~200k).')
+        parser.add_argument('--admin1', help='GeoNames admin1CodesASCII.txt, for state names.')
+        parser.add_argument('--min-population', type=int, default=0)
+        parser.add_argument('--alternate-names', action='store_true',
+                            help='Also index GeoNames alternate names (much larger index).')
+        parser.add_argument('--output', default=str(gazetteer_index_path()))
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        # Only an index of the configured seed is stamped, so get_gazetteer rebuilds it when the
+        # seed changes but never replaces a GeoNames or custom index with the seed
+        stamp = (0, 0)
+        if options['geonames']:
+            cities = read_geonames(options['geonames'], options['admin1'], options['min_population'],
+                                   options['alternate_names'])
+        else:
+            cities = read_seed(options['source'])
+            if os.path.abspath(options['source']) == os.path.abspath(gazetteer_source()):
+                stamp = source_stamp(options['source'])
+        count = build_index(cities, options['output'], stamp=stamp)
+
+        gazetteer = Gazetteer(options['output'])
+        self.stdout.write(
+            f"{count} cities, {gazetteer.n_keys} keys, {gazetteer.n_prefixes} precomputed prefixes "
+            f"in {options['output']} ({os.path.getsize(options['output']) / 1e6:.1f} MB, "
+            f"{time.monotonic() - started:.1f}s). Restart the workers to pick it up."
+        )
+        gazetteer.close()
@@ -0,0 +1,107 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+
+from api.cache import cache_ttl
+from api.models import WeatherCache
+from api.services import WeatherService
+
+
+class RateLimiter:
+    """
+    Blocking token bucket: at most `calls_per_minute` acquisitions per minute, shared by all workers.
+    """
+
+    def __init__(self, calls_per_minute):
+        self.interval = 60.0 / calls_per_minute
+        self._next_slot = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class Command(BaseCommand):
+    help = (
+        "Refresh the most demanded WeatherCache entries shortly before they expire, "
+        "ranked by request counts and SearchHistory, within an upstream calls-per-minute budget."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=getattr(settings, 'WEATHER_PREFETCH_TOP_N', 100),
+                            help='How many of the most demanded entries to keep warm.')
+        parser.add_argument('--lead-minutes', type=float, default=getattr(settings, 'WEATHER_PREFETCH_LEAD_MINUTES', 5),
+                            help='Refresh entries expiring within this many minutes.')
+        parser.add_argument('--calls-per-minute', type=int, default=getattr(settings, 'WEATHER_PREFETCH_CALLS_PER_MINUTE', 30),
+                            help='Upstream budget for prefetching.')
+        parser.add_argument('--workers', type=int, default=getattr(settings, 'WEATHER_PREFETCH_WORKERS', 4))
+        parser.add_argument('--active-hours', type=float, default=24,
+                            help='Ignore entries nobody requested for this long.')
+        parser.add_argument('--history-weight', type=int, default=1,
+                            help='Weight of one SearchHistory row relative to one request.')
+        parser.add_argument('--interval', type=float, default=60, help='Seconds between cycles.')
+        parser.add_argument('--once', action='store_true', help='Run a single cycle and exit.')
+
+    def handle(self, *args, **options):
+        limiter = RateLimiter(options['calls_per_minute'])
+        while True:
+            started = time.monotonic()
+            due, refreshed, failed = self.run_cycle(limiter, options)
+            self.stdout.write(
+                f"[{timezone.now():%Y-%m-%d %H:%M:%S}] {due} due, {refreshed} refreshed, {failed} failed "
+                f"in {time.monotonic() - started:.1f}s"
+            )
+            if options['once']:
+                return
+            time.sleep(max(0, options['interval'] - (time.monotonic() - started)))
+
+    def select_due(self, options):
+        """
+        The head of the demand distribution, restricted to entries that expire within the lead time.
+        """
+        now = timezone.now()
+        due_before = now - cache_ttl() + timedelta(minutes=options['lead_minutes'])
+        active_since = now - timedelta(hours=options['active_hours'])
+
+        head = (
+            WeatherCache.objects
+            .ranked_by_demand(history_weight=options['history_weight'])
+            .filter(demand__gt=0)
+            .filter(Q(last_accessed_at__gte=active_since) | Q(searches__gt=0))
+            # Only the location and timestamps are read: leave the payload and its rendered bodies
+            .defer('data', 'body', 'body_gzip', 'body_br')
+        )[:options['top']]
+        return [entry for entry in head if entry.updated_at <= due_before]
+
+    def run_cycle(self, limiter, options):
+        due = self.select_due(options)
+        if not due:
+            return 0, 0, 0
+
+        def refresh(entry):
+            limiter.acquire()
+            try:
+                WeatherService.refresh_weather(entry.city, entry.state, entry.country)
+                return True
+            except Exception as e:
+                self.stderr.write(f"Failed to refresh {entry}: {e}")
+                return False
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=options['workers']) as pool:
+            results = list(pool.map(refresh, due))
+        refreshed = sum(results)
+        return len(due), refreshed, len(due) - refreshed
@@ -0,0 +1,97 @@
+import json
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from api.retention import RetentionSweeper, enable_incremental_vacuum, sqlite_auto_vacuum_mode
+
+
+def minutes(value):
+    """
+    timedelta for a --*-minutes option, or None (the sweeper's default from settings) when not given.
+    """
+    return timedelta(minutes=value) if value is not None else None
+
+
+class Command(BaseCommand):
+    help = (
+        "Keep the WeatherCache table bounded: delete long-expired rows in batches, evict the least "
+        "requested rows beyond a row cap, and return free SQLite pages with an incremental vacuum."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retention-minutes', type=float,
+                            help='Keep expired rows this long (default: WEATHER_CACHE_RETENTION_MINUTES, '
+                                 'the stale-if-error window, which serves them).')
+        parser.add_argument('--max-rows', type=int, default=getattr(settings, 'WEATHER_CACHE_MAX_ROWS', 0),
+                            help='Evict the least requested rows beyond this many (0: no cap).')
+        parser.add_argument('--grace-minutes', type=float,
+                            help='Never evict rows written this recently (default: WEATHER_CACHE_EVICTION_GRACE_MINUTES).')
+        parser.add_argument('--hit-half-life-minutes', type=float,
+                            help='Halve every hit_count once per this many minutes '
+                                 '(default: WEATHER_CACHE_HIT_HALF_LIFE_MINUTES; 0: never).')
+        parser.add_argument('--batch-size', type=int, default=getattr(settings, 'WEATHER_RETENTION_BATCH_SIZE', 500),
+                            help='Rows deleted per transaction.')
+        parser.add_argument('--pause', type=float, default=0.0,
+                            help='Seconds to sleep between batches, to leave the write lock to requests.')
+        parser.add_argument('--vacuum-pages', type=int,
+                            default=getattr(settings, 'WEATHER_RETENTION_VACUUM_PAGES', 2000),
+                            help='Free pages returned per sweep (SQLite, auto_vacuum=INCREMENTAL; 0: none).')
+        parser.add_argument('--enable-incremental-vacuum', action='store_true',
+                            help='Switch SQLite to auto_vacuum=INCREMENTAL first (one full VACUUM).')
+        parser.add_argument('--interval', type=float,
+                            default=getattr(settings, 'WEATHER_RETENTION_INTERVAL_SECONDS', 300),
+                            help='Seconds between sweeps.')
+        parser.add_argument('--once', action='store_true', help='Run a single sweep and exit.')
+        parser.add_argument('--json', action='store_true', help='Print each report as JSON.')
+
+    def handle(self, *args, **options):
+        if options['enable_incremental_vacuum']:
+            if enable_incremental_vacuum():
+                self.stdout.write("SQLite auto_vacuum is now INCREMENTAL")
+            else:
+                self.stderr.write("Incremental vacuum is only available on SQLite")
+
+        sweeper = RetentionSweeper(
+            retention=minutes(options['retention_minutes']),
+            max_rows=options['max_rows'],
+            eviction_grace=minutes(options['grace_minutes']),
+            batch_size=options['batch_size'],
+            vacuum_pages=options['vacuum_pages'],
+            pause=options['pause'],
+            hit_half_life=minutes(options['hit_half_life_minutes']),
+            interval=options['interval'],
+        )
+        vacuum_warned = False
+        while True:
+            started = time.monotonic()
+            report = sweeper.sweep()
+            self.stdout.write(json.dumps(report) if options['json'] else self.describe(report))
+            vacuum = report['vacuum']
+            if vacuum and vacuum['mode'] != 'incremental' and not vacuum_warned:
+                vacuum_warned = True
+                self.stderr.write(
+                    f"SQLite auto_vacuum is {sqlite_auto_vacuum_mode()}: freed pages are reused but the file "
+                    f"never shrinks. Run once with --enable-incremental-vacuum to reclaim them."
+                )
+            if options['once']:
+                return
+            time.sleep(max(0, options['interval'] - (time.monotonic() - started)))
+
+    def describe(self, report):
+        line = (
+            f"[{timezone.now():%Y-%m-%d %H:%M:%S}] {report['expired']} expired, {report['evicted']} evicted "
+            f"({report['history_unlinked']} history rows unlinked), {report['rows']} rows left"
+        )
+        if report['decayed']:
+            line += f", hit counts of {report['decayed']} rows halved"
+        vacuum = report['vacuum']
+        if vacuum:
+            line += (
+                f", {vacuum['reclaimed_bytes'] / 1e6:.1f} MB reclaimed, {vacuum['free_bytes'] / 1e6:.1f} MB free "
+                f"of {vacuum['file_bytes'] / 1e6:.1f} MB"
+            )
+        return f"{line} in {report['seconds']:.1f}s"
@@ -0,0 +1,304 @@
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+
+from django.conf import settings
+
+# Seconds: from a local cache hit (well under a millisecond) to a slow upstream call with retries
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+
+def metrics_enabled():
+    return getattr(settings, 'WEATHER_METRICS_ENABLED', True)
+
+
+def _format_labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    Monotonic count per label combination. Exposed as `<name>_total`.
+    """
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def clear(self):
+        with self._lock:
+            self._values = {}
+
+    def render(self):
+        with self._lock:
+            values = list(self._values.items())
+        for labelvalues, value in sorted(values):
+            yield f"{self.name}_total{_format_labels(self.labelnames, labelvalues)} {_format_value(value)}"
+
+
+class Histogram:
+    """
+    Distribution of observed values per label combination, in fixed buckets.
+
+    An observation is a bisect plus two updates under the lock; buckets are only made cumulative
+    when rendered.
+    """
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labelvalues)
+            if state is None:
+                # [per-bucket counts (the last one is +Inf), sum]
+                state = self._values[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def clear(self):
+        with self._lock:
+            self._values = {}
+
+    def render(self):
+        with self._lock:
+            values = [(labelvalues, list(counts), total) for labelvalues, (counts, total) in self._values.items()]
+        for labelvalues, counts, total in sorted(values):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = f'le="{_format_value(float(bound))}"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, labelvalues, le)} {cumulative}"
+            labels = _format_labels(self.labelnames, labelvalues)
+            yield f"{self.name}_sum{labels} {_format_value(total)}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class MetricsRegistry:
+    """
+    The metrics of this process, rendered in the Prometheus text exposition format.
+
+    Besides Counters and Histograms updated on the hot path, collectors are called at scrape time
+    to export counters the app already keeps (cache tiers, upstream quota, history writer), so
+    those cost nothing extra per request. A collector returns an iterable of
+    (name, type, documentation, labelnames, [(labelvalues, value), ...]).
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._add(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, documentation, labelnames, buckets))
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector):
+        self._collectors.append(collector)
+        return collector
+
+    def clear(self):
+        for metric in self._metrics:
+            metric.clear()
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            for name, metric_type, documentation, labelnames, samples in collector():
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                sample_name = f"{name}_total" if metric_type == 'counter' else name
+                for labelvalues, value in samples:
+                    lines.append(f"{sample_name}{_format_labels(labelnames, labelvalues)} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+http_request_seconds = registry.histogram(
+    'http_request_duration_seconds', 'Request latency by route.', ('method', 'route', 'status'),
+)
+db_queries_per_request = registry.histogram(
+    'django_db_queries_per_request', 'Database queries run by one request.', ('route',),
+    buckets=QUERY_COUNT_BUCKETS,
+)
+db_query_seconds = registry.counter(
+    'django_db_query_seconds', 'Time spent in database queries by route.', ('route',),
+)
+upstream_request_seconds = registry.histogram(
+    'weather_upstream_request_duration_seconds', 'OpenWeatherMap calls (each retry counts) by response status.',
+    ('status',),
+)
+throttled_requests = registry.counter(
+    'weather_throttled_requests', 'Requests rejected by a throttle, by scope.', ('scope',),
+)
+
+
+class QueryTimer:
+    """
+    Number and total time of the database queries run by one request.
+    """
+    __slots__ = ('count', 'seconds')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+
+# The current request's QueryTimer. A context variable, so queries that async views run in
+# worker threads (sync_to_async copies the context) are counted too.
+current_query_timer = ContextVar('current_query_timer', default=None)
+
+
+def time_query(execute, sql, params, many, context):
+    """
+    Execute wrapper installed on every connection once (install_query_timer). Entering
+    connection.execute_wrapper() per request costs more than the whole rest of the instrumentation.
+    """
+    timer = current_query_timer.get()
+    if timer is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timer.count += 1
+        timer.seconds += time.perf_counter() - started
+
+
+def install_query_timer(sender, connection, **kwargs):
+    """
+    connection_created receiver.
+    """
+    if time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(time_query)
+
+
+@registry.register_collector
+def collect_weather_cache():
+    from .cache import get_weather_cache
+
+    stats = get_weather_cache().stats()
+    tiers = [(name, counts) for name, counts in stats.items() if isinstance(counts, dict) and 'hits' in counts
+             and name != 'negative']
+    negative = stats.get('negative', {})
+    return [
+        ('weather_cache_hits', 'counter', 'Weather cache lookups answered by each tier.', ('tier',),
+         [((name,), counts['hits']) for name, counts in tiers]),
+        ('weather_cache_misses', 'counter', 'Weather cache lookups each tier could not answer.', ('tier',),
+         [((name,), counts['misses']) for name, counts in tiers]),
+        ('weather_cache_entries', 'gauge', 'Entries held by size-bounded tiers.', ('tier',),
+         [((name,), counts['size']) for name, counts in tiers if 'size' in counts]),
+        ('weather_cache_stale_served', 'counter', 'Expired entries served, by X-Cache-Status.', ('status',),
+         [((status,), count) for status, count in sorted(stats.get('stale_served', {}).items())]),
+        ('weather_negative_cache_lookups', 'counter', 'Negative cache lookups by result.', ('result',),
+         [(('hit',), negative.get('hits', 0)), (('miss',), negative.get('misses', 0))]),
+    ]
+
+
+@registry.register_collector
+def collect_upstream_quota():
+    from .quota import get_upstream_quota
+
+    stats = get_upstream_quota().stats()
+    windows = stats.get('windows', {})
+    return [
+        ('weather_upstream_quota_used', 'gauge', 'Upstream calls counted in the current window.', ('window',),
+         [((name,), window.get('used', 0)) for name, window in sorted(windows.items())]),
+        ('weather_upstream_quota_limit', 'gauge', 'Upstream calls allowed per window.', ('window',),
+         [((name,), window.get('limit', 0)) for name, window in sorted(windows.items())]),
+        ('weather_upstream_quota_calls', 'counter', 'Upstream call admissions by priority and outcome.',
+         ('priority', 'outcome'),
+         [((priority, outcome), count) for priority, counts in sorted(stats.get('calls', {}).items())
+          for outcome, count in sorted(counts.items())]),
+    ]
+
+
+@registry.register_collector
+def collect_history_writer():
+    from .history import history_writer
+
+    stats = history_writer.stats()
+    return [
+        ('weather_history_records', 'counter', 'Search history records by outcome.', ('outcome',),
+         [((name,), stats[name]) for name in ('written', 'failed', 'dropped') if name in stats]),
+        ('weather_history_queue_depth', 'gauge', 'Search history records waiting to be written.', (),
+         [((), history_writer.pending())]),
+    ]
+
+
+@registry.register_collector
+def collect_circuit_breaker():
+    from .clients import CircuitBreaker, get_weather_client
+
+    state = get_weather_client().breaker.state
+    return [
+        ('weather_upstream_circuit_state', 'gauge', 'Upstream circuit breaker state (1 for the current one).',
+         ('state',),
+         [((name,), int(name == state)) for name in (CircuitBreaker.CLOSED, CircuitBreaker.OPEN,
+                                                     CircuitBreaker.HALF_OPEN)]),
+    ]
+
+
+@registry.register_collector
+def collect_log_queue():
+    from core.logs import queue_handler_stats
+
+    stats = sorted(queue_handler_stats().items())
+    return [
+        ('weather_log_queue_depth', 'gauge', 'Log records waiting for the listener thread.', ('handler',),
+         [((name,), counts['pending']) for name, counts in stats]),
+        ('weather_log_records_dropped', 'counter', 'Log records dropped because the queue was full.', ('handler',),
+         [((name,), counts['dropped']) for name, counts in stats]),
+    ]
+
+
+@registry.register_collector
+def collect_auth_status_cache():
+    from .authentication import user_status_cache
+
+    return [
+        ('weather_auth_status_lookups', 'counter', 'Token user status lookups by result (a miss is a query).',
+         ('result',), [(('hit',), user_status_cache.hits), (('miss',), user_status_cache.misses)]),
+    ]
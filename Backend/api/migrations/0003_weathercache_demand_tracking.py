@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0002_remove_weathercache_city_country_idx_and_more"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="weathercache",
+            name="hit_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="weathercache",
+            name="last_accessed_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,68 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:02
+
+from django.db import migrations, models
+
+
+def build_lookup_key(city_name, state_name, country):
+    # Frozen copy of api.models.build_lookup_key
+    return "|".join(
+        (part or "").strip().upper() for part in (city_name, state_name, country)
+    )
+
+
+def backfill_lookup_keys(apps, schema_editor):
+    """
+    Compute lookup_key for existing rows. Rows that collapse onto the same key (e.g. the
+    duplicates a NULL state let through the old unique_together) keep only the freshest one.
+    """
+    WeatherCache = apps.get_model("api", "WeatherCache")
+    seen = set()
+    duplicates = []
+    batch = []
+    rows = WeatherCache.objects.order_by("-updated_at", "-id").only(
+        "id", "city", "state", "country"
+    )
+    for row in rows.iterator(chunk_size=2000):
+        key = build_lookup_key(row.city, row.state, row.country)
+        if key in seen:
+            duplicates.append(row.id)
+            continue
+        seen.add(key)
+        row.lookup_key = key
+        batch.append(row)
+        if len(batch) >= 2000:
+            WeatherCache.objects.bulk_update(batch, ["lookup_key"])
+            batch = []
+    if batch:
+        WeatherCache.objects.bulk_update(batch, ["lookup_key"])
+    for start in range(0, len(duplicates), 500):
+        WeatherCache.objects.filter(id__in=duplicates[start : start + 500]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0003_weathercache_demand_tracking"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="weathercache",
+            name="lookup_key",
+            field=models.CharField(editable=False, max_length=303, null=True),
+        ),
+        migrations.RunPython(backfill_lookup_keys, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name="weathercache",
+            name="lookup_key",
+            field=models.CharField(editable=False, max_length=303, unique=True),
+        ),
+        migrations.RemoveIndex(
+            model_name="weathercache",
+            name="city_country_idx",
+        ),
+        migrations.AlterUniqueTogether(
+            name="weathercache",
+            unique_together=set(),
+        ),
+    ]
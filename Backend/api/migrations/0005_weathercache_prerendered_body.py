@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0004_weathercache_lookup_key"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="weathercache",
+            name="body",
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="weathercache",
+            name="body_br",
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="weathercache",
+            name="body_gzip",
+            field=models.BinaryField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,123 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:17
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def history_snapshot(data):
+    # Frozen copy of api.models.history_snapshot
+    if not data:
+        return {}
+    snapshot = {key: data[key] for key in ("name", "dt", "cod") if key in data}
+    if data.get("sys", {}).get("country"):
+        snapshot["sys"] = {"country": data["sys"]["country"]}
+    main = {
+        key: value
+        for key, value in data.get("main", {}).items()
+        if key in ("temp", "feels_like", "humidity")
+    }
+    if main:
+        snapshot["main"] = main
+    if data.get("weather"):
+        condition = data["weather"][0]
+        snapshot["weather"] = [
+            {
+                key: condition[key]
+                for key in ("main", "description", "icon")
+                if key in condition
+            }
+        ]
+    return snapshot
+
+
+def link_history_to_cache(apps, schema_editor):
+    """
+    Point each search at the WeatherCache entry for the city it returned (the payload's canonical
+    name and country, else the queried name) and keep only a snapshot of its payload.
+    """
+    WeatherCache = apps.get_model("api", "WeatherCache")
+    SearchHistory = apps.get_model("api", "SearchHistory")
+
+    by_city_country = {}
+    by_city = {}
+    # Oldest first, so the most recently refreshed entry wins for each key
+    for pk, city, country in WeatherCache.objects.order_by("updated_at").values_list(
+        "pk", "city", "country"
+    ):
+        by_city_country[(city.upper(), country.upper())] = pk
+        by_city[city.upper()] = pk
+
+    batch = []
+    for row in SearchHistory.objects.order_by("pk").iterator(chunk_size=2000):
+        data = row.response_data or {}
+        name = str(data.get("name", "")).upper()
+        country = str(data.get("sys", {}).get("country", "")).upper()
+        row.weather_id = (
+            by_city_country.get((name, country))
+            or by_city.get(name)
+            or by_city.get(row.city_name_queried.upper())
+        )
+        row.snapshot = history_snapshot(data)
+        batch.append(row)
+        if len(batch) >= 2000:
+            SearchHistory.objects.bulk_update(batch, ["weather", "snapshot"])
+            batch = []
+    if batch:
+        SearchHistory.objects.bulk_update(batch, ["weather", "snapshot"])
+
+
+def restore_response_data(apps, schema_editor):
+    SearchHistory = apps.get_model("api", "SearchHistory")
+    batch = []
+    for row in (
+        SearchHistory.objects.select_related("weather")
+        .order_by("pk")
+        .iterator(chunk_size=2000)
+    ):
+        row.response_data = row.weather.data if row.weather_id else row.snapshot
+        batch.append(row)
+        if len(batch) >= 2000:
+            SearchHistory.objects.bulk_update(batch, ["response_data"])
+            batch = []
+    if batch:
+        SearchHistory.objects.bulk_update(batch, ["response_data"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0005_weathercache_prerendered_body"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="searchhistory",
+            name="snapshot",
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name="searchhistory",
+            name="weather",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="search_history",
+                to="api.weathercache",
+            ),
+        ),
+        # Nullable first, so that the migration can be reversed on a populated table
+        migrations.AlterField(
+            model_name="searchhistory",
+            name="response_data",
+            field=models.JSONField(
+                help_text="The weather data returned to the user for this search.",
+                null=True,
+            ),
+        ),
+        migrations.RunPython(link_history_to_cache, restore_response_data),
+        migrations.RemoveField(
+            model_name="searchhistory",
+            name="response_data",
+        ),
+    ]
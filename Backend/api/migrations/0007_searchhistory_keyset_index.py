@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0006_searchhistory_weather_reference"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="searchhistory",
+            index=models.Index(
+                fields=["user", "-timestamp", "-id"], name="history_user_recent_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:27
+
+from django.db import migrations, models
+
+
+def payload_coordinates(data):
+    # Frozen copy of api.models.payload_coordinates
+    coord = (data or {}).get("coord") or {}
+    try:
+        return float(coord["lat"]), float(coord["lon"])
+    except (KeyError, TypeError, ValueError):
+        return None, None
+
+
+def backfill_coordinates(apps, schema_editor):
+    """
+    Copy each existing payload's coord into lat/lon.
+    """
+    WeatherCache = apps.get_model("api", "WeatherCache")
+    batch = []
+    for row in WeatherCache.objects.only("id", "data").iterator(chunk_size=2000):
+        row.lat, row.lon = payload_coordinates(row.data)
+        if row.lat is None:
+            continue
+        batch.append(row)
+        if len(batch) >= 2000:
+            WeatherCache.objects.bulk_update(batch, ["lat", "lon"])
+            batch = []
+    if batch:
+        WeatherCache.objects.bulk_update(batch, ["lat", "lon"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0007_searchhistory_keyset_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="weathercache",
+            name="lat",
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name="weathercache",
+            name="lon",
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(backfill_coordinates, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name="weathercache",
+            index=models.Index(fields=["lat", "lon"], name="weather_coord_idx"),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api", "0008_weathercache_coordinates"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="weathercache",
+            index=models.Index(fields=["updated_at"], name="weather_updated_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="weathercache",
+            index=models.Index(
+                fields=["hit_count", "last_accessed_at"], name="weather_eviction_idx"
+            ),
+        ),
+    ]
@@ -1,25 +1,145 @@
 from django.db import models
+from django.db.models.functions import Coalesce
 from django.contrib.auth.models import AbstractUser
 from django.conf import settings
 from django.utils import timezone
 from datetime import timedelta
 
+from .db import retry_on_lock
+from .geo import bounding_box, haversine_km
+
+def build_lookup_key(city_name, state_name, country):
+    """
+    Canonical "CITY|STATE|COUNTRY" key (stripped, upper-cased, empty state for none).
+    Precomputed into WeatherCache.lookup_key so a lookup is a single index seek.
+    """
+    return "|".join(
+        (part or '').strip().upper() for part in (city_name, state_name, country)
+    )
+
+def payload_coordinates(data):
+    """
+    (lat, lon) of a provider payload's `coord`, or (None, None).
+    """
+    coord = (data or {}).get('coord') or {}
+    try:
+        return float(coord['lat']), float(coord['lon'])
+    except (KeyError, TypeError, ValueError):
+        return None, None
+
+def history_snapshot(data):
+    """
+    The few fields of a provider payload worth keeping per search, in the payload's own shape
+    (served as a search's response_data once its WeatherCache entry is gone).
+    """
+    if not data:
+        return {}
+    snapshot = {key: data[key] for key in ('name', 'dt', 'cod') if key in data}
+    if data.get('sys', {}).get('country'):
+        snapshot['sys'] = {'country': data['sys']['country']}
+    main = {key: value for key, value in data.get('main', {}).items() if key in ('temp', 'feels_like', 'humidity')}
+    if main:
+        snapshot['main'] = main
+    if data.get('weather'):
+        condition = data['weather'][0]
+        snapshot['weather'] = [{key: condition[key] for key in ('main', 'description', 'icon') if key in condition}]
+    return snapshot
+
 # --- Manager for Efficient Querying ---
 
 class WeatherCacheManager(models.Manager):
-    def get_valid_cache(self, city_name, state_name, country):
+    def _lookup(self, city_name, state_name, country):
+        return self.filter(lookup_key=build_lookup_key(city_name, state_name, country))
+
+    def _valid_cache_query(self, city_name, state_name, country, grace=None):
+        threshold = getattr(settings, 'WEATHER_CACHE_MINUTES', 60)
+        expiry_limit = timezone.now() - timedelta(minutes=threshold)
+        if grace:
+            expiry_limit -= grace
+        return self._lookup(city_name, state_name, country).filter(updated_at__gte=expiry_limit)
+
+    def get_valid_cache(self, city_name, state_name, country, grace=None):
         """
         Custom manager method to find a valid (unexpired) cache entry.
+        `grace` (timedelta) also accepts entries expired for at most that long.
         """
+        return self._valid_cache_query(city_name, state_name, country, grace).first()
+
+    def get_valid_version(self, city_name, state_name, country):
+        """
+        (updated_at, city, state, country) of the valid entry, or None - without loading
+        (or decoding) its payload.
+        """
+        return self._valid_cache_query(city_name, state_name, country).values_list(
+            'updated_at', 'city', 'state', 'country',
+        ).first()
+
+    def get_valid_cache_many(self, keys):
+        """
+        Valid cache entries for many (city, state, country) keys in a single query.
+        Returns {key: WeatherCache} for the keys that have a fresh entry.
+        """
+        if not keys:
+            return {}
         threshold = getattr(settings, 'WEATHER_CACHE_MINUTES', 60)
         expiry_limit = timezone.now() - timedelta(minutes=threshold)
-        
-        query = self.filter(city__iexact=city_name, updated_at__gte=expiry_limit)
-        if state_name:
-            query = query.filter(state__iexact=state_name)
-        if country:
-            query = query.filter(country__iexact=country)  
-        return query.first()
+
+        keys_by_lookup = {build_lookup_key(*key): key for key in keys}
+        rows = self.filter(lookup_key__in=list(keys_by_lookup), updated_at__gte=expiry_limit)
+        return {keys_by_lookup[row.lookup_key]: row for row in rows}
+
+    @retry_on_lock
+    def record_hits(self, city_name, state_name, country, count, accessed_at):
+        """
+        Add `count` requests to the demand counter of the matching entries.
+        """
+        return self._lookup(city_name, state_name, country).update(
+            hit_count=models.F('hit_count') + count,
+            last_accessed_at=accessed_at,
+        )
+
+    def ranked_by_demand(self, history_weight=1):
+        """
+        Entries annotated with `searches` (SearchHistory rows linked to the entry, whatever
+        spelling was searched) and `demand` (hit_count + history_weight * searches), most demanded first.
+        """
+        searches = SearchHistory.objects.filter(
+            weather=models.OuterRef('pk')
+        ).values('weather').annotate(total=models.Count('id')).values('total')
+        return self.annotate(
+            searches=Coalesce(models.Subquery(searches), 0),
+        ).annotate(
+            demand=models.F('hit_count') + history_weight * models.F('searches'),
+        ).order_by('-demand', 'updated_at')
+
+    def nearest_valid(self, lat, lon, radius_km, grace=None):
+        """
+        (city, state, country) of the closest valid entry within `radius_km` of (lat, lon), or None.
+        A bounding-box range scan on the (lat, lon) index picks the candidates; the exact
+        great-circle distance then filters and ranks them. Payloads are not read.
+        """
+        threshold = getattr(settings, 'WEATHER_CACHE_MINUTES', 60)
+        expiry_limit = timezone.now() - timedelta(minutes=threshold)
+        if grace:
+            expiry_limit -= grace
+
+        lat_range, lon_ranges = bounding_box(lat, lon, radius_km)
+        in_lon = models.Q()
+        for lon_range in lon_ranges:
+            in_lon |= models.Q(lon__range=lon_range)
+        candidates = self.filter(in_lon, lat__range=lat_range, updated_at__gte=expiry_limit).values_list(
+            'city', 'state', 'country', 'lat', 'lon',
+        )
+
+        nearest, nearest_distance = None, radius_km
+        for city, state, country, entry_lat, entry_lon in candidates:
+            distance = haversine_km(lat, lon, entry_lat, entry_lon)
+            if distance <= nearest_distance:
+                nearest, nearest_distance = (city, state, country), distance
+        return nearest
+
+    async def aget_valid_cache(self, city_name, state_name, country, grace=None):
+        return await self._valid_cache_query(city_name, state_name, country, grace).afirst()
 
 # --- Models ---
 
@@ -41,22 +161,42 @@ class WeatherCache(models.Model):
     city = models.CharField(max_length=100)
     state = models.CharField(max_length=100, blank=True, null=True)
     country = models.CharField(max_length=100)
+    # Normalized CITY|STATE|COUNTRY, maintained in save(); every lookup goes through it
+    lookup_key = models.CharField(max_length=303, unique=True, editable=False)
     data = models.JSONField(help_text="Full payload from provider")
+    # Payload `coord`, maintained in save(); indexed for coordinate lookups (nearest_valid)
+    lat = models.FloatField(blank=True, null=True, editable=False)
+    lon = models.FloatField(blank=True, null=True, editable=False)
+    # `data` pre-rendered as the API response, plus compressed variants (WEATHER_CACHE_PRERENDER)
+    body = models.BinaryField(blank=True, null=True)
+    body_gzip = models.BinaryField(blank=True, null=True)
+    body_br = models.BinaryField(blank=True, null=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Demand tracking (flushed in batches by api.demand.DemandTracker)
+    hit_count = models.PositiveIntegerField(default=0)
+    last_accessed_at = models.DateTimeField(blank=True, null=True)
 
     objects = WeatherCacheManager()
 
     class Meta:
-        # Composite Index: Most searches will be City + Country
+        # No composite (city, state, country) index: lookups go through lookup_key, whose
+        # unique index also prevents duplicate rows (including NULL states, which
+        # unique_together let through).
         indexes = [
-            models.Index(fields=['city', 'state', 'country'], name='city_country_idx'),
+            models.Index(fields=['lat', 'lon'], name='weather_coord_idx'),
+            # Retention sweeps (api.retention): expiry order, and eviction order by demand
+            models.Index(fields=['updated_at'], name='weather_updated_idx'),
+            models.Index(fields=['hit_count', 'last_accessed_at'], name='weather_eviction_idx'),
         ]
-        # Prevents duplicate rows for the same city/country
-        unique_together = ('city', 'state', 'country')
         verbose_name = "Weather Cache"  
         verbose_name_plural = "Weather Cache"
 
 
+    def save(self, *args, **kwargs):
+        self.lookup_key = build_lookup_key(self.city, self.state, self.country)
+        self.lat, self.lon = payload_coordinates(self.data)
+        super().save(*args, **kwargs)
+
     @property
     def is_valid(self):
         threshold = getattr(settings, 'WEATHER_CACHE_MINUTES', 60)
@@ -73,7 +213,15 @@ class SearchHistory(models.Model):
         related_name='search_history'
     )
     # Linked to cache so we don't duplicate JSON data in two tables
-    response_data = models.JSONField(help_text="The weather data returned to the user for this search.")
+    weather = models.ForeignKey(
+        WeatherCache,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='search_history',
+    )
+    # Key fields at search time (see history_snapshot); served when the cache entry is gone
+    snapshot = models.JSONField(default=dict, blank=True)
     # Keep city name here as a backup in case the Cache entry is deleted
     city_name_queried = models.CharField(max_length=100)
     timestamp = models.DateTimeField(auto_now=True) # Updates time if user searches same city again
@@ -82,6 +230,19 @@ class SearchHistory(models.Model):
         ordering = ['-timestamp']
         # Ensures a user doesn't have 100 identical rows for the same city
         unique_together = ('user', 'city_name_queried')
+        # Keyset pagination of a user's history: (user, timestamp, id) seeks straight to any page
+        indexes = [
+            models.Index(fields=['user', '-timestamp', '-id'], name='history_user_recent_idx'),
+        ]
+
+    @property
+    def response_data(self):
+        """
+        The weather data for this search: the cache entry's payload, or the snapshot if it was deleted.
+        """
+        if self.weather_id is not None:
+            return self.weather.data
+        return self.snapshot
 
     def __str__(self):
         return f"{self.user.username} -> {self.city_name_queried}"
\ No newline at end of file
@@ -0,0 +1,125 @@
+import base64
+import binascii
+import json
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetCursorPagination(BasePagination):
+    """
+    Keyset (seek) pagination over the unique (timestamp, id) key, newest first.
+
+    A page is a single index range scan of `page_size + 1` rows starting right after the cursor
+    position, so it costs the same on page 1 and page 1000 (unlike OFFSET, or DRF's
+    CursorPagination, which seeks on one column and then offsets through ties).
+    Cursors are opaque tokens of (direction, timestamp, id); the response shape matches DRF's
+    cursor pagination: {"next": url, "previous": url, "results": [...]}.
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def get_page_size(self, request):
+        default = getattr(settings, 'WEATHER_HISTORY_PAGE_SIZE', 50)
+        maximum = getattr(settings, 'WEATHER_HISTORY_MAX_PAGE_SIZE', 1000)
+        try:
+            requested = int(request.query_params.get(self.page_size_query_param, default))
+        except (TypeError, ValueError):
+            return default
+        return max(1, min(requested, maximum))
+
+    def decode_cursor(self, request):
+        """
+        (reverse, timestamp, id) from the request, or None on the first page.
+        """
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            reverse, timestamp, pk = json.loads(base64.urlsafe_b64decode(encoded.encode('ascii')))
+            timestamp = parse_datetime(timestamp)
+            if timestamp is None:
+                raise ValueError
+            return bool(reverse), timestamp, int(pk)
+        except (TypeError, ValueError, UnicodeEncodeError, binascii.Error):
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, reverse, row):
+        token = json.dumps([int(reverse), row.timestamp.isoformat(), row.pk], separators=(',', ':'))
+        encoded = base64.urlsafe_b64encode(token.encode('ascii')).decode('ascii')
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def page_queryset(self, queryset, request):
+        """
+        The rows of the requested page plus one lookahead row, as a sliced queryset.
+        `timestamp <= t` bounds the index range; the OR only breaks ties on id.
+        """
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.page_size = self.get_page_size(request)
+        self.cursor = self.decode_cursor(request)
+
+        if self.cursor is None:
+            return queryset.order_by('-timestamp', '-id')[:self.page_size + 1]
+        reverse, timestamp, pk = self.cursor
+        if reverse:
+            queryset = queryset.filter(
+                Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=pk), timestamp__gte=timestamp,
+            ).order_by('timestamp', 'id')
+        else:
+            queryset = queryset.filter(
+                Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=pk), timestamp__lte=timestamp,
+            ).order_by('-timestamp', '-id')
+        return queryset[:self.page_size + 1]
+
+    def paginate_rows(self, rows):
+        """
+        Trim the lookahead row off the fetched rows (newest first) and work out the next/previous links.
+        """
+        rows = list(rows)
+        has_more = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        reverse = self.cursor is not None and self.cursor[0]
+        if reverse:
+            # Fetched oldest first; there is a next page (the one we came from) by construction
+            rows.reverse()
+            has_next, has_previous = True, has_more
+        else:
+            has_next, has_previous = has_more, self.cursor is not None
+
+        self.next_link = self.encode_cursor(False, rows[-1]) if has_next and rows else None
+        self.previous_link = self.encode_cursor(True, rows[0]) if has_previous and rows else None
+        return rows
+
+    def paginate_queryset(self, queryset, request, view=None):
+        return self.paginate_rows(self.page_queryset(queryset, request))
+
+    def get_next_link(self):
+        return self.next_link
+
+    def get_previous_link(self):
+        return self.previous_link
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.next_link,
+            'previous': self.previous_link,
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
@@ -0,0 +1,158 @@
+"""
+Per-request profiles for ProfilingMiddleware (core/middleware.py): cProfile stats, every SQL
+query and every upstream call of one request, reported as a Server-Timing header and a report
+file in WEATHER_PROFILING_DIR.
+
+Nothing here runs unless WEATHER_PROFILING_ENABLED is on: the middleware is not installed and
+the query capture wrapper is not added to connections. The upstream client's hook is a single
+context variable lookup per upstream attempt.
+"""
+import cProfile
+import io
+import json
+import os
+import pstats
+import time
+from contextvars import ContextVar
+from datetime import datetime, timezone
+
+from django.conf import settings
+
+# The RequestProfile of the request being profiled, if any. A context variable, so queries and
+# upstream calls made from sync_to_async worker threads are captured too.
+current_profile = ContextVar('current_profile', default=None)
+
+
+def profiling_enabled():
+    return getattr(settings, 'WEATHER_PROFILING_ENABLED', False)
+
+
+class RequestProfile:
+    """
+    What one profiled request spent its time on. Call start() and stop() around the request;
+    cProfile is only used on the sync path (on an event loop it would mix in other requests).
+    """
+
+    def __init__(self, use_cprofile=True):
+        self.profiler = cProfile.Profile() if use_cprofile else None
+        self.queries = []
+        self.upstream = []
+        self.started = None
+        self.seconds = None
+
+    def start(self):
+        self.started = time.perf_counter()
+        if self.profiler is not None:
+            try:
+                self.profiler.enable()
+            except ValueError:
+                # Another profiler (a debugger, or a profiled request on this thread) is active
+                self.profiler = None
+
+    def stop(self):
+        if self.profiler is not None:
+            self.profiler.disable()
+        self.seconds = time.perf_counter() - self.started
+
+    def add_query(self, sql, seconds, many):
+        self.queries.append({'sql': sql, 'ms': round(seconds * 1000, 3), 'many': many})
+
+    def add_upstream(self, status, seconds):
+        self.upstream.append({'status': status, 'ms': round(seconds * 1000, 3)})
+
+    @property
+    def db_ms(self):
+        return sum(query['ms'] for query in self.queries)
+
+    @property
+    def upstream_ms(self):
+        return sum(call['ms'] for call in self.upstream)
+
+    def server_timing(self):
+        """
+        Server-Timing header value: database, upstream, the rest of the app, and the total.
+        """
+        total = self.seconds * 1000
+        db, upstream = self.db_ms, self.upstream_ms
+        return ', '.join([
+            f'db;dur={db:.2f};desc="{len(self.queries)} queries"',
+            f'upstream;dur={upstream:.2f};desc="{len(self.upstream)} calls"',
+            f'app;dur={max(total - db - upstream, 0):.2f}',
+            f'total;dur={total:.2f}',
+        ])
+
+    def top_functions(self, limit):
+        if self.profiler is None:
+            return None
+        out = io.StringIO()
+        pstats.Stats(self.profiler, stream=out).sort_stats('cumulative').print_stats(limit)
+        return out.getvalue()
+
+    def report(self, request, response, request_id, limit):
+        return {
+            'time': datetime.now(timezone.utc).isoformat(timespec='milliseconds'),
+            'request_id': request_id,
+            'method': request.method,
+            'path': request.get_full_path(),
+            'status': response.status_code,
+            'total_ms': round(self.seconds * 1000, 3),
+            'db': {'count': len(self.queries), 'ms': round(self.db_ms, 3), 'queries': self.queries},
+            'upstream': {'count': len(self.upstream), 'ms': round(self.upstream_ms, 3), 'calls': self.upstream},
+            'profile': self.top_functions(limit),
+        }
+
+
+def capture_query(execute, sql, params, many, context):
+    """
+    Execute wrapper added to every connection by install_query_capture.
+    """
+    profile = current_profile.get()
+    if profile is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        profile.add_query(sql, time.perf_counter() - started, many)
+
+
+def install_query_capture(sender, connection, **kwargs):
+    """
+    connection_created receiver (connected only when profiling is enabled).
+    """
+    if capture_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(capture_query)
+
+
+def record_upstream(status, seconds):
+    profile = current_profile.get()
+    if profile is not None:
+        profile.add_upstream(status, seconds)
+
+
+def save_report(report, profiler=None, directory=None, keep=None):
+    """
+    Write `report` as <time>-<request id>.json (and the raw cProfile stats as .prof, for
+    snakeviz or pstats) to `directory`, then delete the oldest reports beyond `keep`.
+    Returns the report's base name.
+    """
+    directory = directory or settings.WEATHER_PROFILING_DIR
+    keep = keep if keep is not None else getattr(settings, 'WEATHER_PROFILING_KEEP', 100)
+    os.makedirs(directory, exist_ok=True)
+    stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%f')
+    name = f"{stamp}-{(report['request_id'] or 'request').replace(':', '-')}"
+    with open(os.path.join(directory, f'{name}.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+    if profiler is not None:
+        profiler.dump_stats(os.path.join(directory, f'{name}.prof'))
+
+    # Names start with the UTC time, so they sort oldest first
+    reports = sorted(entry for entry in os.listdir(directory) if entry.endswith('.json'))
+    for old in reports[:max(len(reports) - keep, 0)]:
+        base = old[:-len('.json')]
+        for suffix in ('.json', '.prof'):
+            try:
+                os.remove(os.path.join(directory, base + suffix))
+            except FileNotFoundError:
+                pass
+    return name
@@ -0,0 +1,246 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import requests
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = 'interactive'
+BACKGROUND = 'background'
+
+
+class UpstreamQuotaExceeded(requests.exceptions.RequestException):
+    """
+    Raised without calling upstream when the provider's call budget is used up.
+    Carries no response, so callers treat it as a provider failure (stale-if-error applies).
+    """
+
+    def __init__(self, *args, retry_after=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.retry_after = retry_after
+
+
+class UpstreamQuotaGovernor:
+    """
+    Admits upstream calls against the provider's plan limits, shared by every worker on the host.
+
+    Each limit is a fixed window (calls per minute, calls per UTC day) counted in a small SQLite
+    file, like the throttle buckets. Admission checks and counts every window in one IMMEDIATE
+    transaction, so workers cannot overshoot together.
+
+    Priorities: INTERACTIVE calls (a user is waiting) may use the whole budget and wait up to
+    `wait_seconds` for the next window; BACKGROUND calls (stale refreshes, prefetching) may only
+    use `background_share` of each window and never wait, so they cannot starve users.
+    Every attempt counts, retries included: the provider counts them too.
+    """
+
+    def __init__(self, path, limits, background_share=0.5, wait_seconds=2.0):
+        self.path = str(path)
+        # window name -> (period in seconds, calls allowed per period); falsy limits are skipped
+        self.limits = {name: (period, limit) for name, (period, limit) in limits.items() if limit}
+        self.background_share = background_share
+        self.wait_seconds = wait_seconds
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self._stats = {priority: {'admitted': 0, 'waited': 0, 'rejected': 0} for priority in (INTERACTIVE, BACKGROUND)}
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=1.0, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS upstream_quota ('
+                'name TEXT PRIMARY KEY, started REAL NOT NULL, used INTEGER NOT NULL) WITHOUT ROWID'
+            )
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _windows(self, now):
+        # window name -> (period, limit, start of the current window)
+        return {name: (period, limit, now - now % period) for name, (period, limit) in self.limits.items()}
+
+    def _used(self, conn, now):
+        # Calls counted so far in each current window (rows of past windows count as 0)
+        windows = self._windows(now)
+        return {
+            window: used
+            for window, started, used in conn.execute('SELECT name, started, used FROM upstream_quota')
+            if window in windows and windows[window][2] == started
+        }
+
+    def allowance(self, priority, limit):
+        if priority == BACKGROUND:
+            return int(limit * self.background_share)
+        return limit
+
+    def try_acquire(self, priority=INTERACTIVE):
+        """
+        Count one upstream call if every window has room for `priority`.
+        Returns (admitted, seconds until the blocking window resets).
+        """
+        if not self.limits:
+            return True, 0.0
+        now = time.time()
+        try:
+            conn = self._connection()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                used = self._used(conn, now)
+                blocking = [
+                    started + period - now
+                    for window, (period, limit, started) in self._windows(now).items()
+                    if used.get(window, 0) >= self.allowance(priority, limit)
+                ]
+                if blocking:
+                    conn.execute('ROLLBACK')
+                    return False, max(blocking)
+                for window, (period, limit, started) in self._windows(now).items():
+                    conn.execute(
+                        'INSERT INTO upstream_quota (name, started, used) VALUES (?, ?, 1) '
+                        'ON CONFLICT (name) DO UPDATE SET '
+                        'used = CASE WHEN started = excluded.started THEN used + 1 ELSE 1 END, '
+                        'started = excluded.started',
+                        (window, started),
+                    )
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+        except sqlite3.Error as e:
+            # Better to risk the provider's 429 than to fail every request on a local file
+            logger.warning(f"Upstream quota store unavailable, admitting call: {e}")
+        return True, 0.0
+
+    async def atry_acquire(self, priority=INTERACTIVE):
+        """
+        try_acquire for the event loop: the SQLite transaction (which may wait up to a second for
+        the file lock) runs on a worker thread.
+        """
+        if not self.limits:
+            return True, 0.0
+        return await sync_to_async(self.try_acquire, thread_sensitive=False)(priority)
+
+    def _wait_for(self, priority, retry_after, waited):
+        if priority != INTERACTIVE or waited + retry_after > self.wait_seconds:
+            return None
+        # Poll shortly after the window resets (or sooner: a concurrent worker may give up its place)
+        return min(retry_after + 0.01, 0.25)
+
+    def acquire(self, priority=INTERACTIVE):
+        """
+        Admit one call or raise UpstreamQuotaExceeded. Interactive calls wait briefly for room.
+        """
+        waited = 0.0
+        while True:
+            admitted, retry_after = self.try_acquire(priority)
+            if admitted:
+                self._count(priority, 'waited' if waited else 'admitted')
+                return
+            delay = self._wait_for(priority, retry_after, waited)
+            if delay is None:
+                raise self._rejected(priority, retry_after)
+            time.sleep(delay)
+            waited += delay
+
+    async def aacquire(self, priority=INTERACTIVE):
+        """
+        Async variant of acquire: never blocks the event loop, neither on the store nor while waiting.
+        """
+        waited = 0.0
+        while True:
+            admitted, retry_after = await self.atry_acquire(priority)
+            if admitted:
+                self._count(priority, 'waited' if waited else 'admitted')
+                return
+            delay = self._wait_for(priority, retry_after, waited)
+            if delay is None:
+                raise self._rejected(priority, retry_after)
+            await asyncio.sleep(delay)
+            waited += delay
+
+    def _rejected(self, priority, retry_after):
+        self._count(priority, 'rejected')
+        logger.warning(f"Upstream quota exhausted, {priority} call refused for {retry_after:.1f}s")
+        return UpstreamQuotaExceeded(
+            f"Upstream weather provider call budget exhausted; retry in {retry_after:.0f}s.",
+            retry_after=retry_after,
+        )
+
+    def _count(self, priority, outcome):
+        with self._stats_lock:
+            self._stats[priority][outcome] += 1
+
+    def usage(self):
+        """
+        Current consumption of each window, as counted by all workers.
+        """
+        now = time.time()
+        try:
+            used = self._used(self._connection(), now)
+        except sqlite3.Error as e:
+            logger.warning(f"Upstream quota store unavailable: {e}")
+            used = {}
+        windows = {}
+        for window, (period, limit, started) in self._windows(now).items():
+            count = used.get(window, 0)
+            windows[window] = {
+                'used': count,
+                'limit': limit,
+                'background_limit': self.allowance(BACKGROUND, limit),
+                'utilization': round(count / limit, 4),
+                'resets_in': round(started + period - now, 1),
+            }
+        return windows
+
+    def stats(self):
+        """
+        Window usage (host-wide) plus this process's admission counters per priority.
+        """
+        with self._stats_lock:
+            calls = {priority: dict(counts) for priority, counts in self._stats.items()}
+        return {'windows': self.usage(), 'calls': calls}
+
+    def clear(self):
+        self._connection().execute('DELETE FROM upstream_quota')
+        with self._stats_lock:
+            for counts in self._stats.values():
+                for outcome in counts:
+                    counts[outcome] = 0
+
+
+_governor = None
+_governor_lock = threading.Lock()
+
+
+def get_upstream_quota():
+    """
+    Process-wide governor built from the WEATHER_UPSTREAM_* settings on first use.
+    """
+    global _governor
+    if _governor is None:
+        with _governor_lock:
+            if _governor is None:
+                _governor = UpstreamQuotaGovernor(
+                    getattr(settings, 'WEATHER_UPSTREAM_QUOTA_DB', settings.BASE_DIR / 'throttle.sqlite3'),
+                    {
+                        'minute': (60, getattr(settings, 'WEATHER_UPSTREAM_CALLS_PER_MINUTE', 60)),
+                        'day': (86400, getattr(settings, 'WEATHER_UPSTREAM_CALLS_PER_DAY', 30000)),
+                    },
+                    background_share=getattr(settings, 'WEATHER_UPSTREAM_BACKGROUND_SHARE', 0.5),
+                    wait_seconds=getattr(settings, 'WEATHER_UPSTREAM_QUOTA_WAIT_SECONDS', 2.0),
+                )
+    return _governor
+
+
+def reset_upstream_quota():
+    global _governor
+    with _governor_lock:
+        _governor = None
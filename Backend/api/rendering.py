@@ -0,0 +1,71 @@
+import gzip
+import json
+
+from django.conf import settings
+
+try:
+    import brotli  # optional: pip install brotli
+except ImportError:
+    brotli = None
+
+
+def prerender_enabled():
+    """
+    Store rendered (and compressed) response bodies with every cache entry.
+    """
+    return getattr(settings, 'WEATHER_CACHE_PRERENDER', True)
+
+
+def render_body(data):
+    """
+    JSON bytes exactly as DRF's JSONRenderer would produce them (compact, UTF-8).
+    """
+    ret = json.dumps(data, ensure_ascii=False, separators=(',', ':'), allow_nan=False)
+    # Same escaping DRF applies: these separators are valid JSON but not valid JavaScript
+    ret = ret.replace('\u2028', '\\u2028').replace('\u2029', '\\u2029')
+    return ret.encode('utf-8')
+
+
+def compress_body(body):
+    """
+    {content-coding: bytes} for every supported encoding that actually shrinks the body.
+    Preference order is the dict order: brotli (if installed), then gzip.
+    """
+    if len(body) < getattr(settings, 'WEATHER_CACHE_COMPRESS_MIN_BYTES', 256):
+        return {}
+    variants = {}
+    if brotli is not None:
+        variants['br'] = brotli.compress(body, quality=11)
+    # mtime=0 keeps the bytes deterministic, so replicas produce identical bodies
+    variants['gzip'] = gzip.compress(body, compresslevel=9, mtime=0)
+    return {coding: encoded for coding, encoded in variants.items() if len(encoded) < len(body)}
+
+
+def negotiate_encoding(accept_encoding, available):
+    """
+    The coding of `available` the Accept-Encoding header gives the highest q-value (ties go to
+    `available`'s order), or None for identity. Honours q=0 exclusions and the `*` wildcard.
+    """
+    if not accept_encoding or not available:
+        return None
+    weights = {}
+    for item in accept_encoding.split(','):
+        coding, _, params = item.strip().partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        weights[coding] = q
+
+    def weight(coding):
+        return weights.get(coding, weights.get('*', 0.0))
+
+    # max() keeps the first of equal weights
+    best = max(available, key=weight)
+    return best if weight(best) > 0 else None
@@ -0,0 +1,213 @@
+import logging
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .cache import cache_ttl
+from .models import SearchHistory, WeatherCache
+
+logger = logging.getLogger(__name__)
+
+SQLITE_AUTO_VACUUM_MODES = {0: 'none', 1: 'full', 2: 'incremental'}
+
+
+def sqlite_space():
+    """
+    {'page_size', 'pages', 'free_pages'} of the default SQLite database, or None on other backends.
+    """
+    if connection.vendor != 'sqlite':
+        return None
+    with connection.cursor() as cursor:
+        space = {}
+        for pragma, name in (('page_size', 'page_size'), ('page_count', 'pages'), ('freelist_count', 'free_pages')):
+            cursor.execute(f"PRAGMA {pragma}")
+            space[name] = cursor.fetchone()[0]
+    return space
+
+
+def sqlite_auto_vacuum_mode():
+    with connection.cursor() as cursor:
+        cursor.execute("PRAGMA auto_vacuum")
+        return SQLITE_AUTO_VACUUM_MODES.get(cursor.fetchone()[0], 'unknown')
+
+
+def enable_incremental_vacuum():
+    """
+    Switch the SQLite database to auto_vacuum=INCREMENTAL. The mode only takes effect after a full
+    VACUUM, which rewrites the whole file under an exclusive lock: run it once, off-peak.
+    """
+    if connection.vendor != 'sqlite':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        cursor.execute("VACUUM")
+    return sqlite_auto_vacuum_mode() == 'incremental'
+
+
+class RetentionSweeper:
+    """
+    Keeps the WeatherCache table bounded.
+
+    1. Rows expired for longer than `retention` (by default the stale-if-error window, so stale
+       fallbacks keep working) are deleted.
+    2. If more than `max_rows` remain, the least frequently requested rows are evicted:
+       lowest hit_count first (maintained in batches by api.demand), least recently
+       accessed among equals. Rows written within `eviction_grace` are never evicted, so new
+       entries get the chance to collect hits.
+    3. Every hit_count is halved once per `hit_half_life`, so eviction and prefetch ranking
+       follow recent demand rather than all-time totals.
+    4. On SQLite in auto_vacuum=INCREMENTAL mode, up to `vacuum_pages` free pages are returned
+       to the filesystem.
+
+    Deletes run in batches of `batch_size`, each in its own short transaction, so the sweep never
+    holds the write lock for long. SearchHistory rows keep their snapshot and are unlinked first.
+    """
+
+    def __init__(self, retention=None, max_rows=None, eviction_grace=None, batch_size=None, vacuum_pages=None,
+                 pause=0.0, hit_half_life=None, interval=None):
+        if retention is None:
+            retention = timedelta(minutes=getattr(
+                settings, 'WEATHER_CACHE_RETENTION_MINUTES',
+                getattr(settings, 'WEATHER_CACHE_STALE_IF_ERROR_MINUTES', 24 * 60),
+            ))
+        if eviction_grace is None:
+            eviction_grace = timedelta(minutes=getattr(settings, 'WEATHER_CACHE_EVICTION_GRACE_MINUTES', 10))
+        self.retention = retention
+        self.max_rows = max_rows if max_rows is not None else getattr(settings, 'WEATHER_CACHE_MAX_ROWS', 0)
+        self.eviction_grace = eviction_grace
+        self.batch_size = batch_size or getattr(settings, 'WEATHER_RETENTION_BATCH_SIZE', 500)
+        self.vacuum_pages = vacuum_pages if vacuum_pages is not None else getattr(
+            settings, 'WEATHER_RETENTION_VACUUM_PAGES', 2000,
+        )
+        self.pause = pause
+        if hit_half_life is None:
+            hit_half_life = timedelta(minutes=getattr(settings, 'WEATHER_CACHE_HIT_HALF_LIFE_MINUTES', 24 * 60))
+        self.hit_half_life = hit_half_life
+        # How long ago the previous sweep ran, for the first sweep of this process (e.g. --once from cron)
+        self.interval = interval if interval is not None else getattr(settings, 'WEATHER_RETENTION_INTERVAL_SECONDS', 300)
+        self.last_swept_at = None
+
+    def _delete_batch(self, candidates, still_eligible, size):
+        """
+        Delete the first `size` candidate rows. `still_eligible` re-checks the selection condition in the
+        DELETE itself, so a row refreshed since it was selected survives. Returns (deleted, unlinked).
+        """
+        ids = list(candidates.values_list('pk', flat=True)[:size])
+        if not ids:
+            return 0, 0
+        with transaction.atomic():
+            doomed = WeatherCache.objects.filter(still_eligible, pk__in=ids)
+            unlinked = SearchHistory.objects.filter(weather__in=doomed).update(weather=None)
+            deleted = doomed.only('pk').delete()[1].get(WeatherCache._meta.label, 0)
+        return deleted, unlinked
+
+    def _drain(self, candidates, still_eligible, limit=None):
+        deleted = unlinked = 0
+        while limit is None or deleted < limit:
+            size = self.batch_size if limit is None else min(self.batch_size, limit - deleted)
+            batch, batch_unlinked = self._delete_batch(candidates, still_eligible, size)
+            if not batch:
+                break
+            deleted += batch
+            unlinked += batch_unlinked
+            if self.pause:
+                time.sleep(self.pause)
+        return deleted, unlinked
+
+    def delete_expired(self):
+        """
+        Delete rows past expiry plus the retention window, oldest first. Returns (deleted, unlinked).
+        """
+        cutoff = timezone.now() - cache_ttl() - self.retention
+        condition = Q(updated_at__lt=cutoff)
+        return self._drain(WeatherCache.objects.filter(condition).order_by('updated_at'), condition)
+
+    def enforce_cap(self):
+        """
+        Evict the least frequently requested rows beyond `max_rows`. Returns (evicted, unlinked).
+        """
+        if not self.max_rows:
+            return 0, 0
+        excess = WeatherCache.objects.count() - self.max_rows
+        if excess <= 0:
+            return 0, 0
+        condition = Q(updated_at__lt=timezone.now() - self.eviction_grace)
+        candidates = WeatherCache.objects.filter(condition).order_by(
+            'hit_count', F('last_accessed_at').asc(nulls_first=True), 'updated_at',
+        )
+        return self._drain(candidates, condition, limit=excess)
+
+    def decay_hits(self, now=None):
+        """
+        Halve every hit_count if a `hit_half_life` boundary (counted from the epoch) has passed
+        since the previous sweep, in batches of `batch_size` rows. Needs no state of its own, so
+        sweeps from separate processes decay once per half-life too, as long as they run every
+        `interval` seconds. Returns the number of rows halved.
+        """
+        now = now or timezone.now()
+        previous, self.last_swept_at = self.last_swept_at, now
+        half_life = self.hit_half_life.total_seconds() if self.hit_half_life else 0
+        if half_life <= 0:
+            return 0
+        previous = previous or now - timedelta(seconds=self.interval)
+        if now.timestamp() // half_life == previous.timestamp() // half_life:
+            return 0
+
+        halved, last_pk = 0, 0
+        while True:
+            ids = list(WeatherCache.objects.filter(pk__gt=last_pk, hit_count__gt=0).order_by('pk').values_list(
+                'pk', flat=True,
+            )[:self.batch_size])
+            if not ids:
+                return halved
+            halved += WeatherCache.objects.filter(pk__in=ids).update(hit_count=F('hit_count') / 2)
+            last_pk = ids[-1]
+            if self.pause:
+                time.sleep(self.pause)
+
+    def vacuum(self):
+        """
+        Run a bounded incremental vacuum. Returns {'mode', 'reclaimed_bytes', 'free_bytes', 'file_bytes'},
+        or None when the database is not SQLite.
+        """
+        before = sqlite_space()
+        if before is None:
+            return None
+        mode = sqlite_auto_vacuum_mode()
+        if mode == 'incremental' and before['free_pages'] and self.vacuum_pages:
+            # The pragma frees one page per step, and sqlite3's execute() only steps a statement
+            # without result columns once: executescript() runs it to completion.
+            connection.ensure_connection()
+            connection.connection.executescript(f"PRAGMA incremental_vacuum({int(self.vacuum_pages)});")
+        after = sqlite_space()
+        page_size = after['page_size']
+        return {
+            'mode': mode,
+            'reclaimed_bytes': (before['pages'] - after['pages']) * page_size,
+            'free_bytes': after['free_pages'] * page_size,
+            'file_bytes': after['pages'] * page_size,
+        }
+
+    def sweep(self):
+        """
+        One full pass. Returns a report of what was deleted and reclaimed.
+        """
+        started = time.monotonic()
+        expired, expired_unlinked = self.delete_expired()
+        evicted, evicted_unlinked = self.enforce_cap()
+        report = {
+            'expired': expired,
+            'evicted': evicted,
+            'history_unlinked': expired_unlinked + evicted_unlinked,
+            'decayed': self.decay_hits(),
+            'rows': WeatherCache.objects.count(),
+            'vacuum': self.vacuum(),
+        }
+        report['seconds'] = round(time.monotonic() - started, 3)
+        if expired or evicted:
+            logger.info(f"Retention sweep deleted {expired} expired and {evicted} evicted cache rows")
+        return report
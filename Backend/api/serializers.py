@@ -1,3 +1,4 @@
+from django.conf import settings
 from rest_framework import serializers
 from .models import WeatherCache, SearchHistory
 
@@ -15,7 +16,29 @@ class WeatherCacheSerializer(serializers.ModelSerializer):
         read_only_fields = ['updated_at']
 
 class SearchHistorySerializer(serializers.ModelSerializer):
+    # Same shape as before: the cached payload this search points to (or its snapshot)
+    response_data = serializers.JSONField(read_only=True)
+
     class Meta:
         model = SearchHistory
         fields = ['id', 'user', 'city_name_queried', 'response_data', 'timestamp']
         read_only_fields = ['timestamp', 'user']
+
+    def __init__(self, *args, fields=None, **kwargs):
+        # Optional projection: only the named fields are serialized
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+class WeatherLocationSerializer(serializers.Serializer):
+    city = serializers.CharField(max_length=100)
+    state = serializers.CharField(max_length=100)
+    country = serializers.CharField(max_length=100)
+
+class WeatherBatchRequestSerializer(serializers.Serializer):
+    locations = serializers.ListField(
+        child=WeatherLocationSerializer(),
+        min_length=1,
+        max_length=getattr(settings, 'WEATHER_BATCH_MAX_ITEMS', 500),
+    )
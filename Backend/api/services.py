@@ -1,93 +1,559 @@
 import requests
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from django.conf import settings
 from django.utils import timezone
-from .models import WeatherCache, SearchHistory
+from django.db import connection
+from .models import SearchHistory, WeatherCache, build_lookup_key, history_snapshot
+from .cache import (
+    CacheEntry, get_weather_cache, make_cache_key, key_digest,
+    stale_while_revalidate_window, stale_if_error_window,
+    CACHE_HIT, CACHE_MISS, CACHE_STALE, CACHE_STALE_IF_ERROR,
+)
+from .db import retry_on_lock
+from .demand import demand_tracker
+from .history import history_writer
+from .singleflight import SingleFlight, AsyncSingleFlight, DistributedLock
+from .clients import get_weather_client, get_async_weather_client
+from .quota import INTERACTIVE, BACKGROUND
+from .geo import grid_label, parse_grid_label, snap_to_grid, search_radius_km
+from .gazetteer import UnknownCityError, get_gazetteer, normalize_name
 
 logger = logging.getLogger(__name__)
+# One record per cache hit: sampled (settings.LOGGING) and formatted lazily, off the request thread
+hit_logger = logging.getLogger(f'{__name__}.hits')
+
+
+def is_provider_failure(e):
+    """
+    True for errors that say nothing about the request itself (timeouts, connection errors,
+    open circuit, 429/5xx) - the cases where serving stale data beats failing.
+    """
+    response = getattr(e, 'response', None)
+    return response is None or response.status_code == 429 or response.status_code >= 500
 
 class WeatherService:
     # Get your API key from settings (keep it in .env)
     API_KEY = getattr(settings, 'WEATHER_API_KEY', "fc32ffca6b17e7a997a35a4a63e670b9")
-    BASE_URL = "https://api.openweathermap.org/data/2.5/weather"
+
+    # Coalesces concurrent misses so only one upstream fetch runs per (city, state, country)
+    _inflight = SingleFlight()
+    _ainflight = AsyncSingleFlight()
+
+    # Background refreshes for stale-while-revalidate
+    _refresh_executor = None
+    _refresh_pending = set()
+    _refresh_lock = threading.Lock()
 
     @staticmethod
-    def log_history(user, city, data):
+    @retry_on_lock
+    def log_history(user, city, entry):
         """
-        Logs the search history for an authenticated user.
+        Logs the search history for an authenticated user (a User or a TokenUser: only its pk is used).
+        The row references the WeatherCache entry and keeps only a snapshot of its payload.
+        With WEATHER_HISTORY_WRITE_BEHIND the request only enqueues; api.history writes in batches.
         """
         if user.is_authenticated:
             normalized_city = city.strip().upper()
-            
+            lookup_key = build_lookup_key(entry.city, entry.state, entry.country)
+
+            if getattr(settings, 'WEATHER_HISTORY_WRITE_BEHIND', True):
+                history_writer.enqueue(user.pk, normalized_city, lookup_key, entry.data)
+                return
+
             SearchHistory.objects.update_or_create(
-                user=user,
+                user_id=user.pk,
+                city_name_queried=normalized_city,
+                defaults={
+                    'weather_id': WeatherCache.objects.filter(lookup_key=lookup_key).values_list('pk', flat=True).first(),
+                    'snapshot': history_snapshot(entry.data),
+                }
+            )
+
+    @staticmethod
+    @retry_on_lock
+    async def alog_history(user, city, entry):
+        """
+        Async variant of log_history for the ASGI weather endpoint.
+        """
+        if user.is_authenticated:
+            normalized_city = city.strip().upper()
+            lookup_key = build_lookup_key(entry.city, entry.state, entry.country)
+
+            if getattr(settings, 'WEATHER_HISTORY_WRITE_BEHIND', True):
+                # Never blocks: a full queue drops instead of stalling the event loop
+                history_writer.enqueue(user.pk, normalized_city, lookup_key, entry.data, block=False)
+                return
+
+            await SearchHistory.objects.aupdate_or_create(
+                user_id=user.pk,
                 city_name_queried=normalized_city,
                 defaults={
-                    'response_data': data
+                    'weather_id': await WeatherCache.objects.filter(lookup_key=lookup_key).values_list('pk', flat=True).afirst(),
+                    'snapshot': history_snapshot(entry.data),
                 }
             )
 
+    @staticmethod
+    @retry_on_lock
+    def touch_history(user, city):
+        """
+        Marks a repeat search as recent without its payload (the request was answered with 304).
+        """
+        if user.is_authenticated:
+            if getattr(settings, 'WEATHER_HISTORY_WRITE_BEHIND', True):
+                history_writer.enqueue(user.pk, city.strip().upper(), None, None)
+                return
+            SearchHistory.objects.filter(
+                user_id=user.pk,
+                city_name_queried=city.strip().upper(),
+            ).update(timestamp=timezone.now())
+
+    @staticmethod
+    def canonicalize_location(city, state, country, reject=True):
+        """
+        The gazetteer's name for the (normalized) city, e.g. BOMBAY -> MUMBAI, so spellings of one
+        place share a cache entry. `country` narrows the match when it is an ISO alpha-2 code, and
+        a match in the requested state wins over a more populous one elsewhere. Any other country
+        ("USA", "INDIA") cannot narrow it, so the location is then left as requested rather than
+        renamed to a namesake in another country.
+        Unknown cities raise UnknownCityError (with suggestions) if WEATHER_GAZETTEER_REJECT_UNKNOWN
+        and `reject` are set, so they never reach the provider; otherwise they pass unchanged.
+        """
+        gazetteer = get_gazetteer()
+        if gazetteer is None:
+            return city, state, country
+        code = country.strip() if country else None
+        if code and not (len(code) == 2 and code.isalpha()):
+            return city, state, country
+        matches = gazetteer.lookup(city, code)
+        if matches:
+            in_state = [match for match in matches if state and normalize_name(match.state) == normalize_name(state)]
+            return (in_state or matches)[0].name.upper(), state, country
+        if reject and getattr(settings, 'WEATHER_GAZETTEER_REJECT_UNKNOWN', False):
+            raise UnknownCityError(city, gazetteer.suggest(city, code))
+        return city, state, country
+
+    @staticmethod
+    def _build_query(city, state, country):
+        # Construct query: city,state,country code or just city,country
+        query_parts = [city]
+        if state:
+            query_parts.append(state)
+        # Note: If user passes 'INDIA', OWM usually handles it, returning 'IN' in sys.country
+        if country:
+            query_parts.append(country)
+
+        return {
+            'q': ",".join(query_parts),
+            'units': 'metric'
+        }
+
+    @staticmethod
+    def _build_entry(api_data, city, state, country):
+        # KEY FIX: Use API's standardized Name and Country (e.g. "IN" instead of "INDIA")
+        # to ensure the DB stores the canonical version.
+        # (Coordinate lookups may come back with an empty name, e.g. at sea: keep the fallback then)
+        return CacheEntry(
+            data=api_data,
+            updated_at=timezone.now(),
+            city=(api_data.get('name') or city).upper(),
+            state=state, # API often doesn't return state clearly, use user's normalized input
+            country=(api_data.get('sys', {}).get('country') or country or '').upper(),
+        )
+
+    @staticmethod
+    def record_demand(entry):
+        """
+        Count a request served by `entry` for the prefetch scheduler and the retention sweeper
+        (flushed to the DB in batches). Counted under the entry's own location, the key of its
+        WeatherCache row, whatever spelling was requested.
+        """
+        demand_tracker.record(make_cache_key(entry.city, entry.state, entry.country))
+
     @classmethod
     def fetch_weather(cls, city, state=None, country=None):
         """
         Full logic: Cache Check -> External API Fetch -> Cache Save
         """
+        entry, cache_status = cls.get_weather(city, state, country)
+        return entry.data  # Return just the data dict
+
+    @classmethod
+    def get_weather(cls, city, state=None, country=None):
+        """
+        Like fetch_weather, but returns (CacheEntry, cache status) so callers can report freshness.
+        Status is one of CACHE_HIT, CACHE_MISS, CACHE_STALE or CACHE_STALE_IF_ERROR.
+        Raises UnknownCityError for cities the gazetteer rejects.
+        """
         city = city.strip().upper()
         if state:
             state = state.strip().upper()
         if country:
             country = country.strip().upper()
+        city, state, country = cls.canonicalize_location(city, state, country)
+        entry, cache_status = cls._get_weather(city, state, country)
+        cls.record_demand(entry)
+        return entry, cache_status
 
-        # 1. Try to get valid data from our optimized Database Manager
-        # Manager uses iexact, so passing Upper remains valid
-        cached_entry = WeatherCache.objects.get_valid_cache(city, state, country)
+    @classmethod
+    def _get_weather(cls, city, state, country, admit_miss=None):
+        # 1. Try the tiered cache (in-process LRU -> shared cache -> Database)
+        weather_cache = get_weather_cache()
+        cached_entry = weather_cache.get(city, state, country, max_stale=stale_while_revalidate_window())
         if cached_entry:
-            logger.info(f"Data fetched from DB for {city}")
-            return cached_entry.data  # Return just the data dict
+            if cached_entry.is_fresh:
+                hit_logger.info('Data fetched from cache for %s', city, extra={'city': city, 'cache': CACHE_HIT})
+                return cached_entry, CACHE_HIT
+            # Stale-while-revalidate: answer now, refresh in the background
+            logger.info('Serving stale data for %s, refreshing in background', city,
+                        extra={'city': city, 'cache': CACHE_STALE})
+            weather_cache.record_stale(CACHE_STALE)
+            cls.schedule_refresh(city, state, country)
+            return cached_entry, CACHE_STALE
 
-        # 2. If no valid cache, call OpenWeatherMap
-        # Construct query: city,state,country code or just city,country
-        query_parts = [city]
+        # 2. Cache miss: exactly one caller per key goes upstream, the rest wait for its result
+        key = make_cache_key(city, state, country)
+        try:
+            # A recent upstream error for this key is replayed instead of calling upstream again
+            negative = weather_cache.negative.get(key)
+            if negative is not None:
+                logger.info('Negative cache hit for %s (%s)', city, negative.status_code,
+                            extra={'city': city, 'status': negative.status_code})
+                raise negative.as_error()
+            if admit_miss is not None:
+                admit_miss(key)
+            entry = cls._inflight.do(key, lambda: cls._refresh_coalesced(city, state, country))
+            return entry, CACHE_MISS
+        except requests.exceptions.RequestException as e:
+            stale_entry = cls._stale_if_error(city, state, country, e)
+            if stale_entry is None:
+                raise
+            return stale_entry, CACHE_STALE_IF_ERROR
+
+    @classmethod
+    def get_weather_by_coords(cls, lat, lon):
+        """
+        get_weather for a (lat, lon) point, e.g. a phone's GPS fix.
+        Any valid entry within WEATHER_GEO_RADIUS_KM answers it (an indexed bounding-box lookup),
+        so slightly different coordinates share one cached entry; an expired one is served while
+        it is refreshed in the background, like city lookups. Otherwise the point is snapped to
+        the WEATHER_GEO_GRID_DEGREES grid and fetched with the provider's coordinate query,
+        coalesced per grid point. Returns (CacheEntry, cache status) like get_weather.
+        """
+        lat, lon = snap_to_grid(lat, lon)
+        weather_cache = get_weather_cache()
+        location = WeatherCache.objects.nearest_valid(lat, lon, search_radius_km())
+        if location:
+            cached_entry = weather_cache.get(*location)
+            if cached_entry is not None and cached_entry.is_fresh:
+                hit_logger.info('Data fetched from cache for %s,%s (%s)', lat, lon, cached_entry.city,
+                                extra={'lat': lat, 'lon': lon, 'city': cached_entry.city, 'cache': CACHE_HIT})
+                cls.record_demand(cached_entry)
+                return cached_entry, CACHE_HIT
+
+        window = stale_while_revalidate_window()
+        location = WeatherCache.objects.nearest_valid(lat, lon, search_radius_km(), grace=window) if window else None
+        stale_entry = weather_cache.get(*location, max_stale=window) if location else None
+        if stale_entry is not None:
+            logger.info('Serving stale data for %s,%s (%s), refreshing in background', lat, lon, stale_entry.city,
+                        extra={'lat': lat, 'lon': lon, 'city': stale_entry.city, 'cache': CACHE_STALE})
+            weather_cache.record_stale(CACHE_STALE)
+            cls.schedule_refresh(stale_entry.city, stale_entry.state, stale_entry.country)
+            cls.record_demand(stale_entry)
+            return stale_entry, CACHE_STALE
+
+        try:
+            entry = cls._inflight.do(('@', lat, lon), lambda: cls._fetch_coords_from_provider(lat, lon))
+        except requests.exceptions.RequestException as e:
+            window = stale_if_error_window()
+            if not window or not is_provider_failure(e):
+                raise
+            location = WeatherCache.objects.nearest_valid(lat, lon, search_radius_km(), grace=window)
+            stale_entry = weather_cache.get(*location, max_stale=window) if location else None
+            if stale_entry is None:
+                raise
+            logger.warning(f"Upstream failed ({e.__class__.__name__}), serving stale data for {lat},{lon}")
+            weather_cache.record_stale(CACHE_STALE_IF_ERROR)
+            cls.record_demand(stale_entry)
+            return stale_entry, CACHE_STALE_IF_ERROR
+        cls.record_demand(entry)
+        return entry, CACHE_MISS
+
+    @classmethod
+    def get_weather_version_by_coords(cls, lat, lon):
+        """
+        get_weather_version for a (lat, lon) point: (updated_at, location) of the fresh entry that
+        get_weather_by_coords would serve, or None, without loading the payload.
+        """
+        lat, lon = snap_to_grid(lat, lon)
+        location = WeatherCache.objects.nearest_valid(lat, lon, search_radius_km())
+        version = get_weather_cache().get_version(*location) if location else None
+        if version is not None:
+            demand_tracker.record(version[1])
+        return version
+
+    @classmethod
+    def get_weather_version(cls, city, state=None, country=None):
+        """
+        updated_at of the fresh cached entry for the location, or None, without loading the payload.
+        Lets the view answer a conditional request with 304 before any JSON is read.
+        """
+        key = make_cache_key(city, state, country)
+        # Never rejects: unknown cities are answered by get_weather
+        key = make_cache_key(*cls.canonicalize_location(*key, reject=False))
+        version = get_weather_cache().get_version(*key)
+        if version is None:
+            return None
+        updated_at, location = version
+        demand_tracker.record(location)
+        return updated_at
+
+    @classmethod
+    def _stale_if_error(cls, city, state, country, error):
+        """
+        Stale-if-error: the freshest entry within the window, if the failure was the provider's fault.
+        """
+        window = stale_if_error_window()
+        if not window or not is_provider_failure(error):
+            return None
+        weather_cache = get_weather_cache()
+        stale_entry = weather_cache.get(city, state, country, max_stale=window)
+        if stale_entry is not None:
+            logger.warning(f"Upstream failed ({error.__class__.__name__}), serving stale data for {city}")
+            weather_cache.record_stale(CACHE_STALE_IF_ERROR)
+        return stale_entry
+
+    @classmethod
+    def schedule_refresh(cls, city, state=None, country=None):
+        """
+        Queue a background upstream refresh for the location (at most one pending per key).
+        """
+        key = make_cache_key(city, state, country)
+        with cls._refresh_lock:
+            if key in cls._refresh_pending:
+                return False
+            cls._refresh_pending.add(key)
+            if cls._refresh_executor is None:
+                cls._refresh_executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'WEATHER_BACKGROUND_REFRESH_WORKERS', 2),
+                    thread_name_prefix='weather-refresh',
+                )
+        cls._refresh_executor.submit(cls._background_refresh, key, city, state, country)
+        return True
+
+    @classmethod
+    def refresh_weather(cls, city, state=None, country=None):
+        """
+        Unconditionally re-fetch the location from upstream and write it through every tier
+        (used by the prefetch scheduler to refresh entries before they expire).
+        Runs at BACKGROUND priority: it only gets the share of the upstream budget users leave.
+        """
+        point = parse_grid_label(state)
+        if point is not None:
+            return cls._inflight.do(('@', *point), lambda: cls._fetch_coords_from_provider(*point, BACKGROUND))
+        key = make_cache_key(city, state, country)
+        return cls._inflight.do(key, lambda: cls._fetch_from_provider(city, state or None, country or None, BACKGROUND))
+
+    @classmethod
+    def _background_refresh(cls, key, city, state, country):
+        try:
+            point = parse_grid_label(state)
+            if point is not None:
+                cls._inflight.do(('@', *point), lambda: cls._fetch_coords_from_provider(*point, BACKGROUND))
+            else:
+                cls._inflight.do(key, lambda: cls._refresh_coalesced(city, state, country, BACKGROUND))
+        except Exception as e:
+            logger.warning(f"Background refresh failed for {city}: {e}")
+        finally:
+            with cls._refresh_lock:
+                cls._refresh_pending.discard(key)
+            connection.close()
+
+    @classmethod
+    def fetch_weather_batch(cls, locations, admit_miss=None):
+        """
+        Bulk variant of get_weather for many (city, state, country) locations.
+        Locations are canonicalized like single lookups (so aliases share one entry, and unknown
+        cities fail alone), then all fresh cache hits are resolved with one lookup per tier (a
+        single query for the Database tier). Each remaining location goes through the same path
+        as get_weather: stale-while-revalidate, negative cache, singleflight (shared with single
+        requests for that city), stale-if-error. Those run in parallel through a bounded thread pool.
+        `admit_miss(key)`, if given, is called before each upstream call and may raise to refuse it.
+        Returns ({normalized requested key: data dict or Exception}, number of cache hits).
+        """
+        canonical = {}
+        for location in locations:
+            requested = make_cache_key(*location)
+            if requested in canonical:
+                continue
+            city, state, country = requested
+            try:
+                canonical[requested] = make_cache_key(*cls.canonicalize_location(city, state or None, country or None))
+            except UnknownCityError as e:
+                canonical[requested] = e
+
+        weather_cache = get_weather_cache()
+        keys = list(dict.fromkeys(key for key in canonical.values() if not isinstance(key, Exception)))
+        outcomes = weather_cache.get_many(keys)
+        for entry in outcomes.values():
+            cls.record_demand(entry)
+        cache_hits = len(outcomes)
+
+        misses = [key for key in keys if key not in outcomes]
+        if misses:
+            max_workers = min(len(misses), getattr(settings, 'WEATHER_BATCH_MAX_CONCURRENCY', 8))
+            logger.info(f"Batch of {len(keys)}: {cache_hits} cache hits, resolving {len(misses)} misses")
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                resolved = pool.map(lambda key: cls._get_batch_item(key, admit_miss), misses)
+                outcomes.update(zip(misses, resolved))
+
+        results = {}
+        for requested, key in canonical.items():
+            outcome = key if isinstance(key, Exception) else outcomes[key]
+            results[requested] = outcome if isinstance(outcome, Exception) else outcome.data
+        return results, cache_hits
+
+    @classmethod
+    def _get_batch_item(cls, key, admit_miss):
+        city, state, country = key
+        try:
+            entry, cache_status = cls._get_weather(city, state or None, country or None, admit_miss)
+        except Exception as e:
+            return e
+        finally:
+            # Pool threads open their own connections
+            connection.close()
+        cls.record_demand(entry)
+        return entry
+
+    @classmethod
+    def _refresh_coalesced(cls, city, state, country, priority=INTERACTIVE):
+        """
+        Runs once per key per process. Optionally serializes the fetch across workers too.
+        """
+        if not getattr(settings, 'WEATHER_FETCH_LOCK_ENABLED', False):
+            return cls._fetch_from_provider(city, state, country, priority)
+
+        weather_cache = get_weather_cache()
+        lock_name = key_digest(make_cache_key(city, state, country))
+        # Waiters only poll the shared tier, where the lock holder's result shows up first
+        wait_until = lambda: weather_cache.get_shared(city, state, country)  # noqa: E731
+        with DistributedLock().acquire(lock_name, wait_until=wait_until) as entry:
+            if entry is not None:
+                # Another worker finished the fetch while we waited
+                return entry
+            # Re-check: the previous lock holder may have filled the cache just before we acquired it
+            entry = weather_cache.get(city, state, country)
+            if entry is not None:
+                return entry
+            return cls._fetch_from_provider(city, state, country, priority)
+
+    @classmethod
+    def _fetch_from_provider(cls, city, state, country, priority=INTERACTIVE):
+        """
+        External API Fetch -> Cache Save (write-through). Returns the stored CacheEntry.
+        `priority` is the call's class for the upstream quota governor (api.quota).
+        """
+        weather_cache = get_weather_cache()
+        params = cls._build_query(city, state, country)
+
+        logger.info('API is hit for %s', city, extra={'city': city, 'cache': CACHE_MISS})
+        # Pooled client with timeouts, retries and a circuit breaker; raises for 4xx or 5xx.
+        # Errors propagate to get_weather, which may fall back to stale data.
+        try:
+            api_data = get_weather_client().get_current_weather(params, priority)
+        except requests.exceptions.RequestException as e:
+            # Only the singleflight leader gets here, so each upstream error is stored once
+            weather_cache.negative.remember(make_cache_key(city, state, country), e)
+            raise
+
+        # 3. Update or Create Cache entry
+        # Write-through: Database first, then the faster tiers under the requested key
+        return weather_cache.set(city, state, country, cls._build_entry(api_data, city, state, country))
+
+    @classmethod
+    def _fetch_coords_from_provider(cls, lat, lon, priority=INTERACTIVE):
+        """
+        Coordinate variant of _fetch_from_provider. The entry keeps the place name the provider
+        resolves the point to (or the grid point itself if it has none), but is stored under the
+        grid point (grid_label as its state): a row of its own, so it never replaces the row, or
+        moves the coordinates, of a city search for that place.
+        """
+        logger.info('API is hit for %s,%s', lat, lon, extra={'lat': lat, 'lon': lon, 'cache': CACHE_MISS})
+        api_data = get_weather_client().get_current_weather({'lat': lat, 'lon': lon, 'units': 'metric'}, priority)
+        entry = cls._build_entry(api_data, f"{lat},{lon}", grid_label(lat, lon), None)
+        return get_weather_cache().set(entry.city, entry.state, entry.country, entry)
+
+    # --- Async path (ASGI) ---
+
+    @classmethod
+    async def afetch_weather(cls, city, state=None, country=None):
+        entry, cache_status = await cls.aget_weather(city, state, country)
+        return entry.data
+
+    @classmethod
+    async def aget_weather(cls, city, state=None, country=None):
+        """
+        Non-blocking variant of get_weather: async cache tiers, async ORM and the aiohttp client.
+        Misses are coalesced per event loop; the optional cross-worker lock applies to the sync path only.
+        Stale-while-revalidate refreshes run on the same background thread pool as the sync path.
+        """
+        city = city.strip().upper()
         if state:
-            query_parts.append(state)
-        # Note: If user passes 'INDIA', OWM usually handles it, returning 'IN' in sys.country
+            state = state.strip().upper()
         if country:
-            query_parts.append(country)
-        
-        q_param = ",".join(query_parts)
+            country = country.strip().upper()
+        # Memory-mapped lookups, cheap enough to run on the event loop
+        city, state, country = cls.canonicalize_location(city, state, country)
+        entry, cache_status = await cls._aget_weather(city, state, country)
+        cls.record_demand(entry)
+        return entry, cache_status
 
-        params = {
-            'q': q_param,
-            'appid': cls.API_KEY,
-            'units': 'metric'
-        }
+    @classmethod
+    async def _aget_weather(cls, city, state, country):
+        weather_cache = get_weather_cache()
+        cached_entry = await weather_cache.aget(city, state, country, max_stale=stale_while_revalidate_window())
+        if cached_entry:
+            if cached_entry.is_fresh:
+                hit_logger.info('Data fetched from cache for %s', city, extra={'city': city, 'cache': CACHE_HIT})
+                return cached_entry, CACHE_HIT
+            logger.info('Serving stale data for %s, refreshing in background', city,
+                        extra={'city': city, 'cache': CACHE_STALE})
+            weather_cache.record_stale(CACHE_STALE)
+            cls.schedule_refresh(city, state, country)
+            return cached_entry, CACHE_STALE
 
+        key = make_cache_key(city, state, country)
         try:
-            logger.info(f"API is hit for {city}")
-            response = requests.get(cls.BASE_URL, params=params)
-            response.raise_for_status() # Raise error for 4xx or 5xx status
-            api_data = response.json()
-
-            # 3. Update or Create Cache entry
-            # KEY FIX: Use API's standardized Name and Country (e.g. "IN" instead of "INDIA")
-            # to ensure the DB stores the canonical version.
-            canonical_city = api_data.get('name', city).upper()
-            canonical_country = api_data.get('sys', {}).get('country', country).upper()
-
-            weather_obj, created = WeatherCache.objects.update_or_create(
-                city=canonical_city,
-                state=state, # API often doesn't return state clearly, use user's normalized input
-                country=canonical_country,
-                defaults={
-                    'data': api_data,
-                    'updated_at': timezone.now()
-                }
-            )
-            return weather_obj.data
-
+            negative = await weather_cache.negative.aget(key)
+            if negative is not None:
+                logger.info('Negative cache hit for %s (%s)', city, negative.status_code,
+                            extra={'city': city, 'status': negative.status_code})
+                raise negative.as_error()
+            entry = await cls._ainflight.do(key, lambda: cls._afetch_from_provider(city, state, country))
+            return entry, CACHE_MISS
         except requests.exceptions.RequestException as e:
-            # Re-raise to be handled by the view or return None/Error dict
-            # user view expects to catch Exception, so raising is fine.
-            raise e
+            window = stale_if_error_window()
+            if not window or not is_provider_failure(e):
+                raise
+            stale_entry = await weather_cache.aget(city, state, country, max_stale=window)
+            if stale_entry is None:
+                raise
+            logger.warning(f"Upstream failed ({e.__class__.__name__}), serving stale data for {city}")
+            weather_cache.record_stale(CACHE_STALE_IF_ERROR)
+            return stale_entry, CACHE_STALE_IF_ERROR
 
+    @classmethod
+    async def _afetch_from_provider(cls, city, state, country):
+        weather_cache = get_weather_cache()
+        params = cls._build_query(city, state, country)
 
+        logger.info('API is hit for %s', city, extra={'city': city, 'cache': CACHE_MISS})
+        try:
+            api_data = await get_async_weather_client().get_current_weather(params)
+        except requests.exceptions.RequestException as e:
+            await weather_cache.negative.aremember(make_cache_key(city, state, country), e)
+            raise
+        return await weather_cache.aset(city, state, country, cls._build_entry(api_data, city, state, country))
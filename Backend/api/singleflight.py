@@ -0,0 +1,141 @@
+import asyncio
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+class _Call:
+    """
+    An in-flight call that concurrent callers for the same key wait on.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Per-key request coalescing within a process.
+
+    The first caller for a key (the leader) runs the function; callers arriving while
+    it is in flight block and receive the leader's result (or exception) instead of
+    running the function again.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not is_leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+        return call.result
+
+
+class AsyncSingleFlight:
+    """
+    Event-loop counterpart of SingleFlight: waiters await the leader's task instead of a thread Event.
+    Calls are keyed per event loop, since a future can only be awaited on the loop that created it.
+    """
+
+    def __init__(self):
+        self._tasks = {}
+
+    def in_flight(self):
+        return len(self._tasks)
+
+    async def do(self, key, coro_fn):
+        loop_key = (id(asyncio.get_running_loop()), key)
+        task = self._tasks.get(loop_key)
+        if task is None:
+            task = asyncio.ensure_future(coro_fn())
+            self._tasks[loop_key] = task
+            task.add_done_callback(lambda _: self._tasks.pop(loop_key, None))
+        # Shield so one cancelled waiter does not cancel the fetch for everyone else
+        return await asyncio.shield(task)
+
+
+class DistributedLock:
+    """
+    Best-effort cross-worker lock built on the atomic `cache.add` of the Django cache framework.
+
+    Only effective when the alias points at a backend shared by all workers
+    (Database, Redis, Memcached); with a per-process LocMem backend it degrades to a local lock.
+    Waiters poll with exponential backoff, from `poll_interval` up to `max_poll_interval` seconds.
+    """
+    key_prefix = 'weather-lock'
+
+    def __init__(self, alias=None, timeout=None, poll_interval=0.05, max_poll_interval=0.4):
+        self.alias = alias or getattr(settings, 'WEATHER_FETCH_LOCK_ALIAS', 'default')
+        self.timeout = timeout if timeout is not None else getattr(settings, 'WEATHER_FETCH_LOCK_TIMEOUT', 10)
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+
+    @property
+    def backend(self):
+        return caches[self.alias]
+
+    @contextmanager
+    def acquire(self, name, wait_until=None):
+        """
+        Hold the lock for `name`. While waiting, `wait_until()` is polled; if it returns a value
+        the lock is abandoned and that value is yielded instead of None.
+        Gives up waiting after `timeout` seconds and proceeds unlocked rather than failing the request.
+        """
+        key = f"{self.key_prefix}:{name}"
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + self.timeout
+        delay = self.poll_interval
+        acquired = False
+
+        while True:
+            acquired = self.backend.add(key, token, timeout=self.timeout)
+            if acquired:
+                break
+            if wait_until is not None:
+                result = wait_until()
+                if result is not None:
+                    yield result
+                    return
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, self.max_poll_interval)
+
+        try:
+            yield None
+        finally:
+            # Never release a lock that expired and was taken over by another worker
+            if acquired and self.backend.get(key) == token:
+                self.backend.delete(key)
@@ -0,0 +1,1888 @@
+import asyncio
+import gzip
+import io
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+from unittest import mock
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.management import call_command
+from django.db import OperationalError, connection
+from django.db.migrations.executor import MigrationExecutor
+from django.http import HttpResponse
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.response import Response
+from rest_framework.test import APIClient, APIRequestFactory
+from rest_framework.views import APIView
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from benchmarks.stub_provider import StubProvider
+from core.logs import JsonFormatter, QueueHandler, SamplingFilter, current_request_id
+from core.middleware import ProfilingMiddleware
+
+from .cache import (
+    BaseCacheTier, CACHE_MISS, CACHE_STALE, CACHE_STALE_IF_ERROR, CacheEntry, DatabaseTier, LocalMemoryTier, NegativeCache,
+    TieredWeatherCache, get_weather_cache, key_digest, make_cache_key, reset_weather_cache,
+)
+from .db import is_lock_error, retry_on_lock
+from .demand import DemandTracker, demand_tracker
+from .gazetteer import (
+    Gazetteer, UnknownCityError, build_index, gazetteer_source, get_gazetteer, read_seed, reset_gazetteer, source_stamp,
+)
+from .geo import bounding_box, grid_label, parse_grid_label, snap_to_grid
+from . import history
+from .authentication import user_status_cache
+from .history import BLOCK, DROP_NEWEST, DROP_OLDEST, HistoryWriter
+from .clients import (
+    AsyncOpenWeatherMapClient, CircuitBreaker, CircuitOpenError, OpenWeatherMapClient,
+    aclose_async_weather_client, reset_weather_client,
+)
+from .retention import RetentionSweeper
+from .quota import (
+    BACKGROUND, INTERACTIVE, UpstreamQuotaExceeded, UpstreamQuotaGovernor, get_upstream_quota, reset_upstream_quota,
+)
+from .management.commands.prefetch_weather import Command as PrefetchCommand
+from .models import SearchHistory, User, WeatherCache, build_lookup_key
+from .rendering import negotiate_encoding, render_body
+from .services import WeatherService
+from .singleflight import DistributedLock
+from .throttles import SlidingWindowStore, WeatherAnonThrottle, WeatherUserThrottle
+from .views import CityAutocompleteView, WeatherView, prerendered_response
+
+def payload(city, temp=20.0, country='IN'):
+    """
+    Minimal provider payload.
+    """
+    return {'name': city, 'main': {'temp': temp}, 'sys': {'country': country}, 'coord': {'lat': 25.6, 'lon': 85.1}}
+
+
+# Upstream calls in these tests are not counted against the provider's call budget
+NO_UPSTREAM_QUOTA = override_settings(WEATHER_UPSTREAM_CALLS_PER_MINUTE=0, WEATHER_UPSTREAM_CALLS_PER_DAY=0)
+
+
+def tearDownModule():
+    # Write what the process-wide writers still hold while the test database exists, and end
+    # their threads, so nothing is flushed into a dropped database at exit
+    demand_tracker.stop()
+    history.history_writer.stop()
+
+
+@NO_UPSTREAM_QUOTA
+class UpstreamClientTests(SimpleTestCase):
+    """
+    OpenWeatherMapClient and AsyncOpenWeatherMapClient against the local stub provider.
+    """
+    RESET_TIMEOUT = 0.1
+
+    def setUp(self):
+        reset_upstream_quota()
+        self.addCleanup(reset_upstream_quota)
+        self.stub = StubProvider().start()
+        self.addCleanup(self.stub.stop)
+        self.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=self.RESET_TIMEOUT)
+
+    def make_client(self, **kwargs):
+        kwargs = {'max_retries': 0, 'backoff_base': 0.01, 'backoff_max': 0.01, **kwargs}
+        client = OpenWeatherMapClient(base_url=self.stub.url, api_key='test', breaker=self.breaker, **kwargs)
+        self.addCleanup(client.close)
+        return client
+
+    def open_circuit(self, half_open=True):
+        for _ in range(self.breaker.failure_threshold):
+            self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        if half_open:
+            time.sleep(self.RESET_TIMEOUT)
+            self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+
+    def test_success(self):
+        data = self.make_client().get_current_weather({'q': 'Patna,BR,IN'})
+        self.assertEqual(data['name'], 'Patna')
+        self.assertEqual(self.stub.calls, 1)
+
+    def test_read_timeout_is_retried_then_raised(self):
+        self.stub.server.latency = 0.5
+        client = self.make_client(read_timeout=0.05, max_retries=1)
+        started = time.monotonic()
+        with self.assertRaises(requests.exceptions.Timeout):
+            client.get_current_weather({'q': 'Patna,BR,IN'})
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual(self.stub.calls, 2)
+        # One failed call, however many attempts it made
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(self.breaker._failures, 1)
+
+    def test_transient_errors_are_retried_with_backoff(self):
+        self.stub.server.error_rate = 1.0
+        client = self.make_client(max_retries=2)
+        with mock.patch.object(client, 'backoff', wraps=client.backoff) as backoff:
+            with self.assertRaises(requests.exceptions.HTTPError) as raised:
+                client.get_current_weather({'q': 'Patna,BR,IN'})
+        self.assertEqual(raised.exception.response.status_code, 503)
+        self.assertEqual(self.stub.calls, 3)
+        self.assertEqual([c.args for c in backoff.call_args_list], [(0,), (1,)])
+
+    def test_backoff_is_capped_full_jitter(self):
+        client = self.make_client(backoff_base=0.25, backoff_max=2.0)
+        for attempt, cap in [(0, 0.25), (1, 0.5), (2, 1.0), (3, 2.0), (6, 2.0)]:
+            delays = [client.backoff(attempt) for _ in range(200)]
+            self.assertTrue(all(0 <= delay <= cap for delay in delays))
+            self.assertGreater(max(delays), cap / 2)
+
+    def test_not_found_is_not_retried_and_keeps_circuit_closed(self):
+        with self.assertRaises(requests.exceptions.HTTPError) as raised:
+            self.make_client(max_retries=2).get_current_weather({'q': 'Nowhereville,XX'})
+        self.assertEqual(raised.exception.response.status_code, 404)
+        self.assertEqual(self.stub.calls, 1)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_circuit_opens_fails_fast_and_closes_after_trial(self):
+        self.stub.server.error_rate = 1.0
+        client = self.make_client()
+        for _ in range(2):
+            with self.assertRaises(requests.exceptions.HTTPError):
+                client.get_current_weather({'q': 'Patna,BR,IN'})
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        with self.assertRaises(CircuitOpenError):
+            client.get_current_weather({'q': 'Patna,BR,IN'})
+        self.assertEqual(self.stub.calls, 2)
+
+        time.sleep(self.RESET_TIMEOUT)
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.stub.server.error_rate = 0.0
+        client.get_current_weather({'q': 'Patna,BR,IN'})
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_failed_trial_reopens_circuit(self):
+        self.open_circuit()
+        self.stub.server.error_rate = 1.0
+        with self.assertRaises(requests.exceptions.HTTPError):
+            self.make_client().get_current_weather({'q': 'Patna,BR,IN'})
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+    def test_half_open_admits_one_trial_at_a_time(self):
+        self.open_circuit()
+        self.assertTrue(self.breaker.allow_request())
+        self.assertFalse(self.breaker.allow_request())
+        self.breaker.release()
+        self.assertTrue(self.breaker.allow_request())
+
+    def test_other_request_errors_settle_the_trial(self):
+        # Errors outside the retried ones (truncated bodies, redirect loops, TLS...) used to
+        # leave the trial in flight, failing every later call fast
+        client = self.make_client()
+        for error in (requests.exceptions.ChunkedEncodingError, requests.exceptions.SSLError,
+                      requests.exceptions.TooManyRedirects):
+            with self.subTest(error=error.__name__):
+                self.open_circuit()
+                with mock.patch.object(client.session, 'get', side_effect=error('boom')):
+                    with self.assertRaises(error):
+                        client.get_current_weather({'q': 'Patna,BR,IN'})
+                self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+                time.sleep(self.RESET_TIMEOUT)
+                client.get_current_weather({'q': 'Patna,BR,IN'})
+                self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_local_errors_release_the_trial(self):
+        client = self.make_client()
+        self.open_circuit()
+        with mock.patch.object(client.session, 'get', side_effect=RuntimeError('bug')):
+            with self.assertRaises(RuntimeError):
+                client.get_current_weather({'q': 'Patna,BR,IN'})
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        client.get_current_weather({'q': 'Patna,BR,IN'})
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_async_client(self):
+        async def fetch():
+            client = AsyncOpenWeatherMapClient(self.make_client(max_retries=1))
+            try:
+                data = await client.get_current_weather({'q': 'Patna,BR,IN'})
+                self.stub.server.error_rate = 1.0
+                with self.assertRaises(requests.exceptions.HTTPError):
+                    await client.get_current_weather({'q': 'Patna,BR,IN'})
+                return data
+            finally:
+                await client.aclose()
+
+        self.assertEqual(asyncio.run(fetch())['name'], 'Patna')
+        self.assertEqual(self.stub.calls, 3)
+
+    def test_async_cancellation_releases_the_trial(self):
+        # An ASGI client disconnecting cancels the view's task mid-call
+        self.stub.server.latency = 0.5
+        self.open_circuit()
+
+        async def cancel_trial():
+            client = AsyncOpenWeatherMapClient(self.make_client())
+            try:
+                task = asyncio.ensure_future(client.get_current_weather({'q': 'Patna,BR,IN'}))
+                await asyncio.sleep(0.05)
+                task.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await task
+            finally:
+                await client.aclose()
+
+        asyncio.run(cancel_trial())
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertTrue(self.breaker.allow_request())
+
+
+@NO_UPSTREAM_QUOTA
+class StubProviderTestCase(TransactionTestCase):
+    """
+    WeatherService against the local stub provider, with empty caches.
+    Transactional, so threads and sync_to_async workers see the test's rows.
+    """
+
+    def setUp(self):
+        self.stub = StubProvider().start()
+        self.addCleanup(self.stub.stop)
+        api_settings = self.settings(WEATHER_API_BASE_URL=self.stub.url)
+        api_settings.enable()
+        self.addCleanup(api_settings.disable)
+        for reset in (cache.clear, reset_weather_cache, reset_weather_client, reset_upstream_quota):
+            reset()
+            self.addCleanup(reset)
+
+    def run_concurrently(self, fn, count):
+        results, errors = [], []
+
+        def run():
+            try:
+                results.append(fn())
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results, errors
+
+
+class CoalescingTests(StubProviderTestCase):
+    CONCURRENCY = 16
+
+    def test_concurrent_misses_make_one_upstream_call(self):
+        self.stub.server.latency = 0.2
+        results, errors = self.run_concurrently(lambda: WeatherService.fetch_weather('Patna', 'BR', 'IN'),
+                                                self.CONCURRENCY)
+        self.assertEqual(errors, [])
+        self.assertEqual([data['name'] for data in results], ['Patna'] * self.CONCURRENCY)
+        self.assertEqual(self.stub.calls, 1)
+
+    def test_concurrent_misses_share_the_upstream_error(self):
+        self.stub.server.latency = 0.2
+        self.stub.server.error_rate = 1.0
+        with self.settings(WEATHER_API_MAX_RETRIES=0):
+            reset_weather_client()
+            results, errors = self.run_concurrently(lambda: WeatherService.fetch_weather('Patna', 'BR', 'IN'),
+                                                    self.CONCURRENCY)
+        self.assertEqual(results, [])
+        self.assertEqual(len(errors), self.CONCURRENCY)
+        self.assertEqual(self.stub.calls, 1)
+
+    @override_settings(WEATHER_FETCH_LOCK_ENABLED=True)
+    def test_concurrent_misses_with_the_cross_worker_lock(self):
+        self.stub.server.latency = 0.2
+        results, errors = self.run_concurrently(lambda: WeatherService.fetch_weather('Patna', 'BR', 'IN'),
+                                                self.CONCURRENCY)
+        self.assertEqual(errors, [])
+        self.assertEqual(len(results), self.CONCURRENCY)
+        self.assertEqual(self.stub.calls, 1)
+
+    def test_concurrent_async_misses_make_one_upstream_call(self):
+        self.stub.server.latency = 0.2
+
+        async def fetch_all():
+            try:
+                return await asyncio.gather(*(
+                    WeatherService.afetch_weather('Patna', 'BR', 'IN') for _ in range(self.CONCURRENCY)
+                ))
+            finally:
+                await aclose_async_weather_client()
+
+        results = asyncio.run(fetch_all())
+        self.assertEqual([data['name'] for data in results], ['Patna'] * self.CONCURRENCY)
+        self.assertEqual(self.stub.calls, 1)
+
+    @override_settings(WEATHER_FETCH_LOCK_ENABLED=True)
+    def test_lock_waiters_poll_only_the_shared_tier(self):
+        # Another worker holds the fetch lock; this one waits for its result
+        key = make_cache_key('PATNA', 'BR', 'IN')
+        with DistributedLock().acquire(key_digest(key)):
+            with mock.patch.object(DatabaseTier, 'get', autospec=True, side_effect=DatabaseTier.get) as database_get:
+                waiter = threading.Thread(target=WeatherService._refresh_coalesced, args=key)
+                waiter.start()
+                time.sleep(0.3)
+                WeatherService._fetch_from_provider(*key)
+                waiter.join()
+        self.assertEqual(self.stub.calls, 1)
+        self.assertEqual(database_get.call_count, 0)
+
+    def test_lock_polling_backs_off(self):
+        lock = DistributedLock(timeout=1, poll_interval=0.05, max_poll_interval=0.2)
+        with lock.acquire('backoff'):
+            with mock.patch('api.singleflight.time.sleep') as sleep:
+                polls = iter([None] * 5 + ['entry'])
+                with lock.acquire('backoff', wait_until=lambda: next(polls)) as result:
+                    self.assertEqual(result, 'entry')
+        self.assertEqual([c.args[0] for c in sleep.call_args_list], [0.05, 0.1, 0.2, 0.2, 0.2])
+
+
+@override_settings(WEATHER_CACHE_MINUTES=0, WEATHER_CACHE_STALE_WHILE_REVALIDATE_MINUTES=10)
+class StaleWhileRevalidateTests(StubProviderTestCase):
+    CONCURRENCY = 16
+
+    def test_stale_hits_answer_at_once_and_refresh_once(self):
+        WeatherService.get_weather('Patna', 'Bihar', 'IN')
+        self.assertEqual(self.stub.calls, 1)
+
+        self.stub.server.latency = 0.5
+        started = time.monotonic()
+        results, errors = self.run_concurrently(lambda: WeatherService.get_weather('Patna', 'Bihar', 'IN'),
+                                                self.CONCURRENCY)
+        self.assertLess(time.monotonic() - started, self.stub.server.latency)
+        self.assertEqual(errors, [])
+        self.assertEqual({(status, entry.data['name']) for entry, status in results}, {(CACHE_STALE, 'Patna')})
+
+        deadline = time.monotonic() + 5
+        while WeatherService._refresh_pending and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.stub.calls, 2)
+
+
+class AnonThrottledView(APIView):
+    authentication_classes = []
+    permission_classes = []
+    throttle_classes = [WeatherAnonThrottle]
+
+    def get(self, request):
+        return Response({})
+
+
+class SlidingWindowThrottleTests(SimpleTestCase):
+    DAY = 86400
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'throttle.sqlite3')
+        throttle_settings = self.settings(WEATHER_THROTTLE_BACKEND='sliding_window', WEATHER_THROTTLE_DB=self.path)
+        throttle_settings.enable()
+        self.addCleanup(throttle_settings.disable)
+        # The start of a day (and of every minute and 100 seconds): window arithmetic stays exact
+        self.now = 19675 * 86400.0
+        clock = mock.patch('api.throttles.time')
+        clock.start().time.side_effect = lambda: self.now
+        self.addCleanup(clock.stop)
+
+    def test_no_window_admits_more_than_the_limit(self):
+        # A bucket of 5 refilled at 5 per period would admit 10 in the first period
+        store = SlidingWindowStore(self.path)
+        start, admitted = self.now, []
+        for step in range(100):
+            self.now = start + step * 10
+            if store.take('client', 5, 100)[0]:
+                admitted.append(self.now)
+        for at in admitted:
+            self.assertLessEqual(len([other for other in admitted if at - 100 < other <= at]), 5)
+        self.assertGreaterEqual(len(admitted), 40)
+
+    def test_workers_share_the_window(self):
+        workers = [SlidingWindowStore(self.path), SlidingWindowStore(self.path)]
+        results = [workers[i % 2].take('client', 5, 60)[0] for i in range(8)]
+        self.assertEqual(results, [True] * 5 + [False] * 3)
+        self.assertTrue(workers[0].take('other client', 5, 60)[0])
+
+    def test_one_row_per_key_and_window(self):
+        store = SlidingWindowStore(self.path)
+        for _ in range(3):
+            store.take('client', 100, 60)
+        self.assertEqual(store.take('client', 100, 60, cost=10), (True, 0.0))
+        rows = list(store._connection().execute('SELECT key, count FROM throttle_window'))
+        self.assertEqual(rows, [('client', 13)])
+
+    def test_retry_after_is_when_the_estimate_leaves_room(self):
+        store = SlidingWindowStore(self.path)
+        start = self.now
+        self.assertTrue(store.take('client', 2, 60)[0])
+        self.now = start + 10
+        self.assertTrue(store.take('client', 2, 60)[0])
+        # Full for this window; in the next one the 2 weigh 2 * (1 - t / 60), room for 1 at t = 30
+        self.now = start + 20
+        self.assertEqual(store.take('client', 2, 60), (False, 70.0))
+        self.now = start + 59
+        self.assertEqual(store.take('client', 2, 60), (False, 31.0))
+        self.now = start + 60
+        self.assertEqual(store.take('client', 2, 60), (False, 30.0))
+        self.now = start + 90
+        self.assertEqual(store.take('client', 2, 60), (True, 0.0))
+
+    def test_expired_windows_are_swept(self):
+        store = SlidingWindowStore(self.path, sweep_every=1)
+        start = self.now
+        store.take('client', 5, 60)
+        # Still read as the previous window until the end of the next one
+        self.now = start + 119
+        store.take('other client', 5, 60)
+        self.now = start + 121
+        store.take('other client', 5, 60)
+        keys = {key for key, in store._connection().execute('SELECT key FROM throttle_window')}
+        self.assertEqual(keys, {'other client'})
+
+    def test_daily_rate_with_retry_after_header(self):
+        factory, view = APIRequestFactory(), AnonThrottledView.as_view()
+        statuses = [view(factory.get('/')).status_code for _ in range(5)]
+        self.assertEqual(statuses, [200] * 5)
+
+        # Room again once yesterday's 5 weigh 4: a fifth of the way into tomorrow
+        self.now += self.DAY / 2
+        response = view(factory.get('/'))
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], str(round(self.DAY * 0.7)))
+
+        self.now += self.DAY / 2
+        self.assertEqual(view(factory.get('/')).status_code, 429)
+        self.now += self.DAY * 0.2 + 1
+        self.assertEqual(view(factory.get('/')).status_code, 200)
+
+    def test_store_unavailable_lets_requests_through(self):
+        factory, view = APIRequestFactory(), AnonThrottledView.as_view()
+        with self.settings(WEATHER_THROTTLE_DB=os.path.join(self.path, 'missing', 'throttle.sqlite3')):
+            with self.assertLogs('api.throttles', 'WARNING'):
+                statuses = [view(factory.get('/')).status_code for _ in range(10)]
+        self.assertEqual(statuses, [200] * 10)
+
+
+class UpstreamQuotaTests(SimpleTestCase):
+    """
+    UpstreamQuotaGovernor on a temporary store, with a fake clock (time.sleep advances it).
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'quota.sqlite3')
+        self.now = 1_699_999_980.0 + 40  # 40 s into a minute
+        clock = mock.patch('api.quota.time')
+        fake_time = clock.start()
+        fake_time.time.side_effect = lambda: self.now
+        fake_time.sleep.side_effect = self.sleep
+        self.addCleanup(clock.stop)
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    def governor(self, per_minute=4, per_day=0, **kwargs):
+        return UpstreamQuotaGovernor(self.path, {'minute': (60, per_minute), 'day': (86400, per_day)}, **kwargs)
+
+    def test_window_rollover(self):
+        governor = self.governor(per_minute=3)
+        self.assertEqual([governor.try_acquire()[0] for _ in range(4)], [True, True, True, False])
+        self.assertEqual(governor.try_acquire(), (False, 20.0))
+        self.now += 20
+        self.assertTrue(governor.try_acquire()[0])
+        self.assertEqual(governor.usage()['minute']['used'], 1)
+
+    def test_every_window_must_have_room(self):
+        governor = self.governor(per_minute=3, per_day=4)
+        admitted = [governor.try_acquire()[0] for _ in range(3)]
+        self.now += 60
+        admitted += [governor.try_acquire()[0] for _ in range(2)]
+        self.assertEqual(admitted, [True, True, True, True, False])
+
+    def test_background_calls_get_a_share_and_never_wait(self):
+        governor = self.governor(per_minute=4, background_share=0.5, wait_seconds=30)
+        governor.acquire(BACKGROUND)
+        governor.acquire(BACKGROUND)
+        started = self.now
+        with self.assertRaises(UpstreamQuotaExceeded) as raised:
+            governor.acquire(BACKGROUND)
+        self.assertEqual(self.now, started)
+        self.assertEqual(raised.exception.retry_after, 20.0)
+        # Users still get the rest of the window
+        governor.acquire(INTERACTIVE)
+        governor.acquire(INTERACTIVE)
+        self.assertEqual(governor.stats()['calls'][BACKGROUND], {'admitted': 2, 'waited': 0, 'rejected': 1})
+
+    def test_interactive_calls_wait_for_the_next_window(self):
+        governor = self.governor(per_minute=1, wait_seconds=2.0)
+        governor.acquire()
+        self.now += 19  # one second before the window resets
+        governor.acquire()
+        self.assertEqual(governor.stats()['calls'][INTERACTIVE]['waited'], 1)
+
+        with self.assertRaises(UpstreamQuotaExceeded):
+            governor.acquire()  # the next window is 60 s away, past the wait budget
+        self.assertEqual(governor.stats()['calls'][INTERACTIVE]['rejected'], 1)
+
+    def test_async_acquire_does_not_touch_the_store_on_the_event_loop(self):
+        governor = self.governor(per_minute=1, wait_seconds=0)
+        loop_thread = threading.get_ident()
+        store_threads = []
+        try_acquire = governor.try_acquire
+
+        def record_thread(priority):
+            store_threads.append(threading.get_ident())
+            return try_acquire(priority)
+
+        async def acquire_twice():
+            await governor.aacquire()
+            with self.assertRaises(UpstreamQuotaExceeded):
+                await governor.aacquire()
+
+        with mock.patch.object(governor, 'try_acquire', side_effect=record_thread):
+            asyncio.run(acquire_twice())
+        self.assertEqual(len(store_threads), 2)
+        self.assertNotIn(loop_thread, store_threads)
+
+    def test_store_unavailable_admits(self):
+        governor = UpstreamQuotaGovernor(os.path.join(self.path, 'missing', 'quota.sqlite3'), {'minute': (60, 1)})
+        with self.assertLogs('api.quota', 'WARNING'):
+            self.assertEqual([governor.try_acquire()[0] for _ in range(3)], [True] * 3)
+
+
+class UpstreamQuotaClientTests(StubProviderTestCase):
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        quota_settings = self.settings(
+            WEATHER_UPSTREAM_QUOTA_DB=os.path.join(directory.name, 'quota.sqlite3'),
+            WEATHER_UPSTREAM_CALLS_PER_MINUTE=1, WEATHER_UPSTREAM_CALLS_PER_DAY=0,
+            WEATHER_UPSTREAM_QUOTA_WAIT_SECONDS=0,
+        )
+        quota_settings.enable()
+        self.addCleanup(quota_settings.disable)
+        reset_upstream_quota()
+
+    def used(self):
+        return get_upstream_quota().usage()['minute']['used']
+
+    def test_open_circuit_spends_no_budget(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+        breaker.record_failure()
+        client = OpenWeatherMapClient(base_url=self.stub.url, api_key='test', breaker=breaker)
+        self.addCleanup(client.close)
+        with self.assertRaises(CircuitOpenError):
+            client.get_current_weather({'q': 'Patna,BR,IN'})
+        self.assertEqual(self.used(), 0)
+
+    def test_trial_refused_by_the_budget_is_released(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()
+        get_upstream_quota().acquire()  # uses up the minute
+        client = OpenWeatherMapClient(base_url=self.stub.url, api_key='test', breaker=breaker)
+        self.addCleanup(client.close)
+        with self.assertRaises(UpstreamQuotaExceeded):
+            client.get_current_weather({'q': 'Patna,BR,IN'})
+        self.assertEqual(self.stub.calls, 0)
+        self.assertTrue(breaker.allow_request())
+
+    @override_settings(WEATHER_CACHE_MINUTES=0, WEATHER_CACHE_STALE_WHILE_REVALIDATE_MINUTES=0)
+    def test_exhausted_budget_serves_stale_data(self):
+        # Entries expire at once: every lookup after the first is a miss that needs the budget
+        entry, status = WeatherService.get_weather('Patna', 'BR', 'IN')
+        self.assertEqual(status, CACHE_MISS)
+        entry, status = WeatherService.get_weather('Patna', 'BR', 'IN')
+        self.assertEqual(status, CACHE_STALE_IF_ERROR)
+        self.assertEqual(entry.data['name'], 'Patna')
+        self.assertEqual(self.stub.calls, 1)
+
+        async def aget_weather():
+            try:
+                return await WeatherService.aget_weather('Patna', 'BR', 'IN')
+            finally:
+                await aclose_async_weather_client()
+
+        self.assertEqual(asyncio.run(aget_weather())[1], CACHE_STALE_IF_ERROR)
+        self.assertEqual(self.stub.calls, 1)
+
+
+class DemandTrackingTests(StubProviderTestCase):
+
+    def setUp(self):
+        super().setUp()
+        demand_tracker.flush()  # counts left over from other tests
+
+    def hit_count(self, city='PATNA', state=None, country='IN'):
+        return WeatherCache.objects.get(lookup_key=build_lookup_key(city, state, country)).hit_count
+
+    def test_demand_is_counted_under_the_served_entry(self):
+        # The provider answers 'India' with the code IN, so the row is PATNA||IN
+        WeatherService.get_weather('Patna', None, 'India')
+        WeatherService.get_weather('Patna', None, 'India')
+        self.assertIsNotNone(WeatherService.get_weather_version('Patna', None, 'India'))
+        demand_tracker.flush()
+        self.assertEqual(self.hit_count(), 3)
+
+    def test_async_demand_is_counted_under_the_served_entry(self):
+        async def aget_weather():
+            try:
+                for _ in range(2):
+                    await WeatherService.aget_weather('Patna', None, 'India')
+            finally:
+                await aclose_async_weather_client()
+
+        asyncio.run(aget_weather())
+        demand_tracker.flush()
+        self.assertEqual(self.hit_count(), 2)
+
+    def test_requests_never_flush(self):
+        WeatherService.get_weather('Patna', None, 'IN')
+        tracker = DemandTracker(flush_interval=0)
+        self.addCleanup(tracker.stop)
+        with self.assertNumQueries(0):
+            tracker.record(('PATNA', '', 'IN'))
+        tracker = DemandTracker(flush_interval=0.05)
+        self.addCleanup(tracker.stop)
+        tracker.record(('PATNA', '', 'IN'))
+        deadline = time.monotonic() + 2
+        while self.hit_count() == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.hit_count(), 1)
+
+    def test_a_failing_key_does_not_drop_the_others(self):
+        for city in ('Patna', 'Delhi', 'Mumbai'):
+            WeatherService.get_weather(city, None, 'IN')
+        demand_tracker.flush()
+        for city in ('Patna', 'Delhi', 'Mumbai'):
+            WeatherService.get_weather(city, None, 'IN')
+
+        record_hits = WeatherCache.objects.record_hits
+
+        def fail_for_delhi(city, *args):
+            if city == 'DELHI':
+                raise RuntimeError('locked')
+            return record_hits(city, *args)
+
+        with mock.patch.object(WeatherCache.objects, 'record_hits', side_effect=fail_for_delhi):
+            with self.assertLogs('api.demand', 'WARNING'):
+                self.assertEqual(demand_tracker.flush(), 2)
+        self.assertEqual([self.hit_count(city) for city in ('PATNA', 'DELHI', 'MUMBAI')], [2, 1, 2])
+
+    def test_ranking_counts_searches_of_every_spelling(self):
+        WeatherService.get_weather('Patna', None, 'IN')
+        WeatherService.get_weather('Delhi', None, 'IN')
+        demand_tracker.flush()
+        patna = WeatherCache.objects.get(city='PATNA')
+        for i, spelling in enumerate(['Patna', 'PATNA', 'patna , bihar']):
+            user = User.objects.create_user(f'user{i}', f'user{i}@example.com', 'pw', phone=str(i))
+            SearchHistory.objects.create(user=user, city_name_queried=spelling, weather=patna)
+
+        ranked = list(WeatherCache.objects.ranked_by_demand().values_list('city', 'searches', 'demand'))
+        self.assertEqual(ranked, [('PATNA', 3, 4), ('DELHI', 0, 1)])
+
+
+class HistoryWriterTests(TransactionTestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('alice', 'alice@example.com', 'pw', phone='1')
+        self.patna = WeatherCache.objects.create(city='PATNA', country='IN', data=payload('Patna', temp=30))
+
+    def writer(self, **kwargs):
+        # Only flushed by the test: the background thread waits for an hour or a huge batch
+        writer = HistoryWriter(**{'flush_interval': 3600, 'batch_size': 10000, **kwargs})
+        self.addCleanup(writer.stop)
+        return writer
+
+    def test_repeated_searches_are_coalesced(self):
+        writer = self.writer()
+        writer.enqueue(self.user.pk, 'Patna', self.patna.lookup_key, payload('Patna', temp=30))
+        writer.enqueue(self.user.pk, 'Patna', self.patna.lookup_key, payload('Patna', temp=31))
+        writer.enqueue(self.user.pk, 'Patna', self.patna.lookup_key, None)  # a 304: timestamp only
+        writer.enqueue(self.user.pk, 'Delhi', 'DELHI||IN', payload('Delhi', temp=25))
+
+        with self.assertNumQueries(4):  # BEGIN, the entries' ids, one bulk upsert, COMMIT
+            self.assertEqual(writer.flush(), 4)
+        rows = {row.city_name_queried: row for row in SearchHistory.objects.all()}
+        self.assertEqual(sorted(rows), ['Delhi', 'Patna'])
+        # The last full record wins; the later touch does not erase its snapshot
+        self.assertEqual(rows['Patna'].snapshot['main']['temp'], 31)
+        self.assertEqual(rows['Patna'].weather_id, self.patna.pk)
+        self.assertIsNone(rows['Delhi'].weather_id)
+        self.assertEqual(writer.stats(), {
+            'enqueued': 4, 'written': 4, 'dropped': 0, 'failed': 0, 'flushes': 1, 'pending': 0,
+        })
+
+    def test_touch_only_bumps_the_timestamp(self):
+        writer = self.writer()
+        writer.enqueue(self.user.pk, 'Patna', self.patna.lookup_key, payload('Patna', temp=30))
+        writer.flush()
+        before = SearchHistory.objects.get().timestamp
+        writer.enqueue(self.user.pk, 'Patna', self.patna.lookup_key, None)
+        writer.flush()
+        row = SearchHistory.objects.get()
+        self.assertGreater(row.timestamp, before)
+        self.assertEqual(row.snapshot['main']['temp'], 30)
+
+    def test_drops_are_counted_per_policy(self):
+        for policy, kept in [(DROP_NEWEST, ['A', 'B']), (DROP_OLDEST, ['B', 'C']), (BLOCK, ['A', 'B'])]:
+            with self.subTest(policy=policy):
+                SearchHistory.objects.all().delete()
+                writer = self.writer(max_size=2, drop_policy=policy, block_timeout=0.01)
+                accepted = [writer.enqueue(self.user.pk, city, self.patna.lookup_key, payload(city))
+                            for city in ('A', 'B', 'C')]
+                self.assertEqual(accepted, [True, True, policy == DROP_OLDEST])
+                self.assertEqual(writer.stats()['dropped'], 1)
+                with self.assertLogs('api.history', 'WARNING') as logs:
+                    writer.flush()
+                self.assertIn('dropped 1 records', logs.output[0])
+                self.assertEqual(sorted(SearchHistory.objects.values_list('city_name_queried', flat=True)), kept)
+
+    def test_pending_records_are_written_at_shutdown(self):
+        writer = self.writer()
+        writer.enqueue(self.user.pk, 'Patna', self.patna.lookup_key, payload('Patna'))
+        with mock.patch.object(history, 'history_writer', writer):
+            history._flush_at_exit()
+        self.assertEqual(writer.pending(), 0)
+        self.assertEqual(SearchHistory.objects.get().city_name_queried, 'Patna')
+
+    def test_a_failing_batch_is_counted_and_the_writer_keeps_going(self):
+        writer = self.writer()
+        writer.enqueue(self.user.pk, 'Patna', self.patna.lookup_key, payload('Patna'))
+        with mock.patch.object(HistoryWriter, '_upsert', side_effect=RuntimeError('disk full')):
+            with self.assertLogs('api.history', 'WARNING'):
+                writer.flush()
+        writer.enqueue(self.user.pk, 'Patna', self.patna.lookup_key, payload('Patna'))
+        writer.flush()
+        self.assertEqual((writer.stats()['failed'], writer.stats()['written']), (1, 1))
+        self.assertEqual(SearchHistory.objects.count(), 1)
+
+    def test_a_deleted_user_only_loses_their_own_records(self):
+        bob = User.objects.create_user('bob', 'bob@example.com', 'pw', phone='2')
+        writer = self.writer()
+        writer.enqueue(self.user.pk, 'Patna', self.patna.lookup_key, payload('Patna'))
+        writer.enqueue(bob.pk, 'Patna', self.patna.lookup_key, payload('Patna'))
+        writer.enqueue(bob.pk, 'Delhi', 'DELHI||IN', payload('Delhi'))
+        writer.enqueue(self.user.pk, 'Delhi', 'DELHI||IN', payload('Delhi'))
+        bob.delete()  # before the flush
+
+        with self.assertLogs('api.history', 'WARNING') as logs:
+            writer.flush()
+        self.assertEqual(len(logs.output), 2)
+        self.assertEqual(sorted(SearchHistory.objects.values_list('user_id', 'city_name_queried')),
+                         [(self.user.pk, 'Delhi'), (self.user.pk, 'Patna')])
+        self.assertEqual((writer.stats()['failed'], writer.stats()['written']), (2, 2))
+
+
+class GeoTests(SimpleTestCase):
+
+    def test_snap_to_grid(self):
+        self.assertEqual(snap_to_grid(25.614, 85.136), (25.61, 85.14))
+        self.assertEqual(snap_to_grid(0.1 + 0.2, 0), (0.3, 0.0))
+        # Longitude wraps into [-180, 180), latitude is clamped to the poles
+        self.assertEqual(snap_to_grid(10, 179.996), (10.0, -180.0))
+        self.assertEqual(snap_to_grid(-10, -180.004), (-10.0, -180.0))
+        self.assertEqual(snap_to_grid(89.99, 0, cell=0.7), (90.0, 0.0))
+
+    def test_grid_label_round_trip(self):
+        self.assertEqual(parse_grid_label(grid_label(25.61, -85.14)), (25.61, -85.14))
+        self.assertIsNone(parse_grid_label('BR'))
+        self.assertIsNone(parse_grid_label(None))
+
+    def test_bounding_box(self):
+        lat_range, lon_ranges = bounding_box(25.6, 85.1, 5)
+        self.assertAlmostEqual(lat_range[0], 25.555, places=3)
+        self.assertAlmostEqual(lat_range[1], 25.645, places=3)
+        self.assertEqual(len(lon_ranges), 1)
+        self.assertAlmostEqual(lon_ranges[0][0], 85.05, places=2)
+        self.assertAlmostEqual(lon_ranges[0][1], 85.15, places=2)
+
+    def test_bounding_box_at_the_antimeridian(self):
+        _, lon_ranges = bounding_box(0, 179.99, 5)
+        (east_low, east_high), (west_low, west_high) = lon_ranges
+        self.assertAlmostEqual(east_low, 179.945, places=3)
+        self.assertEqual((east_high, west_low), (180.0, -180.0))
+        self.assertAlmostEqual(west_high, -179.965, places=3)
+
+        _, lon_ranges = bounding_box(0, -179.99, 5)
+        (east_low, east_high), (west_low, west_high) = lon_ranges
+        self.assertAlmostEqual(east_low, 179.965, places=3)
+        self.assertEqual((east_high, west_low), (180.0, -180.0))
+        self.assertAlmostEqual(west_high, -179.945, places=3)
+
+    def test_bounding_box_at_the_poles(self):
+        for lat in (90, 89.99, -90, -89.99):
+            lat_range, lon_ranges = bounding_box(lat, 30, 5)
+            self.assertEqual(lon_ranges, [(-180.0, 180.0)])
+            self.assertTrue(-90.0 <= lat_range[0] < lat_range[1] <= 90.0)
+        self.assertEqual(bounding_box(90, 30, 5)[0][1], 90.0)
+        self.assertEqual(bounding_box(-90, 30, 5)[0][0], -90.0)
+
+
+class CoordinateLookupTests(StubProviderTestCase):
+
+    def setUp(self):
+        super().setUp()
+        throttles = mock.patch.object(WeatherView, 'throttle_classes', [])
+        throttles.start()
+        self.addCleanup(throttles.stop)
+
+    def test_coordinate_fetch_does_not_replace_the_city_row(self):
+        city_row = WeatherCache.objects.create(city='PATNA', country='IN', data=payload('Patna', temp=30.0))
+        # The provider names a point 50 km away after the same city
+        gps_payload = {**payload('Patna', temp=10.0), 'coord': {'lat': 26.05, 'lon': 85.1}}
+        client = mock.Mock(**{'get_current_weather.return_value': gps_payload})
+        with mock.patch('api.services.get_weather_client', return_value=client):
+            entry, status = WeatherService.get_weather_by_coords(26.05, 85.1)
+        self.assertEqual(status, CACHE_MISS)
+        self.assertEqual((entry.city, entry.state), ('PATNA', grid_label(26.05, 85.1)))
+
+        city_row.refresh_from_db()
+        self.assertEqual((city_row.lat, city_row.lon, city_row.data['main']['temp']), (25.6, 85.1, 30.0))
+        entry, _ = WeatherService.get_weather('Patna', None, 'IN')
+        self.assertEqual(entry.data['main']['temp'], 30.0)
+        self.assertEqual(WeatherCache.objects.count(), 2)
+
+    def test_grid_entries_are_refreshed_by_coordinates(self):
+        entry, _ = WeatherService.get_weather_by_coords(40.0, 85.1)
+        self.assertEqual((entry.city, entry.country), ('GRID 40.0 85.1', 'XX'))
+        refreshed = WeatherService.refresh_weather(entry.city, entry.state, entry.country)
+        self.assertEqual(self.stub.calls, 2)
+        self.assertEqual(make_cache_key(refreshed.city, refreshed.state, refreshed.country),
+                         make_cache_key(entry.city, entry.state, entry.country))
+        self.assertEqual(WeatherCache.objects.count(), 1)
+
+    def test_coordinate_revalidation_is_answered_with_304(self):
+        params = {'lat': 40.0, 'lon': 85.1}
+        response = self.client.get('/api/weather/', params)
+        self.assertEqual(response['X-Cache-Status'], 'MISS')
+        # A point nearby is answered by the same entry, so the client's copy is still current
+        with mock.patch.object(WeatherService, 'get_weather_by_coords') as get_weather_by_coords:
+            response = self.client.get('/api/weather/', {'lat': 40.001, 'lon': 85.1},
+                                       HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        get_weather_by_coords.assert_not_called()
+        self.assertEqual(self.stub.calls, 1)
+
+    @override_settings(WEATHER_CACHE_MINUTES=0)
+    def test_expired_coordinate_entry_is_served_while_revalidating(self):
+        WeatherService.get_weather_by_coords(40.0, 85.1)
+        entry, status = WeatherService.get_weather_by_coords(40.001, 85.1)
+        self.assertEqual((status, entry.city), (CACHE_STALE, 'GRID 40.0 85.1'))
+        deadline = time.monotonic() + 5
+        while self.stub.calls < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.stub.calls, 2)
+
+
+class MetricsViewTests(SimpleTestCase):
+
+    def test_refused_without_a_token_or_allowlist(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.0.0.7').status_code, 403)
+
+    @override_settings(WEATHER_METRICS_ALLOWED_IPS=['127.0.0.1'])
+    def test_allowlist_admits_direct_connections_only(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 200)
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.0.0.7').status_code, 403)
+        # A reverse proxy on the same host connects from loopback on behalf of anyone
+        for header in ('HTTP_X_FORWARDED_FOR', 'HTTP_X_REAL_IP', 'HTTP_FORWARDED'):
+            self.assertEqual(self.client.get('/metrics', **{header: '203.0.113.9'}).status_code, 403)
+
+    @override_settings(WEATHER_METRICS_TOKEN='s3cret')
+    def test_token_is_required(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 401)
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer s3cret', HTTP_X_FORWARDED_FOR='203.0.113.9')
+        self.assertEqual(response.status_code, 200)
+
+class SearchHistoryPaginationTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('reader', 'reader@example.com', 'pw', phone='1')
+        self.api = APIClient()
+        self.api.force_authenticate(self.user)
+        self.weather = WeatherCache.objects.create(city='PATNA', country='IN', data=payload('Patna'))
+        now = timezone.now()
+        # Three timestamps with three rows each: pages have to break ties on id
+        for i in range(9):
+            SearchHistory.objects.create(user=self.user, city_name_queried=f'CITY{i}', weather=self.weather)
+        for i, row in enumerate(SearchHistory.objects.order_by('id')):
+            SearchHistory.objects.filter(pk=row.pk).update(timestamp=now - timedelta(minutes=i // 3))
+        self.newest_first = list(SearchHistory.objects.order_by('-timestamp', '-id').values_list('id', flat=True))
+
+    def get(self, url='/api/history/', **params):
+        response = self.api.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def ids(self, response):
+        return [row['id'] for row in response.json()['results']]
+
+    def test_next_links_walk_every_row_once_across_ties(self):
+        seen, response = [], self.get(page_size=2)
+        self.assertIsNone(response.json()['previous'])
+        while True:
+            seen += self.ids(response)
+            if response.json()['next'] is None:
+                break
+            response = self.get(response.json()['next'])
+        self.assertEqual(seen, self.newest_first)
+
+    def test_previous_link_returns_to_the_same_page(self):
+        first = self.get(page_size=4)
+        second = self.get(first.json()['next'])
+        self.assertEqual(self.ids(second), self.newest_first[4:8])
+        back = self.get(second.json()['previous'])
+        self.assertEqual(self.ids(back), self.ids(first))
+        self.assertIsNone(back.json()['previous'])
+        self.assertEqual(self.ids(self.get(back.json()['next'])), self.ids(second))
+
+    def test_invalid_cursor_is_not_found(self):
+        self.assertEqual(self.api.get('/api/history/', {'cursor': 'bogus'}).status_code, 404)
+
+    def test_fields_projection(self):
+        response = self.get(fields='id,timestamp', page_size=3)
+        self.assertEqual([set(row) for row in response.json()['results']], [{'id', 'timestamp'}] * 3)
+        response = self.get(fields='city_name_queried,response_data', page_size=1)
+        self.assertEqual(response.json()['results'], [{'city_name_queried': 'CITY2', 'response_data': payload('Patna')}])
+        self.assertEqual(self.api.get('/api/history/', {'fields': 'id,password'}).status_code, 400)
+
+    def test_page_and_etag_come_from_one_query(self):
+        for fields in ('id,timestamp', 'id,response_data'):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.get(fields=fields)
+            self.assertEqual(len([q for q in queries if 'api_searchhistory' in q['sql']]), 1)
+            not_modified = self.api.get('/api/history/', {'fields': fields}, HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(not_modified.status_code, 304)
+
+    def test_etag_changes_with_the_page(self):
+        etag = self.get(fields='id,response_data')['ETag']
+        self.weather.save()  # new entry version
+        self.assertNotEqual(self.get(fields='id,response_data')['ETag'], etag)
+        etag = self.get()['ETag']
+        SearchHistory.objects.filter(pk=self.newest_first[0]).delete()
+        self.assertNotEqual(self.get()['ETag'], etag)
+
+
+class HistoryReferenceMigrationTests(TransactionTestCase):
+    """
+    0006_searchhistory_weather_reference: history rows point at cache entries instead of
+    carrying the payload, and get it back when migrated in reverse.
+    """
+    before = [('api', '0005_weathercache_prerendered_body')]
+    after = [('api', '0006_searchhistory_weather_reference')]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def setUp(self):
+        latest = MigrationExecutor(connection).loader.graph.leaf_nodes('api')
+        self.addCleanup(self.migrate, latest)
+        apps = self.migrate(self.before)
+        WeatherCache = apps.get_model('api', 'WeatherCache')
+        SearchHistory = apps.get_model('api', 'SearchHistory')
+        user = apps.get_model('api', 'User').objects.create(username='old', email='old@example.com', phone='1')
+
+        full = {**payload('Patna'), 'weather': [{'main': 'Rain', 'description': 'light rain', 'id': 500}], 'wind': {}}
+        self.patna = WeatherCache.objects.create(city='PATNA', country='IN', lookup_key='PATNA||IN', data=full).pk
+        self.delhi = WeatherCache.objects.create(city='DELHI', country='IN', lookup_key='DELHI||IN',
+                                                 data=payload('Delhi')).pk
+        self.rows = {
+            # By the payload's canonical name and country, whatever was typed
+            'canonical': SearchHistory.objects.create(user=user, city_name_queried='patna, bihar', response_data=full),
+            # No name in the payload: by the queried name
+            'queried': SearchHistory.objects.create(user=user, city_name_queried='Delhi', response_data={'cod': 200}),
+            # No entry left for the city: snapshot only
+            'orphan': SearchHistory.objects.create(user=user, city_name_queried='Goa', response_data=payload('Goa')),
+        }
+
+    def test_forward_links_rows_and_keeps_snapshots(self):
+        apps = self.migrate(self.after)
+        rows = {row.pk: row for row in apps.get_model('api', 'SearchHistory').objects.all()}
+        canonical, queried, orphan = (rows[self.rows[name].pk] for name in ('canonical', 'queried', 'orphan'))
+
+        self.assertEqual(canonical.weather_id, self.patna)
+        self.assertEqual(canonical.snapshot, {
+            'name': 'Patna', 'sys': {'country': 'IN'}, 'main': {'temp': 20.0},
+            'weather': [{'main': 'Rain', 'description': 'light rain'}],
+        })
+        self.assertEqual((queried.weather_id, queried.snapshot), (self.delhi, {'cod': 200}))
+        self.assertEqual((orphan.weather_id, orphan.snapshot['name']), (None, 'Goa'))
+
+    def test_reverse_restores_response_data(self):
+        self.migrate(self.after)
+        apps = self.migrate(self.before)
+        rows = {row.pk: row.response_data for row in apps.get_model('api', 'SearchHistory').objects.all()}
+        # Linked rows get their entry's payload back, the others their snapshot
+        self.assertEqual(rows[self.rows['canonical'].pk]['weather'][0]['id'], 500)
+        self.assertEqual(rows[self.rows['queried'].pk], payload('Delhi'))
+        self.assertEqual(rows[self.rows['orphan'].pk], {
+            'name': 'Goa', 'sys': {'country': 'IN'}, 'main': {'temp': 20.0},
+        })
+
+
+@override_settings(WEATHER_CACHE_MINUTES=30, WEATHER_CACHE_RETENTION_MINUTES=60, WEATHER_CACHE_EVICTION_GRACE_MINUTES=10)
+class RetentionSweeperTests(TransactionTestCase):
+
+    def make_rows(self, count, age_minutes, prefix='CITY', **fields):
+        rows = [
+            WeatherCache.objects.create(city=f'{prefix}{i}', country='IN', data=payload(f'{prefix}{i}'))
+            for i in range(count)
+        ]
+        WeatherCache.objects.filter(pk__in=[row.pk for row in rows]).update(
+            updated_at=timezone.now() - timedelta(minutes=age_minutes), **fields,
+        )
+        return rows
+
+    def deletes(self, queries):
+        return [q for q in queries if q['sql'].startswith('DELETE FROM "api_weathercache"')]
+
+    def test_expired_rows_are_deleted_in_batches(self):
+        expired = self.make_rows(7, age_minutes=91, prefix='OLD')
+        kept = self.make_rows(2, age_minutes=89)
+        user = User.objects.create_user('reader', 'reader@example.com', 'pw', phone='1')
+        history = SearchHistory.objects.create(user=user, city_name_queried='old0', weather=expired[0],
+                                               snapshot={'name': 'Old0'})
+
+        with CaptureQueriesContext(connection) as queries:
+            deleted, unlinked = RetentionSweeper(batch_size=3).delete_expired()
+        self.assertEqual((deleted, unlinked), (7, 1))
+        self.assertEqual(len(self.deletes(queries)), 3)
+        self.assertEqual(set(WeatherCache.objects.values_list('pk', flat=True)), {row.pk for row in kept})
+        history.refresh_from_db()
+        self.assertEqual((history.weather_id, history.snapshot), (None, {'name': 'Old0'}))
+
+    def test_cap_evicts_the_least_requested_rows(self):
+        now = timezone.now()
+        rows = self.make_rows(5, age_minutes=20)
+        for row, hits, accessed in zip(rows, [9, 1, 1, 0, 5], [now, now, now - timedelta(hours=1), None, now]):
+            WeatherCache.objects.filter(pk=row.pk).update(hit_count=hits, last_accessed_at=accessed)
+
+        evicted, _ = RetentionSweeper(max_rows=2, batch_size=2).enforce_cap()
+        self.assertEqual(evicted, 3)
+        self.assertEqual(set(WeatherCache.objects.values_list('city', flat=True)), {'CITY0', 'CITY4'})
+
+    def test_new_rows_are_never_evicted(self):
+        self.make_rows(3, age_minutes=5, prefix='NEW')
+        self.make_rows(2, age_minutes=20, hit_count=100)
+        evicted, _ = RetentionSweeper(max_rows=1).enforce_cap()
+        self.assertEqual(evicted, 2)
+        self.assertEqual(sorted(WeatherCache.objects.values_list('city', flat=True)), ['NEW0', 'NEW1', 'NEW2'])
+
+    def test_hit_counts_are_halved_once_per_half_life(self):
+        self.make_rows(5, age_minutes=0, hit_count=9)
+        sweeper = RetentionSweeper(hit_half_life=timedelta(days=1), interval=60, batch_size=2)
+        midnight = datetime(2026, 10, 18, tzinfo=dt_timezone.utc)
+
+        self.assertEqual(sweeper.decay_hits(now=midnight - timedelta(hours=1)), 0)
+        # The first sweep of a process looks back one interval: 23:59:30 to 00:00:30 crosses midnight
+        sweeper.last_swept_at = None
+        self.assertEqual(sweeper.decay_hits(now=midnight + timedelta(seconds=30)), 5)
+        self.assertEqual(sweeper.decay_hits(now=midnight + timedelta(hours=23)), 0)
+        self.assertEqual(set(WeatherCache.objects.values_list('hit_count', flat=True)), {4})
+        self.assertEqual(sweeper.decay_hits(now=midnight + timedelta(days=1, seconds=1)), 5)
+        self.assertEqual(set(WeatherCache.objects.values_list('hit_count', flat=True)), {2})
+
+    @override_settings(WEATHER_CACHE_STALE_IF_ERROR_MINUTES=15)
+    def test_command_defaults_to_the_sweeper_settings(self):
+        del settings.WEATHER_CACHE_RETENTION_MINUTES
+        self.make_rows(1, age_minutes=46, prefix='OLD')
+        self.make_rows(1, age_minutes=44)
+        call_command('sweep_weather_cache', '--once', '--json', stdout=io.StringIO())
+        self.assertEqual(list(WeatherCache.objects.values_list('city', flat=True)), ['CITY0'])
+
+
+class WeatherBatchEndpointTests(StubProviderTestCase):
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        throttle_settings = self.settings(WEATHER_THROTTLE_DB=os.path.join(directory.name, 'throttle.sqlite3'))
+        throttle_settings.enable()
+        self.addCleanup(throttle_settings.disable)
+        user = User.objects.create_user('dashboard', 'dashboard@example.com', 'pw', phone='1')
+        self.api = APIClient()
+        self.api.force_authenticate(user)
+
+    def post(self, *locations):
+        response = self.api.post('/api/weather/batch/', {'locations': [
+            {'city': city, 'state': state, 'country': country} for city, state, country in locations
+        ]}, format='json')
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_duplicate_locations_are_fetched_once(self):
+        body = self.post(('Patna', 'Bihar', 'IN'), (' patna ', 'bihar', 'in'), ('Gaya', 'Bihar', 'IN'))
+        self.assertEqual(set(body['results']), {'PATNA,BIHAR,IN', 'GAYA,BIHAR,IN'})
+        self.assertEqual(body['summary'], {'requested': 2, 'cache_hits': 0, 'fetched': 2, 'failed': 0})
+        self.assertEqual(self.stub.calls, 2)
+
+        body = self.post(('Patna', 'Bihar', 'IN'), ('Gaya', 'Bihar', 'IN'))
+        self.assertEqual(body['summary']['cache_hits'], 2)
+        self.assertEqual(self.stub.calls, 2)
+
+    def test_aliases_share_one_fetch(self):
+        body = self.post(('Bombay', 'Maharashtra', 'IN'), ('Mumbai', 'Maharashtra', 'IN'))
+        bombay, mumbai = body['results']['BOMBAY,MAHARASHTRA,IN'], body['results']['MUMBAI,MAHARASHTRA,IN']
+        self.assertEqual((bombay['status'], bombay['data']['name']), (200, 'Mumbai'))
+        self.assertEqual(bombay, mumbai)
+        self.assertEqual(self.stub.calls, 1)
+
+    @override_settings(WEATHER_GAZETTEER_REJECT_UNKNOWN=True)
+    def test_each_location_gets_its_own_status(self):
+        body = self.post(('Patna', 'Bihar', 'IN'), ('Patnaa', 'Bihar', 'IN'))
+        self.assertEqual(body['results']['PATNA,BIHAR,IN']['status'], 200)
+        unknown = body['results']['PATNAA,BIHAR,IN']
+        self.assertEqual(unknown['status'], 404)
+        self.assertIn('PATNA', [suggestion['name'].upper() for suggestion in unknown['suggestions']])
+        self.assertEqual(body['summary'], {'requested': 2, 'cache_hits': 0, 'fetched': 1, 'failed': 1})
+        self.assertEqual(self.stub.calls, 1)
+
+    def test_upstream_errors_are_negatively_cached(self):
+        for _ in range(2):
+            body = self.post(('Nowhere', 'X', 'IN'), ('Patna', 'Bihar', 'IN'))
+            self.assertEqual(body['results']['NOWHERE,X,IN']['status'], 404)
+            self.assertEqual(body['results']['PATNA,BIHAR,IN']['status'], 200)
+        self.assertEqual(self.stub.calls, 2)
+
+    def test_batch_and_single_request_share_the_upstream_call(self):
+        self.stub.server.latency = 0.3
+        single = threading.Thread(target=WeatherService.get_weather, args=('Patna', 'Bihar', 'IN'))
+        single.start()
+        time.sleep(0.1)
+        body = self.post(('Patna', 'Bihar', 'IN'))
+        single.join()
+        self.assertEqual(body['results']['PATNA,BIHAR,IN']['status'], 200)
+        self.assertEqual(self.stub.calls, 1)
+
+    def test_each_upstream_miss_is_charged_to_the_request_throttle(self):
+        cities = [('Patna', 'Bihar', 'IN'), ('Gaya', 'Bihar', 'IN'), ('Muzaffarpur', 'Bihar', 'IN'),
+                  ('Bhagalpur', 'Bihar', 'IN'), ('Mumbai', 'Maharashtra', 'IN')]
+        with mock.patch.object(WeatherUserThrottle, 'THROTTLE_RATES', {'weather_burst': '3/min'}):
+            body = self.post(*cities)
+            statuses = sorted(result['status'] for result in body['results'].values())
+            self.assertEqual(statuses, [200, 200, 200, 429, 429])
+            self.assertEqual(self.stub.calls, 3)
+            self.assertTrue(all(result['retry_after'] > 0 for result in body['results'].values()
+                                if result['status'] == 429))
+
+            # Cache hits cost nothing; the single endpoint shares the used-up allowance
+            cached = [city for city in cities if body['results'][','.join(city).upper()]['status'] == 200]
+            self.assertEqual(self.post(*cached)['summary']['cache_hits'], 3)
+            with mock.patch.object(WeatherView, 'throttle_classes', [WeatherUserThrottle]):
+                response = self.api.get('/api/weather/', {'city': 'Delhi', 'state': 'Delhi', 'country': 'IN'})
+            self.assertEqual(response.status_code, 429)
+
+
+class GazetteerTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.seed = os.path.join(directory.name, 'cities.tsv')
+        with open(gazetteer_source(), encoding='utf-8') as source, open(self.seed, 'w', encoding='utf-8') as seed:
+            seed.write(source.read())
+        self.index = os.path.join(directory.name, 'gazetteer.idx')
+        gazetteer_settings = self.settings(WEATHER_GAZETTEER_SOURCE=self.seed, WEATHER_GAZETTEER_INDEX=self.index)
+        gazetteer_settings.enable()
+        self.addCleanup(gazetteer_settings.disable)
+        reset_gazetteer()
+        self.addCleanup(reset_gazetteer)
+
+    def test_complete_ranks_by_population_and_matches_alternate_names(self):
+        gazetteer = get_gazetteer()
+        self.assertEqual([city.name for city in gazetteer.complete('pat', 'IN')], ['Patna'])
+        self.assertEqual([city.name for city in gazetteer.complete('bom')], ['Mumbai'])
+        names = [city.name for city in gazetteer.complete('m', 'IN', limit=3)]
+        self.assertEqual(names[0], 'Mumbai')
+        self.assertEqual(len(names), 3)
+        self.assertEqual(gazetteer.complete('   '), [])
+
+    def test_precomputed_prefixes_rank_like_a_scan(self):
+        scanned = get_gazetteer()
+        precomputed_path = os.path.join(os.path.dirname(self.index), 'precomputed.idx')
+        build_index(read_seed(self.seed), precomputed_path, scan_limit=1)
+        precomputed = Gazetteer(precomputed_path)
+        self.addCleanup(precomputed.close)
+        self.assertGreater(precomputed.n_prefixes, scanned.n_prefixes)
+        for prefix, country in (('m', None), ('b', 'IN'), ('s', None), ('pa', None)):
+            self.assertEqual(precomputed.complete(prefix, country), scanned.complete(prefix, country))
+
+    def test_lookup_and_suggest(self):
+        gazetteer = get_gazetteer()
+        self.assertEqual([(city.name, city.state) for city in gazetteer.lookup('bombay', 'IN')], [('Mumbai', 'Maharashtra')])
+        self.assertEqual([city.country for city in gazetteer.lookup('Hyderabad')], ['IN', 'PK'])
+        self.assertEqual(gazetteer.lookup('Springfield', 'IN'), [])
+        self.assertIn('Patna', [city.name for city in gazetteer.suggest('Patnaa', 'IN')])
+        self.assertEqual(gazetteer.suggest('Zzyzx'), [])
+
+    def test_only_iso_codes_narrow_canonicalization(self):
+        self.assertEqual(WeatherService.canonicalize_location('BOMBAY', None, 'IN'), ('MUMBAI', None, 'IN'))
+        self.assertEqual(WeatherService.canonicalize_location('HYDERABAD', 'SINDH', 'PK'), ('HYDERABAD', 'SINDH', 'PK'))
+        for country in ('USA', 'INDIA'):
+            self.assertEqual(WeatherService.canonicalize_location('BOMBAY', None, country), ('BOMBAY', None, country))
+        with self.settings(WEATHER_GAZETTEER_REJECT_UNKNOWN=True):
+            self.assertEqual(WeatherService.canonicalize_location('NOWHERE', None, 'INDIA'), ('NOWHERE', None, 'INDIA'))
+            with self.assertRaises(UnknownCityError):
+                WeatherService.canonicalize_location('NOWHERE', None, 'IN')
+
+    def test_index_is_rebuilt_when_the_seed_changes(self):
+        self.assertEqual(get_gazetteer().lookup('Rajgir'), [])
+        stamp = get_gazetteer().stamp
+        with open(self.seed, 'a', encoding='utf-8') as seed:
+            seed.write('Rajgir\tRajgir\t\tIN\tBihar\t41587\t25.0268\t85.4166\n')
+        os.utime(self.seed, ns=(stamp[0] + 10**9, stamp[0] + 10**9))
+
+        reset_gazetteer()
+        self.assertEqual([city.name for city in get_gazetteer().lookup('Rajgir')], ['Rajgir'])
+        self.assertEqual(get_gazetteer().stamp, source_stamp(self.seed))
+
+    def test_indexes_from_other_sources_are_kept(self):
+        build_index([('Rajgir', [], 'IN', 'Bihar', 41587, 25.0268, 85.4166)], self.index)
+        self.assertEqual(len(get_gazetteer()), 1)
+
+    def test_unreadable_index_is_rebuilt_from_the_seed(self):
+        with open(self.index, 'wb') as f:
+            f.write(b'WGAZ0001' + bytes(64))
+        with self.assertLogs('api.gazetteer', 'WARNING'):
+            gazetteer = get_gazetteer()
+        self.assertEqual([city.name for city in gazetteer.lookup('Patna')], ['Patna'])
+
+
+@override_settings(WEATHER_GAZETTEER_REJECT_UNKNOWN=True)
+class CityEndpointTests(StubProviderTestCase):
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        throttle_settings = self.settings(WEATHER_THROTTLE_DB=os.path.join(directory.name, 'throttle.sqlite3'))
+        throttle_settings.enable()
+        self.addCleanup(throttle_settings.disable)
+        self.api = APIClient()
+
+    def test_autocomplete(self):
+        response = self.api.get('/api/cities/', {'q': 'bom', 'country': 'in'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([city['name'] for city in response.json()['results']], ['Mumbai'])
+        self.assertEqual(response.json()['results'][0]['state'], 'Maharashtra')
+        self.assertIn('public', response['Cache-Control'])
+
+        self.assertEqual(len(self.api.get('/api/cities/', {'q': 'm', 'limit': 2}).json()['results']), 2)
+        response = self.api.get('/api/cities/', {'q': 'm', 'limit': 100})
+        self.assertLessEqual(len(response.json()['results']), CityAutocompleteView.max_limit)
+        self.assertEqual(self.api.get('/api/cities/', {'q': ' '}).status_code, 400)
+        self.assertEqual(self.api.get('/api/cities/', {'q': 'm', 'limit': 'x'}).status_code, 400)
+
+    def test_unknown_city_is_answered_locally_with_suggestions(self):
+        response = self.api.get('/api/weather/', {'city': 'Patnaa', 'state': 'Bihar', 'country': 'IN'})
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json()['error'], 'Unknown city: PATNAA.')
+        self.assertIn('Patna', [city['name'] for city in response.json()['suggestions']])
+        self.assertEqual(self.stub.calls, 0)
+
+        response = self.api.get('/api/weather/', {'city': 'Bombay', 'state': 'Maharashtra', 'country': 'IN'})
+        self.assertEqual((response.status_code, response.json()['name']), (200, 'Mumbai'))
+        self.assertEqual(self.stub.calls, 1)
+
+
+@override_settings(WEATHER_HISTORY_WRITE_BEHIND=False)
+class StatelessAuthenticationTests(StubProviderTestCase):
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        throttle_settings = self.settings(WEATHER_THROTTLE_DB=os.path.join(directory.name, 'throttle.sqlite3'))
+        throttle_settings.enable()
+        self.addCleanup(throttle_settings.disable)
+        user_status_cache.clear()
+        self.addCleanup(user_status_cache.clear)
+        self.user = User.objects.create_user('reader', 'reader@example.com', 'pw', phone='1')
+        self.api = APIClient()
+
+    def get(self, token):
+        self.api.credentials(HTTP_AUTHORIZATION=f'Bearer {token}')
+        return self.api.get('/api/weather/', {'city': 'Patna', 'state': 'Bihar', 'country': 'IN'})
+
+    def test_requests_make_no_user_queries(self):
+        token = RefreshToken.for_user(self.user).access_token
+        self.assertEqual(self.get(token).status_code, 200)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.get(token).status_code, 200)
+        self.assertEqual([query['sql'] for query in queries if 'api_user' in query['sql']], [])
+        self.assertEqual((user_status_cache.hits, user_status_cache.misses), (1, 1))
+
+    def test_inactive_and_deleted_users_are_rejected(self):
+        token = RefreshToken.for_user(self.user).access_token
+        self.assertEqual(self.get(token).status_code, 200)
+
+        self.user.is_active = False
+        self.user.save()
+        response = self.get(token)
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.json()['detail'], 'User is inactive')
+
+        self.user.delete()
+        response = self.get(token)
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.json()['detail'], 'User not found')
+
+    def test_password_change_revokes_old_tokens(self):
+        with mock.patch.object(jwt_settings, 'CHECK_REVOKE_TOKEN', True):
+            token = RefreshToken.for_user(self.user).access_token
+            self.assertEqual(self.get(token).status_code, 200)
+
+            self.user.set_password('new password')
+            self.user.save()
+            response = self.get(token)
+            self.assertEqual(response.status_code, 401)
+            self.assertEqual(response.json()['detail'], "The user's password has been changed.")
+            self.assertEqual(self.get(RefreshToken.for_user(self.user).access_token).status_code, 200)
+
+    def test_user_signals_invalidate_the_cached_status(self):
+        self.assertTrue(user_status_cache.get(self.user.pk).is_active)
+        # Bypasses the signals: the cached status is served until its TTL
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        self.assertTrue(user_status_cache.get(self.user.pk).is_active)
+
+        self.user.is_active = False
+        self.user.save()
+        self.assertFalse(user_status_cache.get(self.user.pk).is_active)
+
+        user_id = self.user.pk
+        self.user.delete()
+        self.assertIsNone(user_status_cache.get(user_id))
+        self.assertEqual(user_status_cache.misses, 3)
+
+
+@override_settings(WEATHER_NEGATIVE_CACHE_NOT_FOUND_SECONDS=300, WEATHER_NEGATIVE_CACHE_ERROR_SECONDS=5)
+class NegativeCacheTests(StubProviderTestCase):
+
+    @staticmethod
+    def upstream_error(status_code):
+        response = requests.Response()
+        response.status_code, response.reason, response._content = status_code, 'Error', b'{}'
+        return requests.exceptions.HTTPError(f"{status_code} Error", response=response)
+
+    def test_errors_are_kept_for_their_own_ttl(self):
+        negative = NegativeCache()
+        now = time.time()
+        with mock.patch('api.cache.time') as clock:
+            clock.time.return_value = now
+            negative.remember('NOT FOUND', self.upstream_error(404))
+            negative.remember('UNAVAILABLE', self.upstream_error(503))
+            negative.remember('BAD REQUEST', self.upstream_error(400))
+            negative.remember('NO RESPONSE', requests.exceptions.ConnectionError())
+            self.assertEqual(negative.get('NOT FOUND').status_code, 404)
+            self.assertEqual(negative.get('UNAVAILABLE').status_code, 503)
+            self.assertIsNone(negative.get('BAD REQUEST'))
+            self.assertIsNone(negative.get('NO RESPONSE'))
+
+            clock.time.return_value = now + 5
+            self.assertIsNone(negative.get('UNAVAILABLE'))
+            self.assertIsNotNone(negative.get('NOT FOUND'))
+            clock.time.return_value = now + 300
+            self.assertIsNone(negative.get('NOT FOUND'))
+        self.assertEqual(negative.stats()['not_found'], 1)
+        self.assertEqual(negative.stats()['errors'], 1)
+
+    def test_negative_hits_make_no_upstream_call(self):
+        for _ in range(3):
+            with self.assertRaises(requests.exceptions.HTTPError) as raised:
+                WeatherService.get_weather('Nowhere', None, 'IN')
+            self.assertEqual(raised.exception.response.status_code, 404)
+        self.assertEqual(self.stub.calls, 1)
+
+        self.stub.server.error_rate = 1.0
+        with self.assertRaises(requests.exceptions.HTTPError):
+            WeatherService.get_weather('Patna', 'Bihar', 'IN')
+        calls = self.stub.calls
+        with self.assertRaises(requests.exceptions.HTTPError) as raised:
+            WeatherService.get_weather('Patna', 'Bihar', 'IN')
+        self.assertEqual(raised.exception.response.status_code, 503)
+        self.assertEqual(self.stub.calls, calls)
+
+    def test_successful_write_clears_the_error(self):
+        self.stub.server.error_rate = 1.0
+        with self.assertRaises(requests.exceptions.HTTPError):
+            WeatherService.get_weather('Patna', 'Bihar', 'IN')
+        self.assertIsNotNone(get_weather_cache().negative.get(make_cache_key('PATNA', 'BIHAR', 'IN')))
+
+        # A later successful fetch (e.g. the prefetcher) stores the entry
+        self.stub.server.error_rate = 0
+        WeatherService._fetch_from_provider('PATNA', 'BIHAR', 'IN')
+        self.assertIsNone(get_weather_cache().negative.get(make_cache_key('PATNA', 'BIHAR', 'IN')))
+        calls = self.stub.calls
+        self.assertEqual(WeatherService.get_weather('Patna', 'Bihar', 'IN')[0].data['name'], 'Patna')
+        self.assertEqual(self.stub.calls, calls)
+
+
+@override_settings(WEATHER_CACHE_PRERENDER=True, WEATHER_CACHE_COMPRESS_MIN_BYTES=0)
+class PrerenderedResponseTests(SimpleTestCase):
+    BODIES = {'br': b'brotli bytes', 'gzip': b'gzip bytes'}
+
+    def test_negotiate_encoding(self):
+        for accept_encoding, expected in (
+            ('gzip, deflate, br', 'br'),
+            ('gzip', 'gzip'),
+            ('GZIP , br;q=0', 'gzip'),
+            ('br;q=0.5, gzip;q=0.8', 'gzip'),
+            ('br;q=0.8, gzip;q=0.8', 'br'),
+            ('*', 'br'),
+            ('*;q=0, gzip', 'gzip'),
+            ('br;q=0, gzip;q=0', None),
+            ('gzip;q=x', None),
+            ('identity', None),
+            ('', None),
+        ):
+            with self.subTest(accept_encoding):
+                self.assertEqual(negotiate_encoding(accept_encoding, self.BODIES), expected)
+        self.assertIsNone(negotiate_encoding('gzip', {}))
+
+    def entry(self, data=None):
+        return CacheEntry(data=data or payload('Patna'), updated_at=timezone.now(), city='PATNA', state=None,
+                          country='IN')
+
+    def respond(self, entry, accept_encoding=None):
+        headers = {'HTTP_ACCEPT_ENCODING': accept_encoding} if accept_encoding is not None else {}
+        return prerendered_response(APIRequestFactory().get('/api/weather/', **headers), entry)
+
+    def test_serves_the_stored_variant(self):
+        entry = self.entry({**payload('Patna'), 'hourly': [payload('Patna')] * 10}).prerendered()
+        self.assertEqual(entry.body, render_body(entry.data))
+        self.assertEqual(gzip.decompress(entry.encoded_bodies['gzip']), entry.body)
+
+        response = self.respond(entry, 'gzip, deflate')
+        self.assertEqual((response['Content-Encoding'], response.content), ('gzip', entry.encoded_bodies['gzip']))
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertEqual(response['Content-Type'], 'application/json')
+
+        response = self.respond(entry)
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(response.content, entry.body)
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+
+    def test_falls_back_when_a_variant_is_missing(self):
+        body = render_body(payload('Patna'))
+        row = WeatherCache(city='PATNA', country='IN', data=payload('Patna'), updated_at=timezone.now(), body=body,
+                           body_gzip=gzip.compress(body), body_br=None)
+        entry = CacheEntry.from_model(row)
+        self.assertEqual(list(entry.encoded_bodies), ['gzip'])
+        self.assertEqual(self.respond(entry, 'br, gzip')['Content-Encoding'], 'gzip')
+
+        response = self.respond(entry, 'br')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(response.content, body)
+
+    def test_entries_without_a_body_are_rendered_by_the_view(self):
+        self.assertIsNone(self.respond(self.entry(), 'gzip'))
+        with self.settings(WEATHER_CACHE_PRERENDER=False):
+            self.assertIsNone(self.respond(self.entry().prerendered(), 'gzip'))
+
+
+class ConditionalWeatherTests(StubProviderTestCase):
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        throttle_settings = self.settings(WEATHER_THROTTLE_DB=os.path.join(directory.name, 'throttle.sqlite3'))
+        throttle_settings.enable()
+        self.addCleanup(throttle_settings.disable)
+        self.api = APIClient()
+
+    def get(self, **headers):
+        return self.api.get('/api/weather/', {'city': 'Patna', 'state': 'Bihar', 'country': 'IN'}, **headers)
+
+    def test_matching_etag_is_answered_without_loading_the_payload(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        with mock.patch.object(WeatherService, 'get_weather') as get_weather, \
+                CaptureQueriesContext(connection) as queries:
+            response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(response.content, b'')
+        get_weather.assert_not_called()
+        self.assertEqual([query['sql'] for query in queries if '"data"' in query['sql']], [])
+        self.assertEqual(self.stub.calls, 1)
+
+    def test_refresh_changes_the_etag(self):
+        etag = self.get()['ETag']
+        time.sleep(0.01)
+        WeatherService._fetch_from_provider('PATNA', 'BIHAR', 'IN')
+
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.json()['name'], 'Patna')
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        self.assertEqual(self.stub.calls, 2)
+
+
+class PrefetchSelectionTests(TestCase):
+    OPTIONS = {'top': 10, 'lead_minutes': 5, 'active_hours': 24, 'history_weight': 1}
+
+    def test_selects_due_entries_without_loading_their_bodies(self):
+        now = timezone.now()
+        for city in ('PATNA', 'GAYA'):
+            body = render_body(payload(city.title()))
+            WeatherCache.objects.create(city=city, state='BIHAR', country='IN', data=payload(city.title()), body=body,
+                                        body_gzip=gzip.compress(body), hit_count=3, last_accessed_at=now)
+        WeatherCache.objects.filter(city='PATNA').update(updated_at=now - timedelta(minutes=58))
+
+        with CaptureQueriesContext(connection) as queries:
+            due = PrefetchCommand().select_due(self.OPTIONS)
+        self.assertEqual([entry.city for entry in due], ['PATNA'])
+        self.assertTrue({'data', 'body', 'body_gzip', 'body_br'} <= due[0].get_deferred_fields())
+        self.assertFalse(any('"body' in query['sql'] or '"data"' in query['sql'] for query in queries))
+
+
+class DictTier(BaseCacheTier):
+    """
+    Lower tier for TieredWeatherCacheTests, holding whatever it is given.
+    """
+    name = 'dict'
+
+    def __init__(self):
+        self.entries = {}
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def set(self, key, entry):
+        self.entries[key] = entry
+        return entry
+
+
+@override_settings(WEATHER_CACHE_MINUTES=30, WEATHER_CACHE_STALE_WHILE_REVALIDATE_MINUTES=10,
+                   WEATHER_CACHE_STALE_IF_ERROR_MINUTES=0, WEATHER_CACHE_PRERENDER=False)
+class TieredWeatherCacheTests(SimpleTestCase):
+
+    @staticmethod
+    def entry(city, age_minutes=0):
+        return CacheEntry(data=payload(city.title()), updated_at=timezone.now() - timedelta(minutes=age_minutes),
+                          city=city, state=None, country='IN')
+
+    def test_local_tier_evicts_the_least_recently_used(self):
+        tier = LocalMemoryTier(max_entries=2)
+        for city in ('PATNA', 'GAYA'):
+            tier.set(make_cache_key(city), self.entry(city))
+        self.assertIsNotNone(tier.get(make_cache_key('PATNA')))
+        tier.set(make_cache_key('MUMBAI'), self.entry('MUMBAI'))
+
+        self.assertEqual(len(tier), 2)
+        self.assertIsNone(tier.get(make_cache_key('GAYA')))
+        self.assertIsNotNone(tier.get(make_cache_key('PATNA')))
+        self.assertIsNotNone(tier.get(make_cache_key('MUMBAI')))
+
+        disabled = LocalMemoryTier(max_entries=0)
+        disabled.set(make_cache_key('PATNA'), self.entry('PATNA'))
+        self.assertEqual(len(disabled), 0)
+
+    def test_local_tier_drops_entries_past_the_stale_window(self):
+        tier = LocalMemoryTier(max_entries=10)
+        tier.set(make_cache_key('PATNA'), self.entry('PATNA', age_minutes=35))
+        tier.set(make_cache_key('GAYA'), self.entry('GAYA', age_minutes=41))
+
+        stale = tier.get(make_cache_key('PATNA'))
+        self.assertFalse(stale.is_fresh)
+        self.assertIsNone(tier.get(make_cache_key('GAYA')))
+        self.assertEqual(len(tier), 1)
+
+    def test_lower_tier_hits_are_promoted(self):
+        local, lower = LocalMemoryTier(max_entries=10), DictTier()
+        weather_cache = TieredWeatherCache([local, lower])
+        lower.set(make_cache_key('PATNA'), self.entry('PATNA'))
+
+        self.assertEqual(weather_cache.get('PATNA').city, 'PATNA')
+        self.assertIsNotNone(local.get(make_cache_key('PATNA')))
+        self.assertEqual(weather_cache.get('PATNA').city, 'PATNA')
+        self.assertIsNone(weather_cache.get('GAYA'))
+
+        stats = weather_cache.stats()
+        self.assertEqual(stats['local'], {'hits': 1, 'misses': 2, 'hit_ratio': 0.3333, 'size': 1, 'max_entries': 10})
+        self.assertEqual(stats['dict'], {'hits': 1, 'misses': 1, 'hit_ratio': 0.5})
+        weather_cache.reset_stats()
+        self.assertEqual(weather_cache.stats()['local']['hit_ratio'], None)
+
+    def test_stale_entries_are_returned_but_not_promoted(self):
+        local, lower = LocalMemoryTier(max_entries=10), DictTier()
+        weather_cache = TieredWeatherCache([local, lower])
+        lower.set(make_cache_key('PATNA'), self.entry('PATNA', age_minutes=35))
+
+        self.assertIsNone(weather_cache.get('PATNA'))
+        self.assertFalse(weather_cache.get('PATNA', max_stale=timedelta(minutes=10)).is_fresh)
+        self.assertIsNone(weather_cache.get('PATNA', max_stale=timedelta(minutes=1)))
+        self.assertEqual(len(local), 0)
+        self.assertEqual(weather_cache.stats()['dict']['misses'], 3)
+
+    def test_set_writes_every_tier_slowest_first(self):
+        order = []
+        local, lower = LocalMemoryTier(max_entries=10), DictTier()
+        for tier in (local, lower):
+            tier.set = mock.Mock(side_effect=lambda key, entry, tier=tier: order.append(tier.name) or entry)
+        TieredWeatherCache([local, lower]).set('PATNA', None, 'IN', self.entry('PATNA'))
+        self.assertEqual(order, ['dict', 'local'])
+
+
+@override_settings(WEATHER_DB_LOCK_RETRIES=3, WEATHER_DB_LOCK_RETRY_DELAY=0)
+class RetryOnLockTests(SimpleTestCase):
+
+    def flaky(self, *errors):
+        """
+        A retry_on_lock-wrapped function raising `errors` in turn, then returning 'ok'.
+        """
+        calls = mock.Mock(side_effect=[*errors, 'ok'])
+
+        @retry_on_lock
+        def write():
+            return calls()
+        return write, calls
+
+    def test_retries_lock_errors(self):
+        write, calls = self.flaky(OperationalError('database is locked'), OperationalError('database table is locked'))
+        with self.assertLogs('api.db', 'WARNING') as logs:
+            self.assertEqual(write(), 'ok')
+        self.assertEqual(calls.call_count, 3)
+        self.assertEqual(len(logs.records), 2)
+
+    def test_gives_up_after_the_last_attempt(self):
+        write, calls = self.flaky(*[OperationalError('database is locked')] * 3)
+        with self.assertLogs('api.db', 'WARNING'), self.assertRaisesMessage(OperationalError, 'database is locked'):
+            write()
+        self.assertEqual(calls.call_count, 3)
+
+    def test_other_errors_are_not_retried(self):
+        write, calls = self.flaky(OperationalError('no such table: api_weathercache'))
+        with self.assertRaisesMessage(OperationalError, 'no such table'):
+            write()
+        self.assertEqual(calls.call_count, 1)
+
+        write, calls = self.flaky(ValueError('bad value'))
+        with self.assertRaises(ValueError):
+            write()
+        self.assertEqual(calls.call_count, 1)
+
+    def test_lock_errors_inside_a_transaction_are_raised(self):
+        write, calls = self.flaky(OperationalError('database is locked'))
+        with mock.patch('api.db.connection') as patched_connection, self.assertRaises(OperationalError):
+            patched_connection.in_atomic_block = True
+            write()
+        self.assertEqual(calls.call_count, 1)
+
+    def test_async_functions_are_retried(self):
+        calls = mock.Mock(side_effect=[OperationalError('database is locked'), 'ok'])
+
+        @retry_on_lock
+        async def write():
+            return calls()
+        with self.assertLogs('api.db', 'WARNING'):
+            self.assertEqual(asyncio.run(write()), 'ok')
+        self.assertEqual(calls.call_count, 2)
+
+    def test_postgres_serialization_failures_are_lock_errors(self):
+        error = OperationalError('could not serialize access')
+        error.__cause__ = Exception('could not serialize access')
+        error.__cause__.sqlstate = '40001'
+        self.assertTrue(is_lock_error(error))
+        self.assertFalse(is_lock_error(OperationalError('could not serialize access')))
+        self.assertFalse(is_lock_error(ValueError('database is locked')))
+
+
+class ListHandler(logging.Handler):
+    """
+    Collects the formatted records it is given, for LoggingTests.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.lines = []
+        self.setFormatter(JsonFormatter())
+
+    def emit(self, record):
+        self.lines.append(json.loads(self.format(record)))
+
+
+class LoggingTests(SimpleTestCase):
+
+    def make_record(self, level=logging.INFO, msg='Served %s', args=('PATNA',), exc_info=None, **extra):
+        record = logging.LogRecord('api.services', level, __file__, 1, msg, args, exc_info)
+        record.__dict__.update(extra)
+        return record
+
+    def test_json_formatter_writes_structured_fields(self):
+        record = self.make_record(city='PATNA', cache='HIT', status_code=200, state=None, request_id='req-1')
+        line = json.loads(JsonFormatter().format(record))
+        self.assertEqual(line, {
+            'time': datetime.fromtimestamp(record.created, dt_timezone.utc).isoformat(timespec='milliseconds'),
+            'level': 'INFO', 'logger': 'api.services', 'message': 'Served PATNA',
+            'request_id': 'req-1', 'city': 'PATNA', 'cache': 'HIT', 'status_code': 200,
+        })
+        self.assertTrue(line['time'].endswith('+00:00'))
+
+    def test_json_formatter_includes_the_traceback(self):
+        try:
+            raise ValueError('bad payload')
+        except ValueError:
+            record = self.make_record(logging.ERROR, 'Failed', (), sys.exc_info())
+        line = json.loads(JsonFormatter().format(record))
+        self.assertEqual(line['level'], 'ERROR')
+        self.assertIn('Traceback', line['exc'])
+        self.assertIn('ValueError: bad payload', line['exc'])
+
+    def test_sampling_filter_keeps_warnings_and_samples_the_rest(self):
+        sample = SamplingFilter(rate=0.25, level='INFO')
+        with mock.patch('core.logs.random.random', side_effect=[0.1, 0.9, 0.24, 0.25]):
+            kept = [sample.filter(self.make_record(logging.DEBUG)) for _ in range(4)]
+            warning = self.make_record(logging.WARNING)
+            self.assertTrue(sample.filter(warning))
+            self.assertTrue(sample.filter(self.make_record(logging.ERROR)))
+        self.assertEqual(kept, [True, False, True, False])
+        self.assertFalse(hasattr(warning, 'sample_rate'))
+
+        record = self.make_record(logging.DEBUG)
+        with mock.patch('core.logs.random.random', return_value=0.0):
+            sample.filter(record)
+        self.assertEqual(record.sample_rate, 0.25)
+
+        with mock.patch('core.logs.random.random') as rand:
+            self.assertTrue(SamplingFilter(rate=1).filter(self.make_record(logging.DEBUG)))
+        rand.assert_not_called()
+
+    def test_queue_handler_writes_through_the_sink_on_the_listener(self):
+        sink = logging.getLogger('api.tests.sink')
+        collected = ListHandler()
+        sink.addHandler(collected)
+        self.addCleanup(sink.removeHandler, collected)
+        source = logging.getLogger('api.tests.source')
+        source.propagate = False
+        self.addCleanup(setattr, source, 'propagate', True)
+        handler = QueueHandler('api.tests.sink', maxsize=100)
+        source.addHandler(handler)
+        self.addCleanup(source.removeHandler, handler)
+
+        token = current_request_id.set('req-2')
+        self.addCleanup(current_request_id.reset, token)
+        cities = ['PATNA']
+        source.warning('Fetched %s', cities, extra={'city': 'PATNA'})
+        cities.append('GAYA')
+        try:
+            raise ValueError('bad payload')
+        except ValueError:
+            source.exception('Failed')
+        self.assertEqual((collected.lines, handler.stats()['pending']), ([], 2))
+
+        handler.start()
+        handler.close()
+        self.assertEqual([line['message'] for line in collected.lines], ["Fetched ['PATNA']", 'Failed'])
+        self.assertEqual([line['request_id'] for line in collected.lines], ['req-2', 'req-2'])
+        self.assertEqual(collected.lines[0]['city'], 'PATNA')
+        self.assertIn('ValueError: bad payload', collected.lines[1]['exc'])
+
+    def test_full_queue_drops_records(self):
+        handler = QueueHandler('api.tests.sink', maxsize=2)
+        self.addCleanup(handler.close)
+        for _ in range(5):
+            handler.handle(self.make_record())
+        self.assertEqual(handler.stats(), {'pending': 2, 'capacity': 2, 'dropped': 3})
+
+    def test_settings_route_app_logs_through_the_queue(self):
+        for name in ('api', 'core', 'django'):
+            self.assertTrue(any(isinstance(handler, QueueHandler) for handler in logging.getLogger(name).handlers))
+        hits = logging.getLogger('api.services.hits')
+        self.assertTrue(any(isinstance(log_filter, SamplingFilter) for log_filter in hits.filters))
+        self.assertFalse(logging.getLogger('core.logs.sink').propagate)
+
+
+class BackgroundWriterShutdownTests(TransactionTestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('alice', 'alice@example.com', 'pw', phone='1')
+        self.patna = WeatherCache.objects.create(city='PATNA', country='IN', data=payload('Patna'))
+
+    def test_stopping_the_demand_tracker_flushes_and_joins(self):
+        tracker = DemandTracker(flush_interval=3600)
+        tracker.record(('PATNA', '', 'IN'))
+        thread = tracker._thread
+        tracker.stop(timeout=5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(tracker.pending(), {})
+        self.assertEqual(WeatherCache.objects.get(pk=self.patna.pk).hit_count, 1)
+
+        tracker.record(('PATNA', '', 'IN'))
+        self.assertTrue(tracker._thread.is_alive())
+        tracker.stop(timeout=5)
+        tracker.stop(timeout=5)
+        self.assertEqual(WeatherCache.objects.get(pk=self.patna.pk).hit_count, 2)
+
+    def test_stopping_the_history_writer_writes_the_queue_and_joins(self):
+        writer = HistoryWriter(flush_interval=3600, batch_size=10000)
+        writer.enqueue(self.user.pk, 'Patna', self.patna.lookup_key, payload('Patna'))
+        thread = writer._thread
+        writer.stop(timeout=5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(writer.pending(), 0)
+        self.assertEqual(SearchHistory.objects.get().city_name_queried, 'Patna')
+        writer.stop(timeout=5)
+
+
+@override_settings(WEATHER_PROFILING_ENABLED=True, WEATHER_PROFILING_SAMPLE_RATE=0, WEATHER_PROFILING_TOKEN='secret',
+                   WEATHER_PROFILING_DIR='')
+class ProfilingMiddlewareTests(SimpleTestCase):
+
+    def middleware(self):
+        return ProfilingMiddleware(lambda request: HttpResponse('ok'))
+
+    def get(self, middleware, **headers):
+        return middleware(APIRequestFactory().get('/api/weather/', **headers))
+
+    def test_not_installed_when_disabled(self):
+        with self.settings(WEATHER_PROFILING_ENABLED=False), self.assertRaises(MiddlewareNotUsed):
+            self.middleware()
+
+    def test_profiles_only_requests_with_the_token(self):
+        middleware = self.middleware()
+        with mock.patch('api.profiling.RequestProfile') as request_profile:
+            for headers in ({}, {'HTTP_X_PROFILE': 'wrong'}, {'HTTP_X_PROFILE': ''}):
+                self.assertFalse(self.get(middleware, **headers).has_header('Server-Timing'))
+        request_profile.assert_not_called()
+
+        response = self.get(middleware, HTTP_X_PROFILE='secret')
+        self.assertRegex(response['Server-Timing'], r'^db;dur=[\d.]+;desc="0 queries", upstream;dur=')
+
+    def test_no_token_means_no_header_opt_in(self):
+        with self.settings(WEATHER_PROFILING_TOKEN=''):
+            self.assertFalse(self.get(self.middleware(), HTTP_X_PROFILE='').has_header('Server-Timing'))
+
+    def test_samples_requests_at_the_configured_rate(self):
+        with self.settings(WEATHER_PROFILING_SAMPLE_RATE=0.1):
+            middleware = self.middleware()
+        with mock.patch('core.middleware.random.random', side_effect=[0.05, 0.5, 0.1]):
+            sampled = [self.get(middleware).has_header('Server-Timing') for _ in range(3)]
+        self.assertEqual(sampled, [True, False, False])
+
+    def test_reports_are_saved_with_a_profiling_dir(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        with self.settings(WEATHER_PROFILING_DIR=directory.name):
+            response = self.get(self.middleware(), HTTP_X_PROFILE='secret')
+        self.assertIn('profile;desc="', response['Server-Timing'])
+        self.assertTrue(os.listdir(directory.name))
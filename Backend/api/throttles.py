@@ -1,9 +1,180 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
 
+from django.conf import settings
 from rest_framework.throttling import AnonRateThrottle, UserRateThrottle
 
+from .metrics import throttled_requests
 
-class WeatherAnonThrottle(AnonRateThrottle):
+logger = logging.getLogger(__name__)
+
+
+class SlidingWindowStore:
+    """
+    Sliding-window counters shared by every worker on the host, kept in a small SQLite file
+    (WAL mode): one row per key per fixed window of `period` seconds.
+
+    The rate at time t is estimated from the counts of the current window and the previous one,
+    weighted by how much of it still overlaps the sliding window ending at t:
+
+        previous * (1 - elapsed / period) + current
+
+    A check is one atomic INSERT ... ON CONFLICT that counts the request only if the estimate
+    leaves room for it, so it costs two primary-key lookups whatever the limit, on every worker
+    together. The estimate assumes the previous window's requests were evenly spread. Rows of
+    windows that can no longer be read are swept out periodically.
+    """
+
+    TAKE_SQL = """
+        INSERT INTO throttle_window (key, slot, count, expires_at)
+        SELECT :key, :slot, :cost, :expires_at
+        WHERE coalesce((SELECT count FROM throttle_window WHERE key = :key AND slot = :slot - 1), 0) * :weight
+            + coalesce((SELECT count FROM throttle_window WHERE key = :key AND slot = :slot), 0) + :cost <= :limit
+        ON CONFLICT (key, slot) DO UPDATE SET count = count + excluded.count
+    """
+    COUNTS_SQL = """
+        SELECT
+            coalesce((SELECT count FROM throttle_window WHERE key = :key AND slot = :slot - 1), 0),
+            coalesce((SELECT count FROM throttle_window WHERE key = :key AND slot = :slot), 0)
+    """
+
+    def __init__(self, path, sweep_every=1000):
+        self.path = str(path)
+        self.sweep_every = sweep_every
+        self._local = threading.local()
+        self._checks = 0
+
+    def _connection(self):
+        # One connection per thread (and per process: never reuse one inherited across a fork)
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=1.0, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            # Throttle state may be lost on power failure; it is not worth an fsync per request
+            conn.execute('PRAGMA synchronous=OFF')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS throttle_window ('
+                'key TEXT NOT NULL, slot INTEGER NOT NULL, count INTEGER NOT NULL, expires_at REAL NOT NULL, '
+                'PRIMARY KEY (key, slot)) WITHOUT ROWID'
+            )
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def take(self, key, limit, period, cost=1):
+        """
+        Count `cost` requests for `key` if the estimated rate over the last `period` seconds
+        leaves room for them under `limit`. Returns (allowed, seconds until they would fit).
+        """
+        now = time.time()
+        slot, elapsed = divmod(now, period)
+        params = {
+            'key': key, 'slot': int(slot), 'limit': limit, 'cost': cost,
+            'weight': 1 - elapsed / period,
+            # Read as the previous window until the end of the next one
+            'expires_at': (slot + 2) * period,
+        }
+        conn = self._connection()
+        allowed = conn.execute(self.TAKE_SQL, params).rowcount == 1
+        retry_after = 0.0
+        if not allowed:
+            previous, current = conn.execute(self.COUNTS_SQL, params).fetchone()
+            # Rounded to the microsecond: the float division would otherwise land just short
+            retry_after = round(self.retry_after(previous, current, limit, cost, period, elapsed), 6)
+
+        self._checks += 1
+        if self._checks % self.sweep_every == 0:
+            conn.execute('DELETE FROM throttle_window WHERE expires_at < ?', (now,))
+        return allowed, retry_after
+
+    @staticmethod
+    def retry_after(previous, current, limit, cost, period, elapsed):
+        """
+        Seconds until the estimate leaves room for `cost` more requests, with no new ones counted.
+        """
+        room = limit - cost
+        if room < 0:
+            return float(period)
+        if current > room:
+            # Not in this window: in the next one `current` becomes the weighted previous count
+            return period - elapsed + period * max(0.0, 1 - room / current)
+        # previous * (1 - t / period) + current <= room
+        return max(0.0, period * (1 - (room - current) / previous) - elapsed)
+
+    def clear(self):
+        self._connection().execute('DELETE FROM throttle_window')
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_window_store():
+    """
+    Process-wide store for the WEATHER_THROTTLE_DB file.
+    """
+    path = str(getattr(settings, 'WEATHER_THROTTLE_DB', settings.BASE_DIR / 'throttle.sqlite3'))
+    store = _stores.get(path)
+    if store is None:
+        with _stores_lock:
+            store = _stores.setdefault(path, SlidingWindowStore(path))
+    return store
+
+
+class SlidingWindowThrottleMixin:
+    """
+    Swaps SimpleRateThrottle's per-key timestamp list (kept in the default cache, which is
+    per-process LocMem here) for a sliding-window counter in the shared SlidingWindowStore.
+
+    Same scopes, rates and cache keys as before: a rate of N/period admits about N requests in
+    any `period` seconds, on every worker together, with one O(1) check per request.
+    Set WEATHER_THROTTLE_BACKEND = 'cache' to go back to DRF's implementation.
+    If the store is unavailable the request is let through rather than failed.
+    """
+
+    def allow_request(self, request, view):
+        allowed = self._allow_request(request, view)
+        if not allowed:
+            throttled_requests.inc(self.scope)
+        return allowed
+
+    def _allow_request(self, request, view):
+        if getattr(settings, 'WEATHER_THROTTLE_BACKEND', 'sliding_window') != 'sliding_window':
+            return super().allow_request(request, view)
+        if self.rate is None:
+            return True
+        self.key = self.get_cache_key(request, view)
+        if self.key is None:
+            return True
+
+        try:
+            allowed, self.retry_after = get_window_store().take(self.key, self.num_requests, self.duration)
+        except sqlite3.Error as e:
+            logger.warning(f"Throttle store unavailable, allowing request: {e}")
+            return True
+        return allowed
+
+    def wait(self):
+        if getattr(settings, 'WEATHER_THROTTLE_BACKEND', 'sliding_window') != 'sliding_window':
+            return super().wait()
+        return self.retry_after
+
+
+class WeatherAnonThrottle(SlidingWindowThrottleMixin, AnonRateThrottle):
     scope = 'weather_limited'
 
-class WeatherUserThrottle(UserRateThrottle):
+class WeatherUserThrottle(SlidingWindowThrottleMixin, UserRateThrottle):
     scope = 'weather_burst'
+
+class WeatherBatchThrottle(SlidingWindowThrottleMixin, UserRateThrottle):
+    """
+    Limits batch calls against their own scope. The cities of a batch that go upstream are
+    charged to WeatherUserThrottle one by one (WeatherBatchView.admit_miss).
+    """
+    scope = 'weather_batch'
+
+class CityAutocompleteThrottle(SlidingWindowThrottleMixin, UserRateThrottle):
+    scope = 'cities'
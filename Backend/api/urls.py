@@ -1,10 +1,14 @@
 from django.urls import path
-from .views import WeatherView, SearchHistoryListView
+from .views import WeatherView, AsyncWeatherView, WeatherBatchView, SearchHistoryListView, WeatherCacheStatsView, CityAutocompleteView
 
 urlpatterns = [
 
     path('weather/', WeatherView.as_view(), name='weather'),
+    path('weather/batch/', WeatherBatchView.as_view(), name='weather_batch'),
+    path('weather/async/', AsyncWeatherView.as_view(), name='weather_async'),
     path('history/', SearchHistoryListView.as_view(), name='search_history'),
+    path('cities/', CityAutocompleteView.as_view(), name='city_autocomplete'),
+    path('cache/stats/', WeatherCacheStatsView.as_view(), name='weather_cache_stats'),
 ]
 
 
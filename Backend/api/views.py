@@ -1,78 +1,569 @@
 from rest_framework import generics, status, permissions
 from rest_framework.views import APIView
 from rest_framework.response import Response
+from rest_framework.exceptions import AuthenticationFailed, Throttled, ValidationError
+from django.contrib.auth.models import AnonymousUser
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
+from django.views import View
+from asgiref.sync import sync_to_async
 from .models import SearchHistory
+import hmac
 import requests
 import logging
 
+from .authentication import StatelessJWTAuthentication
 from .services import WeatherService
-from .throttles import WeatherAnonThrottle, WeatherUserThrottle
-from .serializers import SearchHistorySerializer
+from .cache import get_weather_cache, make_cache_key, key_digest, cache_ttl
+from .rendering import prerender_enabled, negotiate_encoding, render_body
+from .pagination import KeysetCursorPagination
+from .quota import UpstreamQuotaExceeded, get_upstream_quota
+from .metrics import metrics_enabled, registry as metrics_registry
+from .gazetteer import UnknownCityError, get_gazetteer
+from .throttles import WeatherAnonThrottle, WeatherUserThrottle, WeatherBatchThrottle, CityAutocompleteThrottle
+from .serializers import SearchHistorySerializer, WeatherBatchRequestSerializer
 
 logger = logging.getLogger(__name__)
 
+
+def missing_location_error(city, state, country):
+    """
+    Returns the validation error for a weather query, or None if all parts are present.
+    """
+    if not city:
+        return "City parameter is required."
+    if not state:
+        return "State parameter is required."
+    if not country:
+        return "Country parameter is required."
+    return None
+
+
+def parse_coordinates(lat, lon):
+    """
+    (lat, lon) as floats from query parameters, or raises ValueError with the message for the client.
+    """
+    try:
+        lat, lon = float(lat), float(lon)
+    except (TypeError, ValueError):
+        raise ValueError("lat and lon must be numbers.")
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        raise ValueError("lat must be within [-90, 90] and lon within [-180, 180].")
+    return lat, lon
+
+
+def add_freshness_headers(response, entry, cache_status):
+    """
+    Tells clients how fresh the data is: cache outcome (HIT, MISS, STALE, STALE-IF-ERROR) and age in seconds.
+    """
+    response['X-Cache-Status'] = cache_status
+    response['Age'] = str(max(0, int(entry.age.total_seconds())))
+    return response
+
+
+def weather_etag(key, updated_at):
+    """
+    Validator for one version of a location's cache entry. Weak, since the identity and
+    compressed bodies of that version share it.
+    """
+    return f'W/"{key_digest(key)[:16]}-{int(updated_at.timestamp() * 1000000):x}"'
+
+
+def conditional_weather_response(request, response, key, updated_at):
+    """
+    Adds ETag, Last-Modified and Cache-Control (max-age = remaining freshness) for the entry version,
+    then returns a 304 if the request's If-None-Match / If-Modified-Since already match it,
+    otherwise `response` itself.
+    """
+    remaining = updated_at + cache_ttl() - timezone.now()
+    response['ETag'] = weather_etag(key, updated_at)
+    response['Last-Modified'] = http_date(updated_at.timestamp())
+    patch_cache_control(response, max_age=max(0, int(remaining.total_seconds())))
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return get_conditional_response(
+        request, etag=response['ETag'], last_modified=int(updated_at.timestamp()), response=response,
+    )
+
+
+def is_conditional(request):
+    return 'HTTP_IF_NONE_MATCH' in request.META or 'HTTP_IF_MODIFIED_SINCE' in request.META
+
+
+def prerendered_response(request, entry):
+    """
+    Serves the entry's stored response bytes as-is, in the best encoding the client accepts.
+    Returns None when the entry has no pre-rendered body (the caller renders `entry.data` instead).
+    """
+    if entry.body is None or not prerender_enabled():
+        return None
+    encoding = negotiate_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''), entry.encoded_bodies)
+    response = HttpResponse(entry.encoded_bodies[encoding] if encoding else entry.body,
+                            content_type='application/json')
+    if encoding:
+        response['Content-Encoding'] = encoding
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return response
+
+
+def unknown_city_details(e):
+    """
+    Error body for a city the gazetteer rejected, with "did you mean" suggestions.
+    """
+    return {
+        "error": f"Unknown city: {e.city}.",
+        "suggestions": [city._asdict() for city in e.suggestions],
+    }
+
+
+def upstream_error_details(e):
+    """
+    Maps an upstream RequestException to (error body, status code) for the weather endpoints.
+    """
+    error_details = {"error": "Failed to fetch weather data from upstream provider."}
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+
+    if isinstance(e, UpstreamQuotaExceeded):
+        # Our own call budget, not the provider, refused the call (and no stale copy was available)
+        error_details["error"] = "Upstream call budget exhausted and no cached data is available."
+        error_details["retry_after"] = int(e.retry_after) + 1
+
+    if e.response is not None:
+        status_code = e.response.status_code
+        try:
+            error_details["upstream_error"] = e.response.json()
+        except ValueError:
+             error_details["upstream_error"] = e.response.text
+
+    return error_details, status_code
+
 class WeatherView(APIView):
     """
     API view to get weather data. 
     Checks local cache first, creating a mock response if not found (placeholder for external API).
+    Accepts either city/state/country or lat/lon (served from any cached entry nearby).
     """
+    # Only the user id is needed (throttling, history): no User query per request
+    authentication_classes = [StatelessJWTAuthentication]
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
     throttle_classes = [WeatherAnonThrottle, WeatherUserThrottle]
 
 
     def get(self, request):
+        if 'lat' in request.query_params or 'lon' in request.query_params:
+            return self.get_by_coordinates(request)
+
         city = request.query_params.get('city')
         state = request.query_params.get('state')
         country = request.query_params.get('country')
 
-        if not city:
-            return Response({"error": "City parameter is required."}, status=status.HTTP_400_BAD_REQUEST)
-        if not state:
-            return Response({"error": "State parameter is required."}, status=status.HTTP_400_BAD_REQUEST)
-        if not country:
-            return Response({"error": "Country parameter is required."}, status=status.HTTP_400_BAD_REQUEST)
+        error = missing_location_error(city, state, country)
+        if error:
+            return Response({"error": error}, status=status.HTTP_400_BAD_REQUEST)
+
+        key = make_cache_key(city, state, country)
+        # Revalidation: answer 304 from the cached entry's version alone, before any payload is loaded
+        if is_conditional(request):
+            updated_at = WeatherService.get_weather_version(city, state, country)
+            if updated_at is not None:
+                response = self.not_modified(request, key, updated_at, city)
+                if response is not None:
+                    return response
+
         # Use Service Layer
         try:
-            data = WeatherService.fetch_weather(city, state, country)
-            
+            entry, cache_status = WeatherService.get_weather(city, state, country)
+
+        except UnknownCityError as e:
+            return Response(unknown_city_details(e), status=status.HTTP_404_NOT_FOUND)
         except requests.exceptions.RequestException as e:
             # Handle potential external API errors gracefully
-            error_details = {"error": "Failed to fetch weather data from upstream provider."}
-            status_code = status.HTTP_503_SERVICE_UNAVAILABLE
-
-            if e.response is not None:
-                status_code = e.response.status_code
-                try:
-                    error_details["upstream_error"] = e.response.json()
-                except ValueError:
-                     error_details["upstream_error"] = e.response.text
-            
+            error_details, status_code = upstream_error_details(e)
             return Response(error_details, status=status_code)
         except Exception as e:
             # Log the unexpected error
             logger.error(f"Unexpected error in WeatherView: {e}", exc_info=True)
             return Response({"error": f"An unexpected error occurred: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-        # Log Search History (if authenticated)
+        return self.weather_response(request, entry, cache_status, key, city)
+
+    def get_by_coordinates(self, request):
+        try:
+            lat, lon = parse_coordinates(request.query_params.get('lat'), request.query_params.get('lon'))
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Same revalidation as city lookups, against the entry nearby that would answer the point
+        if is_conditional(request):
+            version = WeatherService.get_weather_version_by_coords(lat, lon)
+            if version is not None:
+                updated_at, key = version
+                response = self.not_modified(request, key, updated_at, key[0])
+                if response is not None:
+                    return response
+
+        try:
+            entry, cache_status = WeatherService.get_weather_by_coords(lat, lon)
+        except requests.exceptions.RequestException as e:
+            error_details, status_code = upstream_error_details(e)
+            return Response(error_details, status=status_code)
+        except Exception as e:
+            logger.error(f"Unexpected error in WeatherView: {e}", exc_info=True)
+            return Response({"error": f"An unexpected error occurred: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        # Recorded under the place the point resolved to
+        key = make_cache_key(entry.city, entry.state, entry.country)
+        return self.weather_response(request, entry, cache_status, key, entry.city)
+
+    @staticmethod
+    def not_modified(request, key, updated_at, city):
+        """
+        The 304 for a conditional request that already has version `updated_at` of `key`, with the
+        repeat search marked in the history; None if the client's copy is not that version.
+        """
+        response = conditional_weather_response(request, HttpResponse(), key, updated_at)
+        if response.status_code != status.HTTP_304_NOT_MODIFIED:
+            return None
+        try:
+            WeatherService.touch_history(request.user, city)
+        except Exception as e:
+            logger.warning(f"Error logging history: {e}")
+        return response
+
+    @staticmethod
+    def weather_response(request, entry, cache_status, key, city):
+        """
+        Logs the search as `city` (if authenticated) and returns the entry, with freshness and
+        validator headers (or a 304).
+        """
         if request.user.is_authenticated:
             try:
-                WeatherService.log_history(request.user, city, data)
+                WeatherService.log_history(request.user, city, entry)
             except Exception as e:
                 # Log error silently or to system logger so user isn't affected
                 logger.warning(f"Error logging history: {e}")
-        
-        return Response(data, status=status.HTTP_200_OK)
+
+        # Hot path: stream the bytes rendered at write time (unless e.g. the browsable API was asked for)
+        response = None
+        if request.accepted_renderer.format == 'json':
+            response = prerendered_response(request, entry)
+        if response is None:
+            response = Response(entry.data, status=status.HTTP_200_OK)
+        add_freshness_headers(response, entry, cache_status)
+        return conditional_weather_response(request, response, key, entry.updated_at)
+
+class WeatherBatchView(APIView):
+    """
+    API view to get weather for many locations in one request (dashboards).
+    Body: {"locations": [{"city": ..., "state": ..., "country": ...}, ...]}
+    Returns a per-location map of either the weather data or the error.
+    Batch lookups are not recorded in the search history.
+
+    The batch scope limits calls; each location that has to go upstream is also charged to the
+    caller's per-request scope (weather_burst), like a single lookup, and answered 429 once it
+    is used up. Cache hits are free, so a batch is no way around the per-request limit.
+    """
+    authentication_classes = [StatelessJWTAuthentication]
+    permission_classes = [permissions.IsAuthenticated]
+    throttle_classes = [WeatherBatchThrottle]
+    miss_throttle_class = WeatherUserThrottle
+
+    def admit_miss(self, request):
+        def admit(key):
+            throttle = self.miss_throttle_class()
+            if not throttle.allow_request(request, self):
+                raise Throttled(throttle.wait())
+        return admit
+
+    def post(self, request):
+        serializer = WeatherBatchRequestSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        locations = [
+            (item['city'], item['state'], item['country'])
+            for item in serializer.validated_data['locations']
+        ]
+
+        try:
+            outcomes, cache_hits = WeatherService.fetch_weather_batch(locations, self.admit_miss(request))
+        except Exception as e:
+            logger.error(f"Unexpected error in WeatherBatchView: {e}", exc_info=True)
+            return Response({"error": f"An unexpected error occurred: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        results = {}
+        failed = 0
+        for key, outcome in outcomes.items():
+            label = ",".join(part for part in key if part)
+            if isinstance(outcome, requests.exceptions.RequestException):
+                error_details, status_code = upstream_error_details(outcome)
+                results[label] = {"status": status_code, **error_details}
+                failed += 1
+            elif isinstance(outcome, UnknownCityError):
+                results[label] = {"status": status.HTTP_404_NOT_FOUND, **unknown_city_details(outcome)}
+                failed += 1
+            elif isinstance(outcome, Throttled):
+                results[label] = {"status": status.HTTP_429_TOO_MANY_REQUESTS, "error": str(outcome.detail),
+                                  "retry_after": outcome.wait}
+                failed += 1
+            elif isinstance(outcome, Exception):
+                logger.error(f"Unexpected error in WeatherBatchView for {label}: {outcome}")
+                results[label] = {"status": status.HTTP_500_INTERNAL_SERVER_ERROR, "error": "An unexpected error occurred."}
+                failed += 1
+            else:
+                results[label] = {"status": status.HTTP_200_OK, "data": outcome}
+
+        return Response({
+            "results": results,
+            "summary": {
+                "requested": len(outcomes),
+                "cache_hits": cache_hits,
+                "fetched": len(outcomes) - cache_hits - failed,
+                "failed": failed,
+            }
+        }, status=status.HTTP_200_OK)
+
+
+class AsyncWeatherView(View):
+    """
+    Native async variant of WeatherView for the ASGI stack (core.asgi).
+    Upstream waits, cache lookups and history writes never block a worker thread,
+    so one ASGI worker can keep hundreds of misses in flight.
+    Authentication and throttling match WeatherView (stateless JWT, weather_limited / weather_burst scopes).
+    """
+    authentication_classes = [StatelessJWTAuthentication]
+    throttle_classes = [WeatherAnonThrottle, WeatherUserThrottle]
+
+    def check_request(self, request):
+        """
+        Authenticates and throttles the request. Returns an error JsonResponse or None.
+        Runs in a worker thread since token auth and throttle state are sync.
+        """
+        request.user = AnonymousUser()
+        try:
+            for authenticator in self.authentication_classes:
+                user_auth_tuple = authenticator().authenticate(request)
+                if user_auth_tuple is not None:
+                    request.user, request.auth = user_auth_tuple
+                    break
+        except AuthenticationFailed as e:
+            return JsonResponse({"detail": e.detail}, status=e.status_code)
+
+        for throttle_class in self.throttle_classes:
+            throttle = throttle_class()
+            if not throttle.allow_request(request, self):
+                wait = throttle.wait()
+                response = JsonResponse({"detail": "Request was throttled."}, status=status.HTTP_429_TOO_MANY_REQUESTS)
+                if wait is not None:
+                    response['Retry-After'] = str(int(wait) + 1)
+                return response
+        return None
+
+    async def get(self, request):
+        error_response = await sync_to_async(self.check_request)(request)
+        if error_response is not None:
+            return error_response
+
+        city = request.GET.get('city')
+        state = request.GET.get('state')
+        country = request.GET.get('country')
+
+        error = missing_location_error(city, state, country)
+        if error:
+            return JsonResponse({"error": error}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            entry, cache_status = await WeatherService.aget_weather(city, state, country)
+            data = entry.data
+        except UnknownCityError as e:
+            return JsonResponse(unknown_city_details(e), status=status.HTTP_404_NOT_FOUND)
+        except requests.exceptions.RequestException as e:
+            error_details, status_code = upstream_error_details(e)
+            return JsonResponse(error_details, status=status_code)
+        except Exception as e:
+            logger.error(f"Unexpected error in AsyncWeatherView: {e}", exc_info=True)
+            return JsonResponse({"error": f"An unexpected error occurred: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        if request.user.is_authenticated:
+            try:
+                await WeatherService.alog_history(request.user, city, entry)
+            except Exception as e:
+                logger.warning(f"Error logging history: {e}")
+
+        response = prerendered_response(request, entry) or JsonResponse(data, status=status.HTTP_200_OK)
+        add_freshness_headers(response, entry, cache_status)
+        return conditional_weather_response(request, response, make_cache_key(city, state, country), entry.updated_at)
+
 
 class SearchHistoryListView(generics.ListAPIView):
     """
-    API view to list search history for the authenticated user.
+    API view to list search history for the authenticated user, newest first.
+    Keyset-paginated (?cursor=..., ?page_size=...). ?fields=id,city_name_queried,timestamp limits
+    the columns read and returned; response_data (a join on the cache entry) only when asked for.
+    Pages of WEATHER_HISTORY_STREAM_MIN_ROWS rows or more are streamed.
     """
     serializer_class = SearchHistorySerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = KeysetCursorPagination
+
+    def get_requested_fields(self):
+        available = SearchHistorySerializer.Meta.fields
+        requested = self.request.query_params.get('fields')
+        if not requested:
+            return list(available)
+        fields = [name.strip() for name in requested.split(',') if name.strip()]
+        unknown = [name for name in fields if name not in available]
+        if unknown:
+            raise ValidationError({'fields': f"Unknown field(s): {', '.join(unknown)}. Choose from {', '.join(available)}."})
+        return fields
 
     def get_queryset(self):
-        # Optimize query to fetch related user data in a single query (solves potential N+1)
-        return SearchHistory.objects.filter(user=self.request.user).select_related('user')
+        queryset = SearchHistory.objects.filter(user=self.request.user)
+        if 'response_data' in self.get_requested_fields():
+            # One join instead of a query per row; the pre-rendered bodies are never needed here
+            return queryset.select_related('weather').defer('weather__body', 'weather__body_gzip', 'weather__body_br')
+        # The serializer only emits the user id, so neither user nor weather is joined
+        return queryset.only('id', 'user', 'city_name_queried', 'timestamp')
+
+    def history_etag(self, request, rows, fields):
+        """
+        Validator for exactly this page: the keys of its rows (and the lookahead row that decides
+        the next link), plus the versions of the referenced cache entries when response_data is
+        included. Built from the fetched rows, so the page costs one index-bounded query however
+        long the history is, whether it is answered with 304 or not.
+        """
+        if 'response_data' in fields:
+            versions = [
+                (row.pk, row.timestamp, row.weather_id, row.weather.updated_at if row.weather else None)
+                for row in rows
+            ]
+        else:
+            versions = [(row.pk, row.timestamp) for row in rows]
+        version = f"{request.user.pk}:{request.get_full_path()}:{versions}"
+        return f'W/"{key_digest((version,))[:20]}"'
+
+    def list(self, request, *args, **kwargs):
+        fields = self.get_requested_fields()
+        rows = list(self.paginator.page_queryset(self.get_queryset(), request))
+
+        etag = self.history_etag(request, rows, fields)
+        # No Last-Modified: deletions do not move the latest timestamp, so only the ETag is reliable
+        response = HttpResponse()
+        response['ETag'] = etag
+        patch_cache_control(response, private=True, no_cache=True)
+        not_modified = get_conditional_response(request, etag=etag, response=response)
+        if not_modified.status_code == status.HTTP_304_NOT_MODIFIED:
+            return not_modified
+
+        page = self.paginator.paginate_rows(rows)
+        if len(page) >= getattr(settings, 'WEATHER_HISTORY_STREAM_MIN_ROWS', 200) and request.accepted_renderer.format == 'json':
+            response = self.streaming_response(page, fields)
+        else:
+            response = self.get_paginated_response(self.get_serializer(page, many=True, fields=fields).data)
+        response['ETag'] = etag
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+    def streaming_response(self, page, fields):
+        """
+        Same body as get_paginated_response, rendered and sent row by row instead of as one document.
+        """
+        serializer = self.get_serializer(fields=fields)
+        paginator = self.paginator
+
+        def chunks():
+            yield b'{"next":' + render_body(paginator.next_link) + b',"previous":' + render_body(paginator.previous_link)
+            yield b',"results":['
+            for index, row in enumerate(page):
+                yield (b',' if index else b'') + render_body(serializer.to_representation(row))
+            yield b']}'
+
+        return StreamingHttpResponse(chunks(), content_type='application/json')
+
+
+class CityAutocompleteView(APIView):
+    """
+    API view suggesting cities for a name prefix, most populous first (alternate names match too).
+    Query: ?q=pat&country=IN&limit=10. Answered from the memory-mapped gazetteer, never upstream.
+    """
+    permission_classes = [permissions.AllowAny]
+    throttle_classes = [CityAutocompleteThrottle]
+    max_limit = 20
 
+    def get(self, request):
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            return Response({"error": "q parameter is required."}, status=status.HTTP_400_BAD_REQUEST)
+        country = request.query_params.get('country') or None
+        try:
+            limit = max(1, min(int(request.query_params.get('limit', 10)), self.max_limit))
+        except ValueError:
+            return Response({"error": "limit must be a number."}, status=status.HTTP_400_BAD_REQUEST)
+
+        gazetteer = get_gazetteer()
+        if gazetteer is None:
+            return Response({"error": "City suggestions are not available."}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        cities = gazetteer.complete(query, country, limit)
+        response = Response({"results": [city._asdict() for city in cities]}, status=status.HTTP_200_OK)
+        # Same answer for everyone until the index is rebuilt
+        patch_cache_control(response, public=True, max_age=3600)
+        return response
+
+
+class WeatherCacheStatsView(APIView):
+    """
+    API view exposing per-tier hit/miss counters of the weather cache (admin only),
+    plus the upstream call budget consumption under "upstream_quota".
+    """
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request):
+        stats = get_weather_cache().stats()
+        stats['upstream_quota'] = get_upstream_quota().stats()
+        return Response(stats, status=status.HTTP_200_OK)
+
+
+class MetricsView(View):
+    """
+    This process's metrics in the Prometheus text exposition format (GET /metrics).
+    A plain Django view, so scrapes skip DRF authentication and throttling. Scrapers must send
+    WEATHER_METRICS_TOKEN as a Bearer token, or connect directly from an address listed in
+    WEATHER_METRICS_ALLOWED_IPS. With neither configured, every scrape is refused.
+    """
+    # Set by reverse proxies: the connection's address is then the proxy's, not the client's
+    PROXY_HEADERS = ('HTTP_X_FORWARDED_FOR', 'HTTP_X_REAL_IP', 'HTTP_FORWARDED')
+
+    def get(self, request):
+        if not metrics_enabled():
+            return JsonResponse({'error': 'Metrics are disabled.'}, status=status.HTTP_404_NOT_FOUND)
+        denied = self.check_access(request)
+        if denied is not None:
+            return denied
+        return HttpResponse(metrics_registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
+    def check_access(self, request):
+        """
+        None if the scrape may proceed, otherwise the error response.
+        """
+        token = getattr(settings, 'WEATHER_METRICS_TOKEN', '')
+        sent = request.headers.get('Authorization')
+        if token and sent is not None:
+            if hmac.compare_digest(sent.encode(), f"Bearer {token}".encode()):
+                return None
+            return JsonResponse({'error': 'Invalid metrics token.'}, status=status.HTTP_401_UNAUTHORIZED)
+        if self.allowed_address(request):
+            return None
+        if token:
+            return JsonResponse({'error': 'Metrics token required.'}, status=status.HTTP_401_UNAUTHORIZED)
+        return JsonResponse({'error': 'Metrics require WEATHER_METRICS_TOKEN or WEATHER_METRICS_ALLOWED_IPS.'},
+                            status=status.HTTP_403_FORBIDDEN)
 
+    def allowed_address(self, request):
+        """
+        True for a direct connection from WEATHER_METRICS_ALLOWED_IPS. Proxied requests never
+        qualify: behind a reverse proxy on the same host every client would appear as loopback.
+        """
+        allowed = getattr(settings, 'WEATHER_METRICS_ALLOWED_IPS', ())
+        if not allowed or any(header in request.META for header in self.PROXY_HEADERS):
+            return False
+        return request.META.get('REMOTE_ADDR') in allowed
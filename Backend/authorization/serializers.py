@@ -1,4 +1,5 @@
 from rest_framework import serializers
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 from api.models import User
 
 class UserSerializer(serializers.ModelSerializer):
@@ -16,3 +17,17 @@ class UserSerializer(serializers.ModelSerializer):
             password=validated_data['password']
         )
         return user
+
+
+class UsernameTokenObtainPairSerializer(TokenObtainPairSerializer):
+    """
+    Adds the username to the token claims, so stateless authentication (api.authentication)
+    can fill in TokenUser.username without a database lookup. Access tokens minted from the
+    refresh token copy it.
+    """
+
+    @classmethod
+    def get_token(cls, user):
+        token = super().get_token(user)
+        token['username'] = user.username
+        return token
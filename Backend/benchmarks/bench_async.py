@@ -0,0 +1,107 @@
+"""
+Sync (WSGI) vs async (ASGI) weather endpoint throughput under a slow upstream.
+
+Every request is a cache miss for a distinct city, so each one waits on the local stub
+provider for --latency seconds. The WSGI side models one worker with --threads threads;
+the ASGI side models one worker (one event loop) with --concurrency requests in flight.
+
+    python benchmarks/bench_async.py --requests 300 --latency 0.2 --threads 8 --concurrency 300
+"""
+import argparse
+import asyncio
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from common import setup_django, bench_database, summarize
+
+setup_django()
+
+from django.core.cache import cache
+from django.test import Client, AsyncClient, override_settings
+
+from api.cache import reset_weather_cache
+from api.clients import reset_weather_client, aclose_async_weather_client
+from api.models import WeatherCache
+from api.views import WeatherView, AsyncWeatherView
+from stub_provider import StubProvider
+
+
+def reset_state():
+    WeatherCache.objects.all().delete()
+    cache.clear()
+    reset_weather_cache()
+    reset_weather_client()
+
+
+def run_sync(n, threads, prefix):
+    client = Client()
+
+    def one(i):
+        start = time.perf_counter()
+        response = client.get('/api/weather/', {'city': f'{prefix}{i}', 'state': 'S', 'country': 'IN'})
+        return time.perf_counter() - start, response.status_code
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        results = list(pool.map(one, range(n)))
+    elapsed = time.perf_counter() - start
+    report = summarize([r[0] for r in results], elapsed)
+    report['errors'] = sum(1 for r in results if r[1] != 200)
+    return report
+
+
+async def run_async(n, concurrency, prefix):
+    client = AsyncClient()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with semaphore:
+            start = time.perf_counter()
+            response = await client.get('/api/weather/async/', {'city': f'{prefix}{i}', 'state': 'S', 'country': 'IN'})
+            return time.perf_counter() - start, response.status_code
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(one(i) for i in range(n)))
+    elapsed = time.perf_counter() - start
+    await aclose_async_weather_client()
+    report = summarize([r[0] for r in results], elapsed)
+    report['errors'] = sum(1 for r in results if r[1] != 200)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.2, help='stub upstream latency in seconds')
+    parser.add_argument('--threads', type=int, default=8, help='WSGI worker threads')
+    parser.add_argument('--concurrency', type=int, default=200, help='in-flight requests on the ASGI loop')
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args()
+
+    # Measure the serving model, not the rate limits
+    WeatherView.throttle_classes = []
+    AsyncWeatherView.throttle_classes = []
+
+    with bench_database(), StubProvider(latency=args.latency) as stub, \
+            override_settings(WEATHER_API_BASE_URL=stub.url, WEATHER_API_POOL_SIZE=args.threads):
+        reset_state()
+        sync_report = run_sync(args.requests, args.threads, 'SYNCCITY')
+        reset_state()
+        async_report = asyncio.run(run_async(args.requests, args.concurrency, 'ASYNCCITY'))
+        upstream_calls = stub.calls
+
+    results = {
+        'config': vars(args),
+        'wsgi_sync': sync_report,
+        'asgi_async': async_report,
+        'upstream_calls': upstream_calls,
+    }
+    print(json.dumps(results, indent=2))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
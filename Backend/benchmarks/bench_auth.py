@@ -0,0 +1,86 @@
+"""
+Authenticated cache hits with the User lookup (JWTAuthentication) and without it
+(StatelessJWTAuthentication, the weather endpoints' default).
+
+    python benchmarks/bench_auth.py --requests 3000 --rounds 10
+
+Reports database queries per request and the median request latency (median of interleaved
+rounds). Search history is written behind, as in production, so only authentication differs.
+"""
+import argparse
+import json
+import logging
+import statistics
+import time
+
+from common import setup_django, bench_database
+
+setup_django()
+
+from django.db import connection  # noqa: E402
+from django.test import Client, override_settings  # noqa: E402
+from django.test.utils import CaptureQueriesContext  # noqa: E402
+from rest_framework_simplejwt.authentication import JWTAuthentication  # noqa: E402
+from rest_framework_simplejwt.tokens import RefreshToken  # noqa: E402
+
+from api.authentication import StatelessJWTAuthentication, user_status_cache  # noqa: E402
+from api.cache import reset_weather_cache  # noqa: E402
+from api.clients import reset_weather_client  # noqa: E402
+from api.demand import demand_tracker  # noqa: E402
+from api.history import history_writer  # noqa: E402
+from api.models import User  # noqa: E402
+from api.views import WeatherView  # noqa: E402
+from benchmarks.stub_provider import StubProvider  # noqa: E402
+
+PARAMS = {'city': 'Patna', 'state': 'BR', 'country': 'IN'}
+AUTHENTICATION = {'jwt': JWTAuthentication, 'stateless': StatelessJWTAuthentication}
+
+
+def request(client, headers, name):
+    WeatherView.authentication_classes = [AUTHENTICATION[name]]
+    return client.get('/api/weather/', PARAMS, headers=headers)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=3000)
+    parser.add_argument('--rounds', type=int, default=10)
+    args = parser.parse_args()
+
+    WeatherView.throttle_classes = []
+    logging.getLogger('api').setLevel(logging.WARNING)
+    results = {}
+    with bench_database(), StubProvider() as stub, override_settings(
+        WEATHER_API_BASE_URL=stub.url, WEATHER_UPSTREAM_CALLS_PER_MINUTE=0, WEATHER_UPSTREAM_CALLS_PER_DAY=0,
+    ):
+        reset_weather_cache()
+        reset_weather_client()
+        user_status_cache.clear()
+        user = User.objects.create_user('bench', 'bench@example.com', 'pw', phone='1')
+        headers = {'Authorization': f"Bearer {RefreshToken.for_user(user).access_token}"}
+        client = Client()
+        for name in AUTHENTICATION:
+            assert request(client, headers, name).status_code == 200
+            with CaptureQueriesContext(connection) as queries:
+                request(client, headers, name)
+            results[name] = {'queries_per_request': len(queries)}
+
+        medians = {name: [] for name in AUTHENTICATION}
+        for _ in range(args.rounds):
+            for name in AUTHENTICATION:
+                latencies = []
+                for _ in range(args.requests // args.rounds):
+                    started = time.perf_counter()
+                    request(client, headers, name)
+                    latencies.append(time.perf_counter() - started)
+                medians[name].append(statistics.median(latencies))
+        for name, values in medians.items():
+            results[name]['p50_us'] = round(statistics.median(values) * 1e6, 1)
+        results['status_cache'] = {'hits': user_status_cache.hits, 'misses': user_status_cache.misses}
+        history_writer.flush()
+        demand_tracker.flush()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
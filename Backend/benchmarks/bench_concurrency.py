@@ -0,0 +1,135 @@
+"""
+Write throughput and "database is locked" errors of concurrent workers on SQLite.
+
+    python benchmarks/bench_concurrency.py --threads 16 --seconds 5
+
+Each thread is a worker with its own connection, mixing cache lookups with the two write paths
+that contend for the lock: cache upserts (DatabaseTier.set) and search history upserts
+(WeatherService.log_history, write-behind off). Profiles:
+
+  default   rollback journal, deferred transactions, no PRAGMAs, no lock retries
+            (plain Django SQLite settings)
+  tuned     this project's settings: WAL, synchronous=NORMAL, busy_timeout, cache/mmap size,
+            IMMEDIATE transactions and retry-on-lock for the upserts
+"""
+import argparse
+import json
+import random
+import threading
+import time
+
+from common import setup_django, bench_database, summarize
+
+setup_django()
+
+from django.conf import settings  # noqa: E402
+from django.db import OperationalError, connection, connections  # noqa: E402
+from django.test import override_settings  # noqa: E402
+
+from api.cache import DatabaseTier  # noqa: E402
+from api.db import is_lock_error  # noqa: E402
+from api.models import User, WeatherCache  # noqa: E402
+from api.services import WeatherService  # noqa: E402
+from benchmarks.stub_provider import make_payload  # noqa: E402
+
+PROFILES = {
+    'default': {
+        'options': {},
+        'pragmas': {'journal_mode': 'DELETE', 'synchronous': 'FULL', 'busy_timeout': 5000},
+        'retries': 1,
+    },
+    'tuned': {
+        'options': {'transaction_mode': 'IMMEDIATE'},
+        'pragmas': settings.WEATHER_SQLITE_PRAGMAS,
+        'retries': settings.WEATHER_DB_LOCK_RETRIES,
+    },
+}
+
+
+def worker(users, cities, read_share, deadline, seed, results):
+    rng = random.Random(seed)
+    tier = DatabaseTier()
+    writes, reads, errors, latencies = 0, 0, 0, []
+    try:
+        while time.perf_counter() < deadline:
+            city = rng.choice(cities)
+            started = time.perf_counter()
+            try:
+                if rng.random() < read_share:
+                    WeatherCache.objects.get_valid_cache(city, None, 'IN')
+                    reads += 1
+                    continue
+                entry = WeatherService._build_entry(make_payload(city, 'IN'), city, None, 'IN')
+                if rng.random() < 0.5:
+                    tier.set((city, '', 'IN'), entry)
+                else:
+                    WeatherService.log_history(rng.choice(users), city, entry)
+                writes += 1
+                latencies.append(time.perf_counter() - started)
+            except OperationalError as e:
+                if not is_lock_error(e):
+                    raise
+                errors += 1
+    finally:
+        connection.close()
+    results.append((writes, reads, errors, latencies))
+
+
+def run(profile, args, users, cities):
+    db_settings = connections.settings['default']
+    db_settings['OPTIONS'] = dict(profile['options'])
+    connection.close()
+    results = []
+    with override_settings(WEATHER_SQLITE_PRAGMAS=profile['pragmas'], WEATHER_DB_LOCK_RETRIES=profile['retries']):
+        # Journal mode is stored in the file: set it once before the workers connect
+        connection.ensure_connection()
+        connection.close()
+        deadline = time.perf_counter() + args.seconds
+        threads = [
+            threading.Thread(target=worker, args=(users, cities, args.read_share, deadline, args.seed + i, results))
+            for i in range(args.threads)
+        ]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+    writes = sum(result[0] for result in results)
+    errors = sum(result[2] for result in results)
+    latencies = [latency for result in results for latency in result[3]]
+    stats = summarize(latencies, elapsed)
+    return {
+        'writes_per_s': round(writes / elapsed, 1),
+        'reads_per_s': round(sum(result[1] for result in results) / elapsed, 1),
+        'lock_errors': errors,
+        'write_error_rate': round(errors / (writes + errors), 4) if writes + errors else 0.0,
+        'write_p50_ms': stats['p50_ms'],
+        'write_p99_ms': stats['p99_ms'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--cities', type=int, default=200)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--read-share', type=float, default=0.5, help='Share of operations that are lookups.')
+    parser.add_argument('--profiles', nargs='+', choices=list(PROFILES), default=list(PROFILES))
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    with bench_database(), override_settings(WEATHER_HISTORY_WRITE_BEHIND=False, WEATHER_CACHE_PRERENDER=False):
+        users = [
+            User.objects.create_user(f"bench{i}", f"bench{i}@example.com", 'pw', phone=str(i))
+            for i in range(args.users)
+        ]
+        cities = [f"CITY{i}" for i in range(args.cities)]
+        results = {name: run(PROFILES[name], args, users, cities) for name in args.profiles}
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
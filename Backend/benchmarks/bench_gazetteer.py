@@ -0,0 +1,85 @@
+"""
+Gazetteer index size, build time and query latency at GeoNames scale.
+
+    python benchmarks/bench_gazetteer.py --cities 200000 --queries 5000
+
+Builds an index of synthetic city names (or a real dump with --geonames cities500.txt) in a temp
+directory, then times autocomplete queries with prefixes of 1-6 characters, with and without
+a country, and exact lookups (the canonicalization step of WeatherService).
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+from common import setup_django, percentile
+
+setup_django()
+
+from api.gazetteer import Gazetteer, build_index, read_geonames  # noqa: E402
+
+SYLLABLES = ['ka', 'ra', 'ma', 'na', 'pur', 'ba', 'di', 'lo', 'san', 'ta', 'vi', 'go', 'el', 'ri', 'to',
+             'an', 'be', 'chi', 'mo', 'da', 'shi', 'ur', 'ha', 'ne', 'ville', 'burg', 'es', 'ko', 'li', 'om']
+COUNTRIES = ['IN', 'US', 'FR', 'BR', 'DE', 'CN', 'RU', 'MX', 'ID', 'NG']
+
+
+def synthetic_cities(count, rng):
+    for _ in range(count):
+        name = ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))).title()
+        # Heavy-tailed populations, like real ones
+        population = int(1000 * rng.paretovariate(1.2))
+        yield name, [], rng.choice(COUNTRIES), 'State', population, rng.uniform(-60, 60), rng.uniform(-180, 180)
+
+
+def timed(queries, query):
+    latencies = []
+    for args in queries:
+        started = time.perf_counter()
+        query(*args)
+        latencies.append(time.perf_counter() - started)
+    return {
+        'p50_us': round(percentile(latencies, 50) * 1e6, 1),
+        'p99_us': round(percentile(latencies, 99) * 1e6, 1),
+        'max_us': round(max(latencies) * 1e6, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--cities', type=int, default=200000)
+    parser.add_argument('--geonames', help='Index a GeoNames dump instead of synthetic names.')
+    parser.add_argument('--queries', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    cities = read_geonames(args.geonames) if args.geonames else synthetic_cities(args.cities, rng)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'gazetteer.idx')
+        started = time.perf_counter()
+        count = build_index(cities, path)
+        build_seconds = time.perf_counter() - started
+
+        gazetteer = Gazetteer(path)
+        names = [gazetteer.record(rng.randrange(len(gazetteer))) for _ in range(args.queries)]
+        prefixes = [(city.name[:rng.randint(1, 6)], None, 10) for city in names]
+        country_prefixes = [(city.name[:rng.randint(1, 6)], city.country, 10) for city in names]
+        exact = [(city.name, city.country) for city in names]
+        results = {
+            'cities': count,
+            'keys': gazetteer.n_keys,
+            'precomputed_prefixes': gazetteer.n_prefixes,
+            'index_mb': round(os.path.getsize(path) / 1e6, 1),
+            'build_s': round(build_seconds, 1),
+            'complete': timed(prefixes, gazetteer.complete),
+            'complete_in_country': timed(country_prefixes, gazetteer.complete),
+            'lookup': timed(exact, gazetteer.lookup),
+        }
+        gazetteer.close()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""
+Cache hit ratio of coordinate lookups (GPS traffic) for different search radii and grid sizes.
+
+    python benchmarks/bench_geo.py --requests 2000 --hotspots 50 --jitter-km 1.5
+
+Requests cluster around `--hotspots` random points, each with normally distributed GPS noise
+of `--jitter-km`, so almost no two requests carry the same coordinates. Configurations:
+
+  exact        grid 0.000001 degrees, radius 0: only identical coordinates hit
+  grid         grid 0.01 degrees (~1.1 km), radius 0: only requests snapped to the same grid point hit
+  radius=N     grid 0.01 degrees, any valid entry within N km answers (indexed nearest_valid lookup)
+
+Upstream is the local stub provider; throttling and the upstream call budget are disabled for the run.
+"""
+import argparse
+import json
+import logging
+import math
+import random
+import time
+
+from common import setup_django, bench_database, summarize
+
+setup_django()
+
+from django.core.cache import cache  # noqa: E402
+from django.test import Client, override_settings  # noqa: E402
+
+from api.cache import reset_weather_cache  # noqa: E402
+from api.clients import reset_weather_client  # noqa: E402
+from api.demand import demand_tracker  # noqa: E402
+from api.geo import KM_PER_DEGREE_LAT  # noqa: E402
+from api.models import WeatherCache  # noqa: E402
+from api.quota import reset_upstream_quota  # noqa: E402
+from api.views import WeatherView  # noqa: E402
+from benchmarks.stub_provider import StubProvider  # noqa: E402
+
+
+def make_points(requests, hotspots, jitter_km, seed):
+    rng = random.Random(seed)
+    centres = [(rng.uniform(-60, 60), rng.uniform(-180, 180)) for _ in range(hotspots)]
+    points = []
+    for _ in range(requests):
+        lat, lon = rng.choice(centres)
+        dlat = rng.gauss(0, jitter_km) / KM_PER_DEGREE_LAT
+        dlon = rng.gauss(0, jitter_km) / (KM_PER_DEGREE_LAT * math.cos(math.radians(lat)))
+        points.append((round(lat + dlat, 6), round(lon + dlon, 6)))
+    return points
+
+
+def run(points, stub):
+    WeatherCache.objects.all().delete()
+    reset_weather_cache()
+    cache.clear()
+    calls_before = stub.calls
+    client = Client()
+    hits, latencies = 0, []
+    started = time.perf_counter()
+    for lat, lon in points:
+        t0 = time.perf_counter()
+        response = client.get('/api/weather/', {'lat': lat, 'lon': lon})
+        latencies.append(time.perf_counter() - t0)
+        assert response.status_code == 200, response.content
+        hits += response['X-Cache-Status'] == 'HIT'
+    stats = summarize(latencies, time.perf_counter() - started)
+    return {
+        'hit_ratio': round(hits / len(points), 4),
+        'upstream_calls': stub.calls - calls_before,
+        'p50_ms': stats['p50_ms'],
+        'p95_ms': stats['p95_ms'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--hotspots', type=int, default=50)
+    parser.add_argument('--jitter-km', type=float, default=1.5)
+    parser.add_argument('--radii', type=float, nargs='+', default=[1, 5])
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    WeatherView.throttle_classes = []
+    logging.getLogger('api').setLevel(logging.WARNING)
+    points = make_points(args.requests, args.hotspots, args.jitter_km, args.seed)
+    configurations = [('exact', 0.000001, 0), ('grid', 0.01, 0)]
+    configurations += [(f"radius={radius:g}km", 0.01, radius) for radius in args.radii]
+
+    with bench_database(), StubProvider() as stub, override_settings(
+        WEATHER_API_BASE_URL=stub.url, WEATHER_UPSTREAM_CALLS_PER_MINUTE=0, WEATHER_UPSTREAM_CALLS_PER_DAY=0,
+    ):
+        reset_weather_client()
+        reset_upstream_quota()
+        results = {}
+        for name, grid, radius in configurations:
+            with override_settings(WEATHER_GEO_GRID_DEGREES=grid, WEATHER_GEO_RADIUS_KM=radius):
+                results[name] = run(points, stub)
+        demand_tracker.flush()
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""
+/api/history/ latency as a user's history grows.
+
+    python benchmarks/bench_history.py --sizes 1000 10000 50000 --requests 50
+
+For each history size, times the first page, a page deep into the history (followed through
+`next` links), a projected page (?fields=id,city_name_queried,timestamp) and a 304 revalidation.
+With keyset pagination all four should stay flat as the history grows.
+"""
+import argparse
+import json
+import time
+
+from common import setup_django, bench_database, summarize
+
+setup_django()
+
+from django.db import connection, transaction  # noqa: E402
+from django.test import Client  # noqa: E402
+from django.utils import timezone  # noqa: E402
+from rest_framework_simplejwt.tokens import AccessToken  # noqa: E402
+
+from api.models import User, SearchHistory, WeatherCache  # noqa: E402
+from benchmarks.stub_provider import make_payload  # noqa: E402
+
+
+def populate(user, rows, cities):
+    SearchHistory.objects.filter(user=user).delete()
+    now = timezone.now()
+    with transaction.atomic():
+        SearchHistory.objects.bulk_create(
+            [
+                SearchHistory(user=user, city_name_queried=f"CITY{i}", weather_id=cities[i % len(cities)],
+                              snapshot={'name': f"City{i}", 'main': {'temp': 20}})
+                for i in range(rows)
+            ],
+            batch_size=5000,
+        )
+        # auto_now stamps every row alike; spread them out (with some ties) like real history
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "UPDATE api_searchhistory SET timestamp = datetime(%s, '-' || (id / 3) || ' seconds') WHERE user_id = %s",
+                [now.strftime('%Y-%m-%d %H:%M:%S'), user.pk],
+            )
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+
+def timed(client, url, auth, requests, **headers):
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(requests):
+        t0 = time.perf_counter()
+        response = client.get(url, **auth, **headers)
+        if response.streaming:
+            b''.join(response.streaming_content)
+        latencies.append(time.perf_counter() - t0)
+    return response, summarize(latencies, time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 50000])
+    parser.add_argument('--requests', type=int, default=50)
+    parser.add_argument('--depth', type=int, default=20, help='pages to follow for the deep page')
+    args = parser.parse_args()
+
+    with bench_database():
+        user = User.objects.create_user('bench', 'bench@example.com', 'pw', phone='0')
+        auth = {'HTTP_AUTHORIZATION': f"Bearer {AccessToken.for_user(user)}"}
+        cities = [
+            WeatherCache.objects.create(city=f"CITY{i}", country='IN', data=make_payload(f"CITY{i}", 'IN')).pk
+            for i in range(100)
+        ]
+        client = Client()
+        results = {}
+        for size in args.sizes:
+            populate(user, size, cities)
+            url = '/api/history/'
+            for _ in range(args.depth):
+                next_url = client.get(url, **auth).json()['next']
+                if not next_url:
+                    break
+                url = next_url
+
+            first, first_stats = timed(client, '/api/history/', auth, args.requests)
+            _, deep_stats = timed(client, url, auth, args.requests)
+            _, projected_stats = timed(client, '/api/history/?fields=id,city_name_queried,timestamp', auth, args.requests)
+            _, revalidate_stats = timed(client, '/api/history/', auth, args.requests, HTTP_IF_NONE_MATCH=first['ETag'])
+            results[size] = {
+                'first_page_p50_ms': first_stats['p50_ms'],
+                'deep_page_p50_ms': deep_stats['p50_ms'],
+                'projected_page_p50_ms': projected_stats['p50_ms'],
+                'revalidate_304_p50_ms': revalidate_stats['p50_ms'],
+            }
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
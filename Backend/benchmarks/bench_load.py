@@ -0,0 +1,320 @@
+"""
+Load test of the HTTP API with realistic traffic against the local stub provider.
+
+    python benchmarks/bench_load.py --requests 5000 --threads 16 --cities 2000 --zipf 1.1
+    python benchmarks/bench_load.py --compare benchmarks/results/load-20261001-120000.json
+
+Traffic (--mix, relative weights):
+  weather   GET /api/weather/, cities drawn from a Zipf popularity distribution (--zipf exponent),
+            half of them (--auth-share) by logged-in users, whose searches are written to history
+  history   GET /api/history/ of a random user
+  login     POST /auth/login/ (password hashing included, as in production)
+  refresh   POST /auth/token/refresh/
+
+By default everything runs in this process: a throwaway database, one Django test client per
+thread, and the stub provider with --latency, --error-rate and --payload-bytes. Throttles and the
+upstream call budget are off. With --target, the same traffic goes over HTTP to a running server
+instead. Point that server's WEATHER_API_BASE_URL at `stub_provider.py`, and pass --stub-url to
+count upstream calls.
+
+Reports throughput and p50/p95/p99 latency per endpoint and overall, the weather hit ratio
+(X-Cache-Status) and upstream calls. Results are saved with the configuration to --json (default
+benchmarks/results/load-<timestamp>.json). --compare prints each headline metric against an
+earlier run.
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import subprocess
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+from common import BACKEND_DIR, setup_django, bench_database, summarize
+
+setup_django()
+
+import django  # noqa: E402
+import requests  # noqa: E402
+from django.core.cache import cache  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.test import Client, override_settings  # noqa: E402
+
+from api.cache import reset_weather_cache  # noqa: E402
+from api.clients import reset_weather_client  # noqa: E402
+from api.demand import demand_tracker  # noqa: E402
+from api.history import history_writer  # noqa: E402
+from api.quota import reset_upstream_quota  # noqa: E402
+from api.views import WeatherView  # noqa: E402
+from benchmarks.stub_provider import StubProvider  # noqa: E402
+
+RESULTS_DIR = os.path.join(BACKEND_DIR, 'benchmarks', 'results')
+PASSWORD = 'load-test-Passw0rd'
+HEADLINE_METRICS = [
+    ('overall', 'throughput_rps'), ('overall', 'p50_ms'), ('overall', 'p95_ms'), ('overall', 'p99_ms'),
+    ('overall', 'errors'), ('weather', 'hit_ratio'), ('weather', 'upstream_calls'),
+]
+
+
+class InProcessClient:
+    """
+    Django test client: the full middleware and view stack, without a network hop.
+    """
+
+    def __init__(self):
+        self.client = Client()
+
+    def request(self, method, path, params=None, body=None, headers=None):
+        if method == 'GET':
+            response = self.client.get(path, params, headers=headers)
+        else:
+            response = self.client.post(path, json.dumps(body), content_type='application/json', headers=headers)
+        content = b''.join(response.streaming_content) if response.streaming else response.content
+        return response.status_code, response.headers, content
+
+
+class HttpClient:
+    """
+    Keep-alive HTTP session against a running server.
+    """
+
+    def __init__(self, target):
+        self.target = target.rstrip('/')
+        self.session = requests.Session()
+
+    def request(self, method, path, params=None, body=None, headers=None):
+        response = self.session.request(method, self.target + path, params=params, json=body, headers=headers,
+                                        timeout=30)
+        return response.status_code, response.headers, response.content
+
+
+def zipf_weights(count, exponent):
+    """
+    Cumulative weights of ranks 1..count under a Zipf distribution: rank r is requested
+    proportionally to 1 / r**exponent.
+    """
+    return list(itertools.accumulate(1 / rank ** exponent for rank in range(1, count + 1)))
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in ('weather', 'history', 'login', 'refresh'):
+            raise argparse.ArgumentTypeError(f"Unknown traffic type: {name}")
+        mix[name] = float(weight)
+    return mix
+
+
+def sign_up(client, count):
+    """
+    Register (or reuse) `count` load-test users and log each in once: [(username, access, refresh)].
+    """
+    users = []
+    for i in range(count):
+        username = f"loaduser{i}"
+        client.request('POST', '/auth/register/', body={
+            'username': username, 'email': f"{username}@example.com", 'phone': f"+1555{i:07d}", 'password': PASSWORD,
+        })
+        status, _, content = client.request('POST', '/auth/login/', body={'username': username, 'password': PASSWORD})
+        if status != 200:
+            raise SystemExit(f"Could not log in {username}: {status} {content[:200]!r}")
+        tokens = json.loads(content)
+        users.append((username, tokens['access'], tokens['refresh']))
+    return users
+
+
+def worker(client, plan, users, cities, cum_weights, auth_share, seed, records):
+    """
+    Run operations until the shared plan (an iterator of traffic types) is exhausted.
+    Appends (type, latency, status, X-Cache-Status) per operation to `records`.
+    """
+    rng = random.Random(seed)
+    local = []
+    for kind in plan:
+        username, access, refresh = rng.choice(users)
+        auth = {'Authorization': f"Bearer {access}"}
+        started = time.perf_counter()
+        try:
+            if kind == 'weather':
+                city, state, country = rng.choices(cities, cum_weights=cum_weights)[0]
+                status, headers, _ = client.request(
+                    'GET', '/api/weather/', params={'city': city, 'state': state, 'country': country},
+                    headers=auth if rng.random() < auth_share else None,
+                )
+            elif kind == 'history':
+                status, headers, _ = client.request('GET', '/api/history/', params={'page_size': 20}, headers=auth)
+            elif kind == 'login':
+                status, headers, _ = client.request(
+                    'POST', '/auth/login/', body={'username': username, 'password': PASSWORD},
+                )
+            else:
+                status, headers, _ = client.request('POST', '/auth/token/refresh/', body={'refresh': refresh})
+            cache_status = headers.get('X-Cache-Status')
+        except requests.exceptions.RequestException:
+            status, cache_status = None, None
+        local.append((kind, time.perf_counter() - started, status, cache_status))
+    records.extend(local)
+    connection.close()
+
+
+def run_load(args, make_client, upstream_calls):
+    mix = args.mix
+    cities = [(f"LOADCITY{rank}", 'ST', 'IN') for rank in range(1, args.cities + 1)]
+    cum_weights = zipf_weights(len(cities), args.zipf)
+    users = sign_up(make_client(), args.users)
+
+    rng = random.Random(args.seed)
+    kinds = rng.choices(list(mix), weights=list(mix.values()), k=args.requests)
+    plan = iter(kinds)
+    plan_lock = threading.Lock()
+
+    def shared_plan():
+        while True:
+            with plan_lock:
+                kind = next(plan, None)
+            if kind is None:
+                return
+            yield kind
+
+    records = []
+    calls_before = upstream_calls()
+    threads = [
+        threading.Thread(target=worker, args=(
+            make_client(), shared_plan(), users, cities, cum_weights, args.auth_share, args.seed + i, records,
+        ))
+        for i in range(args.threads)
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return report(records, elapsed, upstream_calls() - calls_before if calls_before is not None else None)
+
+
+def report(records, elapsed, upstream_calls):
+    def summary(rows):
+        stats = summarize([row[1] for row in rows], elapsed)
+        stats['errors'] = sum(1 for row in rows if row[2] is None or row[2] >= 400)
+        stats['statuses'] = dict(Counter(str(row[2]) for row in rows))
+        return stats
+
+    endpoints = {}
+    for kind in sorted({row[0] for row in records}):
+        endpoints[kind] = summary([row for row in records if row[0] == kind])
+
+    weather = [row for row in records if row[0] == 'weather']
+    cache_statuses = Counter(row[3] or 'NONE' for row in weather)
+    return {
+        'overall': summary(records),
+        'endpoints': endpoints,
+        'weather': {
+            'hit_ratio': round(cache_statuses['HIT'] / len(weather), 4) if weather else None,
+            'cache_status': dict(cache_statuses),
+            'upstream_calls': upstream_calls,
+        },
+    }
+
+
+def metadata():
+    try:
+        commit = subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=BACKEND_DIR,
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'django': django.get_version(),
+    }
+
+
+def compare(old, new):
+    """
+    {metric: {'old', 'new', 'change_pct'}} for the headline metrics of two result files.
+    """
+    changes = {}
+    for section, metric in HEADLINE_METRICS:
+        before, after = old.get(section, {}).get(metric), new.get(section, {}).get(metric)
+        change = round((after - before) / before * 100, 1) if before and after is not None else None
+        changes[f"{section}.{metric}"] = {'old': before, 'new': after, 'change_pct': change}
+    for kind, stats in new.get('endpoints', {}).items():
+        before, after = old.get('endpoints', {}).get(kind, {}).get('p95_ms'), stats.get('p95_ms')
+        change = round((after - before) / before * 100, 1) if before and after is not None else None
+        changes[f"endpoints.{kind}.p95_ms"] = {'old': before, 'new': after, 'change_pct': change}
+    return changes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--cities', type=int, default=2000, help='size of the city catalogue')
+    parser.add_argument('--zipf', type=float, default=1.1, help='Zipf exponent of city popularity')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--auth-share', type=float, default=0.5, help='share of weather requests with a token')
+    parser.add_argument('--mix', type=parse_mix, default='weather=80,history=15,login=2,refresh=3')
+    parser.add_argument('--latency', type=float, default=0.05, help='stub upstream latency in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of stub calls answered with 503')
+    parser.add_argument('--payload-bytes', type=int, help='pad stub payloads to about this size')
+    parser.add_argument('--target', help='base URL of a running server (default: in-process)')
+    parser.add_argument('--stub-url', help='stub provider base URL, to count upstream calls with --target')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--compare', metavar='OLD_JSON', help='compare the run with an earlier result file')
+    parser.add_argument('--no-run', action='store_true', help='with --compare and --json: only compare the two files')
+    args = parser.parse_args()
+
+    if args.no_run:
+        with open(args.compare) as old, open(args.json) as new:
+            print(json.dumps(compare(json.load(old), json.load(new)), indent=2))
+        return
+
+    config = {key: value for key, value in vars(args).items() if key not in ('json', 'compare', 'no_run')}
+    if args.target:
+        def upstream_calls():
+            if not args.stub_url:
+                return None
+            return requests.get(args.stub_url.rstrip('/') + '/__stats__', timeout=5).json()['calls']
+
+        results = run_load(args, lambda: HttpClient(args.target), upstream_calls)
+    else:
+        # Measure the service, not the rate limits
+        WeatherView.throttle_classes = []
+        with bench_database(), StubProvider(
+            latency=args.latency, error_rate=args.error_rate, payload_bytes=args.payload_bytes,
+        ) as stub, override_settings(
+            WEATHER_API_BASE_URL=stub.url, WEATHER_UPSTREAM_CALLS_PER_MINUTE=0, WEATHER_UPSTREAM_CALLS_PER_DAY=0,
+        ):
+            cache.clear()
+            reset_weather_cache()
+            reset_weather_client()
+            reset_upstream_quota()
+            results = run_load(args, InProcessClient, lambda: stub.calls)
+            # Write what is still buffered while the throwaway database exists
+            history_writer.flush()
+            demand_tracker.flush()
+
+    results = {'config': config, 'meta': metadata(), **results}
+    path = args.json or os.path.join(RESULTS_DIR, f"load-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    output = results
+    if args.compare:
+        with open(args.compare) as f:
+            output = {'results': results, 'compare': compare(json.load(f), results)}
+    print(json.dumps(output, indent=2))
+    print(f"Saved to {path}")
+
+
+if __name__ == '__main__':
+    main()
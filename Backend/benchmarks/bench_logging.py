@@ -0,0 +1,147 @@
+"""
+Cache-hit latency under concurrent load with each logging pipeline.
+
+    python benchmarks/bench_logging.py --threads 8 --requests 3000 --sink-latency-ms 0 1 5
+
+Every GET /api/weather/ below is a local cache hit, which logs one INFO record. Pipelines:
+
+  sync      the previous LOGGING: FileHandler and console StreamHandler called on the request thread
+  queue     settings.LOGGING: records queued for a listener thread (JSON file, rotating), no sampling
+  sampled   settings.LOGGING as shipped: queued, and 1 in 100 cache-hit records kept
+
+--sink-latency-ms adds a delay to each console write, like a slow terminal, pipe or log shipper.
+The listener absorbs it; request threads only see it under the sync pipeline.
+"""
+import argparse
+import copy
+import json
+import logging
+import logging.config
+import os
+import tempfile
+import threading
+import time
+
+from common import setup_django, bench_database, summarize
+
+setup_django()
+
+from django.conf import settings  # noqa: E402
+from django.core.cache import cache  # noqa: E402
+from django.test import Client, override_settings  # noqa: E402
+
+from api.cache import reset_weather_cache  # noqa: E402
+from api.clients import reset_weather_client  # noqa: E402
+from api.demand import demand_tracker  # noqa: E402
+from api.views import WeatherView  # noqa: E402
+from benchmarks.stub_provider import StubProvider  # noqa: E402
+from core.logs import start_queue_listeners, stop_queue_listeners  # noqa: E402
+
+PARAMS = {'city': 'Patna', 'state': 'BR', 'country': 'IN'}
+
+
+class SlowStream:
+    """
+    Console stand-in: each write waits `latency` seconds (releasing the GIL, like blocked I/O).
+    """
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.stream = open(os.devnull, 'w')
+
+    def write(self, text):
+        if self.latency:
+            time.sleep(self.latency)
+        return self.stream.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+
+def logging_config(pipeline, log_dir, stream):
+    console = {'()': lambda: logging.StreamHandler(stream)}
+    if pipeline == 'sync':
+        file_handler = {'level': 'INFO', 'class': 'logging.FileHandler', 'formatter': 'verbose',
+                        'filename': os.path.join(log_dir, 'sync.log')}
+        return {
+            'version': 1,
+            'disable_existing_loggers': False,
+            'formatters': {'verbose': {'format': '{levelname} {asctime} {module} {message}', 'style': '{'}},
+            'handlers': {'file': file_handler, 'console': console},
+            'loggers': {
+                name: {'handlers': ['console', 'file'], 'level': 'INFO', 'propagate': True}
+                for name in ('django', 'api', 'core')
+            },
+        }
+    config = copy.deepcopy({key: value for key, value in settings.LOGGING.items() if key != 'handlers'})
+    config['handlers'] = {name: dict(handler) for name, handler in settings.LOGGING['handlers'].items()}
+    config['handlers']['console'] = console
+    config['handlers']['file']['filename'] = os.path.join(log_dir, f"{pipeline}.log")
+    if pipeline == 'queue':
+        config['filters']['sample_hits']['rate'] = 1.0
+    return config
+
+
+def run(pipeline, sink_latency, args, log_dir):
+    stream = SlowStream(sink_latency / 1000)
+    # dictConfig leaves the filters of loggers it is not given alone (the hit sampler)
+    logging.getLogger('api.services.hits').filters.clear()
+    logging.config.dictConfig(logging_config(pipeline, log_dir, stream))
+    start_queue_listeners()
+    clients = [Client() for _ in range(args.threads)]
+    for client in clients:
+        assert client.get('/api/weather/', PARAMS)['X-Cache-Status'] == 'HIT'
+
+    results = []
+
+    def worker(client):
+        latencies = []
+        for _ in range(args.requests // args.threads):
+            started = time.perf_counter()
+            client.get('/api/weather/', PARAMS)
+            latencies.append(time.perf_counter() - started)
+        results.extend(latencies)
+
+    threads = [threading.Thread(target=worker, args=(client,)) for client in clients]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    # Drains the queue: the listener's backlog is reported, not hidden
+    drain_started = time.perf_counter()
+    stop_queue_listeners()
+    stats = summarize(results, elapsed)
+    stats['drain_s'] = round(time.perf_counter() - drain_started, 3)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=3000)
+    parser.add_argument('--sink-latency-ms', type=float, nargs='+', default=[0, 1, 5])
+    parser.add_argument('--pipelines', nargs='+', choices=['sync', 'queue', 'sampled'],
+                        default=['sync', 'queue', 'sampled'])
+    args = parser.parse_args()
+
+    WeatherView.throttle_classes = []
+    results = {}
+    with tempfile.TemporaryDirectory() as log_dir, bench_database(), StubProvider() as stub, override_settings(
+        WEATHER_API_BASE_URL=stub.url, WEATHER_UPSTREAM_CALLS_PER_MINUTE=0, WEATHER_UPSTREAM_CALLS_PER_DAY=0,
+    ):
+        cache.clear()
+        reset_weather_cache()
+        reset_weather_client()
+        Client().get('/api/weather/', PARAMS)  # fills the cache
+        for sink_latency in args.sink_latency_ms:
+            results[f"sink_{sink_latency:g}ms"] = {
+                pipeline: run(pipeline, sink_latency, args, log_dir) for pipeline in args.pipelines
+            }
+        demand_tracker.flush()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
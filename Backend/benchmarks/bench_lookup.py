@@ -0,0 +1,105 @@
+"""
+WeatherCache lookup: the old case-insensitive (city, state, country) filter versus the
+precomputed, indexed lookup_key.
+
+    python benchmarks/bench_lookup.py --rows 1000000 --lookups 2000
+
+The old query is rebuilt with `__iexact` filters and the old composite index restored, so both
+run against the same table. Prints the SQLite query plan and latency percentiles for each.
+"""
+import argparse
+import json
+import random
+import time
+
+from common import setup_django, bench_database, summarize
+
+setup_django()
+
+from django.db import connection, transaction  # noqa: E402
+from django.utils import timezone  # noqa: E402
+
+from api.models import WeatherCache, build_lookup_key  # noqa: E402
+
+
+def populate(rows):
+    now = timezone.now()
+    payload = json.dumps({'main': {'temp': 21.5}, 'name': 'x'})
+    # One transaction: in autocommit mode every row would be its own fsync
+    with transaction.atomic(), connection.cursor() as cursor:
+        batch = []
+        for i in range(rows):
+            city, state, country = f"CITY{i}", (f"S{i % 50}" if i % 3 else None), f"C{i % 200}"
+            batch.append((city, state, country, build_lookup_key(city, state, country), payload, now, 0))
+            if len(batch) == 10000:
+                cursor.executemany(
+                    "INSERT INTO api_weathercache (city, state, country, lookup_key, data, updated_at, hit_count) "
+                    "VALUES (%s, %s, %s, %s, %s, %s, %s)", batch)
+                batch = []
+        if batch:
+            cursor.executemany(
+                "INSERT INTO api_weathercache (city, state, country, lookup_key, data, updated_at, hit_count) "
+                "VALUES (%s, %s, %s, %s, %s, %s, %s)", batch)
+        # The pre-lookup_key composite index, so the baseline is measured as it was deployed
+        cursor.execute("CREATE INDEX city_country_idx ON api_weathercache (city, state, country)")
+        cursor.execute("ANALYZE")
+
+
+def legacy_lookup(city, state, country):
+    query = WeatherCache.objects.filter(city__iexact=city)
+    if state:
+        query = query.filter(state__iexact=state)
+    if country:
+        query = query.filter(country__iexact=country)
+    return query.order_by('-updated_at').first()
+
+
+def query_plan(queryset):
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+        return [row[-1] for row in cursor.fetchall()]
+
+
+def measure(fn, keys):
+    latencies = []
+    started = time.perf_counter()
+    for key in keys:
+        t0 = time.perf_counter()
+        assert fn(*key) is not None
+        latencies.append(time.perf_counter() - t0)
+    return summarize(latencies, time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--lookups', type=int, default=2000)
+    args = parser.parse_args()
+
+    with bench_database():
+        started = time.perf_counter()
+        populate(args.rows)
+        print(f"Inserted {args.rows} rows in {time.perf_counter() - started:.1f}s")
+
+        sample = random.sample(range(args.rows), min(args.lookups, args.rows))
+        # Mixed-case input, as users type it
+        keys = [(f"city{i}", (f"s{i % 50}" if i % 3 else None), f"c{i % 200}") for i in sample]
+
+        city, state, country = keys[0]
+        legacy_qs = WeatherCache.objects.filter(city__iexact=city, state__iexact=state or 'S1', country__iexact=country)
+        results = {
+            'legacy_iexact': {
+                'plan': query_plan(legacy_qs.order_by('-updated_at')),
+                **measure(legacy_lookup, keys),
+            },
+            'lookup_key': {
+                'plan': query_plan(WeatherCache.objects._valid_cache_query(city, state, country)),
+                **measure(WeatherCache.objects.get_valid_cache, keys),
+            },
+        }
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Cost of the metrics instrumentation on the hot path.
+
+    python benchmarks/bench_metrics.py --iterations 200000 --requests 3000
+
+  primitives    Counter.inc and Histogram.observe, per call
+  middleware    MetricsMiddleware around a view that returns at once (query timer, route,
+                latency and query-count histograms), per request
+  cache_hit     a full GET /api/weather/ answered from the local tier, with and without
+                MetricsMiddleware (median of interleaved rounds; the difference is within noise)
+"""
+import argparse
+import json
+import logging
+import statistics
+import time
+import timeit
+
+from common import setup_django, bench_database
+
+setup_django()
+
+from django.conf import settings  # noqa: E402
+from django.core.cache import cache  # noqa: E402
+from django.http import HttpResponse  # noqa: E402
+from django.test import Client, RequestFactory, override_settings  # noqa: E402
+from django.urls import resolve  # noqa: E402
+
+from api.cache import reset_weather_cache  # noqa: E402
+from api.clients import reset_weather_client  # noqa: E402
+from api.demand import demand_tracker  # noqa: E402
+from api.metrics import Counter, Histogram  # noqa: E402
+from api.views import WeatherView  # noqa: E402
+from benchmarks.stub_provider import StubProvider  # noqa: E402
+from core.middleware import MetricsMiddleware  # noqa: E402
+
+
+def per_call_us(statement, iterations, setup='pass', namespace=None):
+    best = min(timeit.repeat(statement, setup=setup, globals=namespace, number=iterations, repeat=5))
+    return round(best / iterations * 1e6, 3)
+
+
+def bench_primitives(iterations):
+    counter = Counter('bench', 'bench', ('route',))
+    histogram = Histogram('bench_seconds', 'bench', ('method', 'route', 'status'))
+    namespace = {'counter': counter, 'histogram': histogram}
+    return {
+        'counter_inc_us': per_call_us("counter.inc('api/weather/')", iterations, namespace=namespace),
+        'histogram_observe_us': per_call_us(
+            "histogram.observe(0.0012, 'GET', 'api/weather/', 200)", iterations, namespace=namespace,
+        ),
+    }
+
+
+def bench_middleware(iterations):
+    response = HttpResponse(b'{}')
+    request = RequestFactory().get('/api/weather/', {'city': 'Patna', 'state': 'BR', 'country': 'IN'})
+    request.resolver_match = resolve('/api/weather/')
+    middleware = MetricsMiddleware(lambda request: response)
+    namespace = {'middleware': middleware, 'request': request, 'view': lambda request: response}
+    bare = per_call_us('view(request)', iterations, namespace=namespace)
+    wrapped = per_call_us('middleware(request)', iterations, namespace=namespace)
+    return {'bare_us': bare, 'with_metrics_us': wrapped, 'overhead_us': round(wrapped - bare, 3)}
+
+
+def bench_cache_hit(requests, rounds):
+    params = {'city': 'Patna', 'state': 'BR', 'country': 'IN'}
+    without = [name for name in settings.MIDDLEWARE if name != 'core.middleware.MetricsMiddleware']
+    clients = {'with_metrics': Client()}
+    with override_settings(MIDDLEWARE=without):
+        clients['without_metrics'] = Client()
+        clients['without_metrics'].get('/api/weather/', params)  # builds its middleware chain now
+    assert clients['with_metrics'].get('/api/weather/', params)['X-Cache-Status'] in ('HIT', 'MISS')
+
+    medians = {name: [] for name in clients}
+    for _ in range(rounds):
+        for name, client in clients.items():
+            latencies = []
+            for _ in range(requests // rounds):
+                started = time.perf_counter()
+                client.get('/api/weather/', params)
+                latencies.append(time.perf_counter() - started)
+            medians[name].append(statistics.median(latencies))
+    results = {f"{name}_us": round(statistics.median(values) * 1e6, 1) for name, values in medians.items()}
+    results['difference_us'] = round(results['with_metrics_us'] - results['without_metrics_us'], 1)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=200000)
+    parser.add_argument('--requests', type=int, default=3000)
+    parser.add_argument('--rounds', type=int, default=10)
+    args = parser.parse_args()
+
+    WeatherView.throttle_classes = []
+    logging.getLogger('api').setLevel(logging.WARNING)
+    results = {'primitives': bench_primitives(args.iterations), 'middleware': bench_middleware(args.iterations)}
+    with bench_database(), StubProvider() as stub, override_settings(
+        WEATHER_API_BASE_URL=stub.url, WEATHER_UPSTREAM_CALLS_PER_MINUTE=0, WEATHER_UPSTREAM_CALLS_PER_DAY=0,
+    ):
+        cache.clear()
+        reset_weather_cache()
+        reset_weather_client()
+        results['cache_hit'] = bench_cache_hit(args.requests, args.rounds)
+        demand_tracker.flush()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+CPU per cache hit of the weather endpoint, with and without pre-rendered response bodies.
+
+    python benchmarks/bench_render.py --hits 5000
+
+Every request is a warm in-process (LocalMemoryTier) hit, so the difference between modes is
+the cost of producing the response body. Modes:
+
+  drf          WEATHER_CACHE_PRERENDER off: DRF renders `data` to JSON on every hit (uncompressed)
+  drf+gzip     same, plus GZipMiddleware compressing every response
+  prerendered  stored bytes streamed as-is (gzip variant, negotiated from Accept-Encoding)
+
+Throttling is disabled for the run; only CPU time (time.process_time) of the request thread is counted.
+"""
+import argparse
+import json
+import logging
+import time
+
+from common import setup_django, bench_database
+
+setup_django()
+
+from django.conf import settings  # noqa: E402
+from django.core.cache import cache  # noqa: E402
+from django.test import Client, override_settings  # noqa: E402
+
+from api.cache import CacheEntry, get_weather_cache, reset_weather_cache  # noqa: E402
+from api.demand import demand_tracker  # noqa: E402
+from api.views import WeatherView  # noqa: E402
+from benchmarks.stub_provider import make_payload  # noqa: E402
+
+QUERY = {'city': 'Patna', 'state': 'Bihar', 'country': 'IN'}
+
+
+def warm_cache():
+    from django.utils import timezone
+
+    reset_weather_cache()
+    cache.clear()
+    get_weather_cache().set('PATNA', 'BIHAR', 'IN', CacheEntry(
+        data=make_payload('PATNA', 'IN'), updated_at=timezone.now(), city='PATNA', state='BIHAR', country='IN',
+    ))
+
+
+def measure(hits):
+    warm_cache()
+    client = Client()
+    response = client.get('/api/weather/', QUERY, HTTP_ACCEPT_ENCODING='gzip, deflate, br')
+    assert response.status_code == 200 and response['X-Cache-Status'] == 'HIT', response.status_code
+
+    cpu_started = time.process_time()
+    wall_started = time.perf_counter()
+    for _ in range(hits):
+        response = client.get('/api/weather/', QUERY, HTTP_ACCEPT_ENCODING='gzip, deflate, br')
+    cpu = time.process_time() - cpu_started
+    wall = time.perf_counter() - wall_started
+    return {
+        'cpu_us_per_hit': round(cpu / hits * 1e6, 1),
+        'wall_us_per_hit': round(wall / hits * 1e6, 1),
+        'content_encoding': response.get('Content-Encoding', 'identity'),
+        'body_bytes': len(response.content),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--hits', type=int, default=5000)
+    args = parser.parse_args()
+
+    WeatherView.throttle_classes = []
+    # Per-hit INFO logging would dominate (and flood the terminal); it is the same in every mode
+    logging.getLogger('api').setLevel(logging.WARNING)
+    gzip_middleware = ['django.middleware.gzip.GZipMiddleware'] + list(settings.MIDDLEWARE)
+
+    with bench_database():
+        results = {}
+        with override_settings(WEATHER_CACHE_PRERENDER=False):
+            results['drf'] = measure(args.hits)
+            with override_settings(MIDDLEWARE=gzip_middleware):
+                results['drf+gzip'] = measure(args.hits)
+        with override_settings(WEATHER_CACHE_PRERENDER=True):
+            results['prerendered'] = measure(args.hits)
+        demand_tracker.flush()
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
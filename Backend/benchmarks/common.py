@@ -0,0 +1,61 @@
+"""
+Shared helpers for the benchmark scripts: Django bootstrap, a throwaway database and stats.
+"""
+import os
+import sys
+import tempfile
+from contextlib import contextmanager
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup_django():
+    if BACKEND_DIR not in sys.path:
+        sys.path.insert(0, BACKEND_DIR)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
+    import django
+    django.setup()
+
+
+@contextmanager
+def bench_database():
+    """
+    Migrated throwaway SQLite file database (never touches db.sqlite3).
+    A file (not :memory:) so that several threads can share it like real workers do.
+    """
+    from django.conf import settings
+    from django.test.utils import setup_test_environment, teardown_test_environment
+    from django.test.runner import DiscoverRunner
+
+    with tempfile.TemporaryDirectory() as tmp:
+        settings.DATABASES['default'].setdefault('TEST', {})['NAME'] = os.path.join(tmp, 'bench.sqlite3')
+        setup_test_environment()
+        runner = DiscoverRunner(verbosity=0, interactive=False)
+        old_config = runner.setup_databases()
+        try:
+            yield
+        finally:
+            runner.teardown_databases(old_config)
+            teardown_test_environment()
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def summarize(latencies, elapsed):
+    """
+    Throughput and latency percentiles (milliseconds) for a list of per-request latencies in seconds.
+    """
+    return {
+        'requests': len(latencies),
+        'elapsed_s': round(elapsed, 3),
+        'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else None,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2) if latencies else None,
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+    }
@@ -0,0 +1,162 @@
+"""
+Local stand-in for the OpenWeatherMap current-weather API.
+
+Run standalone:
+    python benchmarks/stub_provider.py --port 8055 --latency 0.2 --error-rate 0.05 --payload-bytes 4096
+
+and point the backend at it:
+    WEATHER_API_BASE_URL=http://127.0.0.1:8055/data/2.5/weather python manage.py runserver
+
+or embed it in a script:
+    with StubProvider(latency=0.2) as stub:
+        ... stub.url ... stub.calls ...
+
+Cities whose name starts with "NOWHERE" return 404 like a real "city not found".
+`GET /__stats__` returns the number of calls served.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+WEATHER_PATH = '/data/2.5/weather'
+
+
+def make_payload(city, country, lat=None, lon=None, size=None):
+    """
+    Payload shaped like a real OpenWeatherMap response (about 500 bytes).
+    With `size`, a filler field pads the serialized payload to roughly that many bytes.
+    """
+    seed = sum(ord(c) for c in city)
+    payload = {
+        'coord': {
+            'lon': lon if lon is not None else round((seed % 360) - 180 + 0.1234, 4),
+            'lat': lat if lat is not None else round((seed % 180) - 90 + 0.5678, 4),
+        },
+        'weather': [{'id': 800, 'main': 'Clear', 'description': 'clear sky', 'icon': '01d'}],
+        'base': 'stations',
+        'main': {
+            'temp': round(15 + seed % 20 + random.random(), 2),
+            'feels_like': 20.1, 'temp_min': 14.0, 'temp_max': 31.0,
+            'pressure': 1012, 'humidity': 40 + seed % 50,
+        },
+        'visibility': 10000,
+        'wind': {'speed': 3.6, 'deg': 250},
+        'clouds': {'all': 0},
+        'dt': int(time.time()),
+        'sys': {'type': 1, 'id': seed, 'country': country, 'sunrise': 1700000000, 'sunset': 1700040000},
+        'timezone': 19800,
+        'id': seed,
+        'name': city.title(),
+        'cod': 200,
+    }
+    if size:
+        payload['padding'] = 'x' * max(0, size - len(json.dumps(payload)) - 15)
+    return payload
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real provider
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body):
+        raw = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        if url.path == '/__stats__':
+            return self._send(200, {'calls': server.calls})
+        if url.path != WEATHER_PATH:
+            return self._send(404, {'cod': '404', 'message': 'Internal error'})
+
+        with server.lock:
+            server.calls += 1
+        if server.latency:
+            time.sleep(server.latency)
+        if server.error_rate and random.random() < server.error_rate:
+            return self._send(503, {'cod': '503', 'message': 'Service Unavailable'})
+
+        query = parse_qs(url.query)
+        if 'lat' in query and 'lon' in query:
+            lat, lon = float(query['lat'][0]), float(query['lon'][0])
+            city, country = f"GRID {round(lat, 1)} {round(lon, 1)}", 'XX'
+            return self._send(200, make_payload(city, country, lat=lat, lon=lon, size=server.payload_bytes))
+
+        parts = [p.strip() for p in query.get('q', [''])[0].split(',')]
+        city = parts[0]
+        country = parts[-1] if len(parts) > 1 else 'XX'
+        if not city or city.upper().startswith('NOWHERE'):
+            return self._send(404, {'cod': '404', 'message': 'city not found'})
+        return self._send(200, make_payload(city, country[:2].upper(), size=server.payload_bytes))
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # the default backlog of 5 would serialize concurrent clients
+
+
+class StubProvider:
+    """
+    Threaded stub server running in the background for the lifetime of the context manager.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, error_rate=0.0, payload_bytes=None):
+        self.server = StubServer((host, port), StubHandler)
+        self.server.latency = latency
+        self.server.error_rate = error_rate
+        self.server.payload_bytes = payload_bytes
+        self.server.calls = 0
+        self.server.lock = threading.Lock()
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}{WEATHER_PATH}"
+
+    @property
+    def calls(self):
+        return self.server.calls
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8055)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every call')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of calls answered with 503')
+    parser.add_argument('--payload-bytes', type=int, help='pad successful payloads to about this size')
+    args = parser.parse_args()
+
+    stub = StubProvider(args.host, args.port, latency=args.latency, error_rate=args.error_rate,
+                        payload_bytes=args.payload_bytes)
+    print(f"Stub OpenWeatherMap listening on {stub.url}")
+    try:
+        stub.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
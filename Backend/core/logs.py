@@ -0,0 +1,158 @@
+"""
+Logging pipeline: request threads only enqueue records, a background listener formats and writes them.
+
+Wired up in settings.LOGGING:
+  QueueHandler     bounded queue in front of the real handlers (console, rotating JSON file),
+                   which are attached to a sink logger that nothing logs to directly
+  JsonFormatter    one JSON object per line, with the request id and the structured fields below
+  SamplingFilter   keeps a fraction of a high-volume logger's records (cache hits)
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import threading
+import weakref
+from contextvars import ContextVar
+from datetime import datetime, timezone
+
+# Id of the request being handled (RequestIdMiddleware); a context variable, so it follows
+# async views and sync_to_async worker threads
+current_request_id = ContextVar('current_request_id', default=None)
+
+# Fields passed with `extra=` that JsonFormatter writes out
+STRUCTURED_FIELDS = (
+    'request_id', 'city', 'state', 'country', 'lat', 'lon', 'cache', 'status', 'status_code', 'sample_rate',
+)
+
+_queue_handlers = weakref.WeakSet()
+_traceback_formatter = logging.Formatter()
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts records on a bounded queue; a QueueListener thread hands them to the handlers of the
+    `sink` logger (configured with propagate off, so they only see queued records). The request
+    thread only merges the message arguments and captures the request id; formatting and I/O
+    happen on the listener. When the queue is full (the sink cannot keep up) records are dropped
+    and counted instead of blocking requests.
+    """
+
+    def __init__(self, sink, maxsize=10000):
+        super().__init__(queue.Queue(maxsize))
+        self.sink = sink
+        self.listener = None
+        self.dropped = 0
+        self._start_lock = threading.Lock()
+        _queue_handlers.add(self)
+
+    def start(self):
+        """
+        Start the listener. Called once logging is configured (the sink's handlers are set up in
+        the same dictConfig call, after this one); records logged earlier wait in the queue.
+        """
+        with self._start_lock:
+            if self.listener is not None:
+                return
+            handlers = logging.getLogger(self.sink).handlers
+            self.listener = logging.handlers.QueueListener(self.queue, *handlers, respect_handler_level=True)
+            self.listener.start()
+
+    def prepare(self, record):
+        # Arguments may be mutated once the call returns, and tracebacks must be rendered while
+        # the frames exist: resolve both here, leave the rest of the formatting to the listener.
+        # The record is not copied: this is the only handler on the loggers it is attached to.
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = _traceback_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        if getattr(record, 'request_id', None) is None:
+            record.request_id = current_request_id.get()
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def stats(self):
+        return {'pending': self.queue.qsize(), 'capacity': self.queue.maxsize, 'dropped': self.dropped}
+
+    def close(self):
+        # Drain what is queued into the target handlers before they are closed
+        # (logging.shutdown closes handlers newest first, and this one is created last)
+        with self._start_lock:
+            if self.listener is not None:
+                self.listener.stop()
+                self.listener = None
+        _queue_handlers.discard(self)
+        super().close()
+
+
+def start_queue_listeners():
+    for handler in list(_queue_handlers):
+        handler.start()
+
+
+def queue_handler_stats():
+    """
+    Queue depth and dropped records of every QueueHandler, by handler name.
+    """
+    return {handler.name or 'queue': handler.stats() for handler in list(_queue_handlers)}
+
+
+@atexit.register
+def stop_queue_listeners():
+    # Registered after logging's own shutdown hook, so it runs first
+    for handler in list(_queue_handlers):
+        handler.close()
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line: time (UTC, ISO 8601), level, logger, message, the STRUCTURED_FIELDS
+    present on the record and the traceback if any.
+    """
+
+    def format(self, record):
+        data = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in STRUCTURED_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exc'] = record.exc_text
+        return json.dumps(data, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps about `rate` of the records at or below `level` (all records above it pass), and tags
+    the kept ones with sample_rate so counts can be scaled back up.
+    """
+
+    def __init__(self, rate=1.0, level=logging.INFO):
+        super().__init__()
+        self.rate = float(rate)
+        self.level = level if isinstance(level, int) else logging.getLevelName(level)
+
+    def filter(self, record):
+        if record.levelno > self.level or self.rate >= 1:
+            return True
+        if random.random() >= self.rate:
+            return False
+        record.sample_rate = self.rate
+        return True
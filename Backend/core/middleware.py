@@ -1,21 +1,49 @@
+import hmac
+import random
+import re
+import time
+import uuid
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
 from django.http import JsonResponse
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
 import logging
 
+from api import metrics, profiling
+from core.logs import current_request_id
+
 logger = logging.getLogger(__name__)
 
 class GracefulExceptionMiddleware:
     """
     Middleware to catch exceptions that would otherwise cause a 500 server error crash
     and return a clean JSON response instead, without dumping a traceback to the console.
+    Supports both sync and async stacks, so async views are not forced onto a single thread under ASGI.
     """
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
         self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
 
     def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
         response = self.get_response(request)
-        
-        # Handle 404s for API/Auth routes to prevent HTML leakage
-        if response.status_code == 404 and (request.path.startswith('/api/') or request.path.startswith('/auth/')):
+        return self.process_response(request, response)
+
+    async def __acall__(self, request):
+        response = await self.get_response(request)
+        return self.process_response(request, response)
+
+    def process_response(self, request, response):
+        # Handle 404s for API/Auth routes to prevent HTML leakage (JSON 404s from the views are kept)
+        if (response.status_code == 404
+                and (request.path.startswith('/api/') or request.path.startswith('/auth/'))
+                and not response.get('Content-Type', '').startswith('application/json')):
              return JsonResponse({'error': 'Resource not found', 'path': request.path}, status=404)
         
         return response
@@ -34,3 +62,169 @@ class GracefulExceptionMiddleware:
             'error': 'Internal Server Error',
             'detail': 'An unexpected error occurred. Please contact support.' 
         }, status=500)
+
+
+class MetricsMiddleware:
+    """
+    Records request latency per route (the URL pattern, so label cardinality stays bounded),
+    and the number and total time of each request's database queries.
+    Not installed at all when WEATHER_METRICS_ENABLED is off.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not metrics.metrics_enabled():
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        # Decided once: checking on every call costs as much as the instrumentation itself
+        self.is_async = iscoroutinefunction(self.get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        started = time.perf_counter()
+        timer = metrics.QueryTimer()
+        token = metrics.current_query_timer.set(timer)
+        try:
+            response = self.get_response(request)
+        finally:
+            metrics.current_query_timer.reset(token)
+        self.record(request, response, time.perf_counter() - started, timer)
+        return response
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        timer = metrics.QueryTimer()
+        token = metrics.current_query_timer.set(timer)
+        try:
+            response = await self.get_response(request)
+        finally:
+            metrics.current_query_timer.reset(token)
+        self.record(request, response, time.perf_counter() - started, timer)
+        return response
+
+    @staticmethod
+    def record(request, response, seconds, timer):
+        match = request.resolver_match
+        route = match.route if match is not None else '<unmatched>'
+        metrics.http_request_seconds.observe(seconds, request.method, route, response.status_code)
+        metrics.db_queries_per_request.observe(timer.count, route)
+        if timer.count:
+            metrics.db_query_seconds.inc(route, amount=timer.seconds)
+
+
+class RequestIdMiddleware:
+    """
+    Gives every request an id for its log records (core.logs): the caller's X-Request-ID if it is
+    a plausible one (e.g. set by a load balancer), else a new one. Echoed in the response.
+    """
+    sync_capable = True
+    async_capable = True
+    header_pattern = re.compile(r'[A-Za-z0-9._:-]{1,64}')
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(self.get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        request_id = self.request_id(request)
+        token = current_request_id.set(request_id)
+        try:
+            response = self.get_response(request)
+        finally:
+            current_request_id.reset(token)
+        response['X-Request-ID'] = request_id
+        return response
+
+    async def __acall__(self, request):
+        request_id = self.request_id(request)
+        token = current_request_id.set(request_id)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_request_id.reset(token)
+        response['X-Request-ID'] = request_id
+        return response
+
+    def request_id(self, request):
+        request_id = request.headers.get('X-Request-ID', '')
+        if self.header_pattern.fullmatch(request_id):
+            return request_id
+        return uuid.uuid4().hex
+
+
+class ProfilingMiddleware:
+    """
+    Profiles a sampled share of requests (WEATHER_PROFILING_SAMPLE_RATE), and any request that
+    sends `X-Profile: <WEATHER_PROFILING_TOKEN>`. A profiled request gets a Server-Timing header
+    (database, upstream, the rest of the app) and, with WEATHER_PROFILING_DIR set, a report with
+    its cProfile stats, every SQL query and every upstream call (api/profiling.py).
+    Not installed at all when WEATHER_PROFILING_ENABLED is off.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not profiling.profiling_enabled():
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.sample_rate = getattr(settings, 'WEATHER_PROFILING_SAMPLE_RATE', 0.0)
+        self.token = getattr(settings, 'WEATHER_PROFILING_TOKEN', '')
+        self.is_async = iscoroutinefunction(self.get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if not self.should_profile(request):
+            return self.get_response(request)
+        profile = profiling.RequestProfile()
+        token = profiling.current_profile.set(profile)
+        profile.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            profile.stop()
+            profiling.current_profile.reset(token)
+        return self.finish(request, response, profile)
+
+    async def __acall__(self, request):
+        if not self.should_profile(request):
+            return await self.get_response(request)
+        # No cProfile on the event loop: it would record whatever else the loop runs meanwhile
+        profile = profiling.RequestProfile(use_cprofile=False)
+        token = profiling.current_profile.set(profile)
+        profile.start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            profile.stop()
+            profiling.current_profile.reset(token)
+        return self.finish(request, response, profile)
+
+    def should_profile(self, request):
+        header = request.headers.get('X-Profile')
+        if header is not None:
+            return bool(self.token) and hmac.compare_digest(header, self.token)
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def finish(self, request, response, profile):
+        timing = profile.server_timing()
+        if getattr(settings, 'WEATHER_PROFILING_DIR', None):
+            report = profile.report(request, response, current_request_id.get(),
+                                    getattr(settings, 'WEATHER_PROFILING_TOP', 30))
+            try:
+                name = profiling.save_report(report, profile.profiler)
+                timing += f', profile;desc="{name}"'
+            except OSError as e:
+                logger.warning(f"Could not save request profile: {e}")
+        response['Server-Timing'] = timing
+        return response
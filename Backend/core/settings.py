@@ -54,7 +54,10 @@ INSTALLED_APPS = [
 
 
 MIDDLEWARE = [
+    "core.middleware.MetricsMiddleware",  # outermost, so it times the whole stack
+    "core.middleware.RequestIdMiddleware",
     "core.middleware.GracefulExceptionMiddleware",
+    "core.middleware.ProfilingMiddleware",  # opt-in, see WEATHER_PROFILING_ENABLED
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "corsheaders.middleware.CorsMiddleware",  # Added CORS Middleware
@@ -88,12 +91,60 @@ WSGI_APPLICATION = "core.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/6.0/ref/settings/#databases
 
-DATABASES = {
-    "default": {
-        "ENGINE": "django.db.backends.sqlite3",
-        "NAME": BASE_DIR / "db.sqlite3",
+# WEATHER_DB_PROFILE picks the backend: 'sqlite' (default, a single host) or 'postgres' (several
+# hosts or heavy write load; needs `pip install "psycopg[binary]"` and the POSTGRES_* variables).
+WEATHER_DB_PROFILE = os.getenv("WEATHER_DB_PROFILE", "sqlite")
+# Persistent connections: reused for this many seconds instead of reconnecting (and re-running the
+# SQLite PRAGMAs below) on every request. Use 0 under ASGI, which does not reuse them.
+DB_CONN_MAX_AGE = int(os.getenv("DB_CONN_MAX_AGE", 60))
+
+if WEATHER_DB_PROFILE == "postgres":
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.postgresql",
+            "NAME": os.getenv("POSTGRES_DB", "weather"),
+            "USER": os.getenv("POSTGRES_USER", "weather"),
+            "PASSWORD": os.getenv("POSTGRES_PASSWORD", ""),
+            "HOST": os.getenv("POSTGRES_HOST", "localhost"),
+            "PORT": os.getenv("POSTGRES_PORT", "5432"),
+            "CONN_MAX_AGE": DB_CONN_MAX_AGE,
+            "CONN_HEALTH_CHECKS": True,
+        }
     }
+else:
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": BASE_DIR / "db.sqlite3",
+            "CONN_MAX_AGE": DB_CONN_MAX_AGE,
+            "CONN_HEALTH_CHECKS": True,
+            "OPTIONS": {
+                # Take the write lock at BEGIN: a deferred transaction that reads first and then
+                # writes fails with "database is locked" at once, without waiting for busy_timeout
+                "transaction_mode": "IMMEDIATE",
+            },
+            # A file in WAL mode like the real one: the default in-memory test database shares one
+            # cache between connections, where a read fails with "database table is locked" at
+            # once while another thread writes (the threaded tests would be flaky)
+            "TEST": {"NAME": BASE_DIR / "test_db.sqlite3"},
+        }
+    }
+
+# Applied to every new SQLite connection (api.db.configure_connection)
+WEATHER_SQLITE_PRAGMAS = {
+    # Takes effect only before the first table exists (so first): existing databases switch with
+    # `python manage.py sweep_weather_cache --enable-incremental-vacuum`
+    "auto_vacuum": "INCREMENTAL",
+    "journal_mode": "WAL",  # readers and the writer no longer block each other
+    "synchronous": "NORMAL",  # with WAL: a power loss may drop the last commits, never corrupts
+    "busy_timeout": 5000,  # ms a writer waits for the lock before "database is locked"
+    "cache_size": -20000,  # page cache per connection, in KiB when negative
+    "mmap_size": 256 * 1024 * 1024,  # read the file through the OS page cache, without copies
+    "temp_store": "MEMORY",
 }
+# Writes that still hit a lock (cache and history upserts) are retried with jittered backoff
+WEATHER_DB_LOCK_RETRIES = 3  # attempts in total
+WEATHER_DB_LOCK_RETRY_DELAY = 0.05  # seconds before the first retry, doubling after that
 
 
 # Password validation
@@ -138,9 +189,135 @@ AUTH_USER_MODEL = 'api.User'
 # CACHE TIME
 WEATHER_CACHE_MINUTES = 30
 
+# Stale serving: past WEATHER_CACHE_MINUTES an entry may still be returned (X-Cache-Status: STALE)
+# while it is refreshed in the background, and for much longer when the provider is failing
+WEATHER_CACHE_STALE_WHILE_REVALIDATE_MINUTES = 10
+WEATHER_CACHE_STALE_IF_ERROR_MINUTES = 24 * 60
+WEATHER_BACKGROUND_REFRESH_WORKERS = 2
+
+# Tiered weather cache: fastest first, the Database tier is the durable last tier
+WEATHER_CACHE_TIERS = [
+    'api.cache.LocalMemoryTier',
+    'api.cache.SharedCacheTier',
+    'api.cache.DatabaseTier',
+]
+WEATHER_CACHE_LOCAL_MAX_ENTRIES = int(os.getenv("WEATHER_CACHE_LOCAL_MAX_ENTRIES", 1024))
+# Point this alias at a shared backend (Redis, Memcached, Database) to share hits across workers
+WEATHER_CACHE_SHARED_ALIAS = 'default'
+# Store each entry's rendered JSON response (plus gzip, and brotli if installed) at write time;
+# the weather endpoints then serve those bytes directly, negotiated on Accept-Encoding
+WEATHER_CACHE_PRERENDER = True
+WEATHER_CACHE_COMPRESS_MIN_BYTES = 256  # smaller bodies are not worth compressing
+
+# Negative cache: upstream errors are replayed from the shared cache instead of calling upstream again.
+# "City not found" (404) is stable, provider errors (5xx, 429) only absorb bursts; 0 disables either
+WEATHER_NEGATIVE_CACHE_NOT_FOUND_SECONDS = 300
+WEATHER_NEGATIVE_CACHE_ERROR_SECONDS = 5
+
+# Coordinate lookups (/api/weather/?lat=..&lon=..): any valid entry within the radius answers;
+# misses are snapped to the grid (0.01 degrees is about 1.1 km) before going upstream
+WEATHER_GEO_RADIUS_KM = 5.0
+WEATHER_GEO_GRID_DEGREES = 0.01
+
+# City gazetteer (api/gazetteer.py): /api/cities/?q= autocomplete and canonical city names.
+# The index is memory-mapped (shared by all workers) and built from the bundled seed on first use,
+# and again whenever the seed changes; build a full one from GeoNames with `python manage.py build_gazetteer --geonames cities500.txt`.
+WEATHER_GAZETTEER_ENABLED = True
+WEATHER_GAZETTEER_SOURCE = BASE_DIR / 'api' / 'data' / 'cities.tsv'
+WEATHER_GAZETTEER_INDEX = BASE_DIR / 'gazetteer.idx'
+# Answer unknown cities with a local 404 (and suggestions) instead of asking the provider.
+# Only enable this with a complete gazetteer: the bundled seed has just the major cities.
+WEATHER_GAZETTEER_REJECT_UNKNOWN = os.getenv("WEATHER_GAZETTEER_REJECT_UNKNOWN", "False") == "True"
+
+# Concurrent misses are always coalesced per process; enable this to also serialize
+# upstream fetches across workers (needs a shared cache backend for the lock alias)
+WEATHER_FETCH_LOCK_ENABLED = os.getenv("WEATHER_FETCH_LOCK_ENABLED", "False") == "True"
+WEATHER_FETCH_LOCK_ALIAS = 'default'
+WEATHER_FETCH_LOCK_TIMEOUT = 10  # seconds
+
+# Search history is written behind the request: queued in-process, bulk-upserted by a background thread
+WEATHER_HISTORY_WRITE_BEHIND = True
+WEATHER_HISTORY_FLUSH_SECONDS = 2  # max delay before a search shows up in /api/history/
+WEATHER_HISTORY_BATCH_SIZE = 500  # flush early once this many records are queued
+WEATHER_HISTORY_QUEUE_SIZE = 10000
+WEATHER_HISTORY_DROP_POLICY = 'drop_oldest'  # when full: 'drop_oldest', 'drop_newest' or 'block'
+WEATHER_HISTORY_BLOCK_TIMEOUT = 0.05  # seconds a request may wait with the 'block' policy
+WEATHER_HISTORY_PAGE_SIZE = 50  # /api/history/ rows per page (?page_size= up to the max)
+WEATHER_HISTORY_MAX_PAGE_SIZE = 1000
+WEATHER_HISTORY_STREAM_MIN_ROWS = 200  # pages at least this large are streamed row by row
+
+# Demand tracking and prefetching (python manage.py prefetch_weather)
+WEATHER_DEMAND_FLUSH_SECONDS = 30  # how often request counters are written to WeatherCache.hit_count
+WEATHER_PREFETCH_TOP_N = 100  # keep the N most demanded locations warm
+WEATHER_PREFETCH_LEAD_MINUTES = 5  # refresh this long before expiry
+WEATHER_PREFETCH_CALLS_PER_MINUTE = 30  # upstream budget of the prefetcher
+WEATHER_PREFETCH_WORKERS = 4
+
+# Retention (python manage.py sweep_weather_cache): rows expired for longer than the retention window
+# are deleted in batches, then the least requested rows beyond WEATHER_CACHE_MAX_ROWS are evicted
+WEATHER_CACHE_RETENTION_MINUTES = WEATHER_CACHE_STALE_IF_ERROR_MINUTES  # past expiry
+WEATHER_CACHE_MAX_ROWS = int(os.getenv("WEATHER_CACHE_MAX_ROWS", 100000))  # 0: no cap
+WEATHER_CACHE_EVICTION_GRACE_MINUTES = 10  # new rows get this long to collect hits
+WEATHER_CACHE_HIT_HALF_LIFE_MINUTES = 24 * 60  # hit_count is halved once per period (0: never)
+WEATHER_RETENTION_BATCH_SIZE = 500  # rows per delete transaction
+WEATHER_RETENTION_VACUUM_PAGES = 2000  # SQLite pages returned per sweep (auto_vacuum=INCREMENTAL only)
+WEATHER_RETENTION_INTERVAL_SECONDS = 300
+
+# Batch endpoint (POST /api/weather/batch/)
+WEATHER_BATCH_MAX_ITEMS = 500
+WEATHER_BATCH_MAX_CONCURRENCY = 8  # parallel upstream fetches for the misses of one batch
+
 # API KEY
 WEATHER_API_KEY = os.getenv("WEATHER_API_KEY", "fc32ffca6b17e7a997a35a4a63e670b9")
 
+# Upstream Client (api/clients.py) - point WEATHER_API_BASE_URL at a local stub for testing
+WEATHER_API_BASE_URL = os.getenv("WEATHER_API_BASE_URL", "https://api.openweathermap.org/data/2.5/weather")
+WEATHER_API_CONNECT_TIMEOUT = 3.05  # seconds
+WEATHER_API_READ_TIMEOUT = 10  # seconds
+WEATHER_API_MAX_RETRIES = 2
+WEATHER_API_BACKOFF_BASE = 0.25  # seconds, doubled per retry with full jitter
+WEATHER_API_BACKOFF_MAX = 2.0  # seconds
+WEATHER_API_POOL_SIZE = 20  # keep-alive connections per process
+WEATHER_API_ASYNC_POOL_SIZE = 100  # connections per event loop for the async (aiohttp) client
+WEATHER_CIRCUIT_FAILURE_THRESHOLD = 5  # consecutive failures before failing fast
+WEATHER_CIRCUIT_RESET_SECONDS = 30
+# Upstream call budget (api/quota.py), shared by all workers on the host: set these to the plan's caps.
+# Interactive calls may wait briefly for the next window, then fall back to stale data (or 503);
+# background refreshes only get WEATHER_UPSTREAM_BACKGROUND_SHARE of each window and never wait.
+WEATHER_UPSTREAM_CALLS_PER_MINUTE = int(os.getenv("WEATHER_UPSTREAM_CALLS_PER_MINUTE", 60))
+WEATHER_UPSTREAM_CALLS_PER_DAY = int(os.getenv("WEATHER_UPSTREAM_CALLS_PER_DAY", 30000))
+WEATHER_UPSTREAM_BACKGROUND_SHARE = 0.5
+WEATHER_UPSTREAM_QUOTA_WAIT_SECONDS = 2.0
+WEATHER_UPSTREAM_QUOTA_DB = BASE_DIR / 'throttle.sqlite3'
+
+# Metrics (GET /metrics, Prometheus text format): per-process counters and histograms.
+# Each gunicorn worker keeps its own registry and a scrape reaches whichever worker takes it,
+# so scrape every worker (its own port or target); through one shared port the values of a
+# series jump between workers and can go backwards.
+# Scrapers send WEATHER_METRICS_TOKEN as `Authorization: Bearer <token>`, or connect directly
+# (not through a proxy) from an address in WEATHER_METRICS_ALLOWED_IPS. With neither set,
+# /metrics refuses every request.
+WEATHER_METRICS_ENABLED = os.getenv("WEATHER_METRICS_ENABLED", "True") == "True"
+WEATHER_METRICS_TOKEN = os.getenv("WEATHER_METRICS_TOKEN", "")
+WEATHER_METRICS_ALLOWED_IPS = [ip for ip in os.getenv("WEATHER_METRICS_ALLOWED_IPS", "").split(",") if ip]
+
+# Request profiling (core.middleware.ProfilingMiddleware, api/profiling.py). Off by default, and
+# then not installed at all. When on, profiles WEATHER_PROFILING_SAMPLE_RATE of requests plus any
+# request with `X-Profile: <WEATHER_PROFILING_TOKEN>`: a Server-Timing header, and a report
+# (cProfile stats, SQL queries, upstream calls) in WEATHER_PROFILING_DIR keeping the newest
+# WEATHER_PROFILING_KEEP. An empty WEATHER_PROFILING_DIR sends the header only.
+WEATHER_PROFILING_ENABLED = os.getenv("WEATHER_PROFILING_ENABLED", "False") == "True"
+WEATHER_PROFILING_SAMPLE_RATE = float(os.getenv("WEATHER_PROFILING_SAMPLE_RATE", "0"))
+WEATHER_PROFILING_TOKEN = os.getenv("WEATHER_PROFILING_TOKEN", "")
+WEATHER_PROFILING_DIR = os.getenv("WEATHER_PROFILING_DIR", str(BASE_DIR / 'profiles'))
+WEATHER_PROFILING_KEEP = 100
+WEATHER_PROFILING_TOP = 30  # functions listed in a report, by cumulative time
+
+# Throttling (api/throttles.py): sliding-window counters in a SQLite file shared by all workers
+# on the host. 'cache' falls back to DRF's per-key timestamp lists in the default cache (per-process LocMem).
+WEATHER_THROTTLE_BACKEND = 'sliding_window'
+WEATHER_THROTTLE_DB = BASE_DIR / 'throttle.sqlite3'
+
 # REST Framework Configuration
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
@@ -152,18 +329,38 @@ REST_FRAMEWORK = {
     'DEFAULT_THROTTLE_RATES': {
         'weather_limited': '5/day',
         'weather_burst': '10/min',
+        'weather_batch': '30/min',  # batch calls; their upstream misses also count against weather_burst
+        'cities': '120/min',  # autocomplete fires on every keystroke
     }
 }
 
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(minutes=60),
     'REFRESH_TOKEN_LIFETIME': timedelta(days=1),
+    'TOKEN_OBTAIN_SERIALIZER': 'authorization.serializers.UsernameTokenObtainPairSerializer',
+    'TOKEN_USER_CLASS': 'api.authentication.TokenUser',
 }
 
+# Weather endpoints authenticate from the token alone (api.authentication.StatelessJWTAuthentication).
+# Whether the account is still active is cached per worker for this many seconds: the longest a
+# deactivated user keeps access through another worker (0 checks the database on every request).
+WEATHER_AUTH_STATUS_TTL = int(os.getenv("WEATHER_AUTH_STATUS_TTL", "30"))
+
 # CORS Configuration
 CORS_ALLOW_ALL_ORIGINS = True  # For development only
 
-# Logging Configuration
+# Logging Configuration (core/logs.py): request threads only enqueue records; a listener thread writes them to
+# the console and to a size-rotated JSON lines file. Records carry the request id (X-Request-ID).
+# Each worker process rotates its own handle: with several workers, give each its own
+# WEATHER_LOG_FILE or rotate externally.
+WEATHER_LOG_FILE = os.getenv("WEATHER_LOG_FILE", str(BASE_DIR / 'debug.log'))
+WEATHER_LOG_MAX_BYTES = int(os.getenv("WEATHER_LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+WEATHER_LOG_BACKUP_COUNT = int(os.getenv("WEATHER_LOG_BACKUP_COUNT", "5"))
+# Records are dropped (and counted) rather than block requests when the queue is full
+WEATHER_LOG_QUEUE_SIZE = 10000
+# Share of the per-request cache hit logs (api.services.hits) that are kept
+WEATHER_LOG_HIT_SAMPLE_RATE = float(os.getenv("WEATHER_LOG_HIT_SAMPLE_RATE", "0.01"))
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -172,31 +369,56 @@ LOGGING = {
             'format': '{levelname} {asctime} {module} {message}',
             'style': '{',
         },
+        'json': {
+            '()': 'core.logs.JsonFormatter',
+        },
+    },
+    'filters': {
+        'sample_hits': {
+            '()': 'core.logs.SamplingFilter',
+            'rate': WEATHER_LOG_HIT_SAMPLE_RATE,
+        },
     },
     'handlers': {
         'file': {
             'level': 'INFO',
-            'class': 'logging.FileHandler',
-            'filename': BASE_DIR / 'debug.log',
-            'formatter': 'verbose',
+            'class': 'logging.handlers.RotatingFileHandler',
+            'filename': WEATHER_LOG_FILE,
+            'maxBytes': WEATHER_LOG_MAX_BYTES,
+            'backupCount': WEATHER_LOG_BACKUP_COUNT,
+            'formatter': 'json',
         },
         'console': {
             'class': 'logging.StreamHandler',
         },
+        'queue': {
+            '()': 'core.logs.QueueHandler',
+            'sink': 'core.logs.sink',
+            'maxsize': WEATHER_LOG_QUEUE_SIZE,
+        },
     },
     'loggers': {
-        'django': {
+        # Written by the queue's listener thread only
+        'core.logs.sink': {
             'handlers': ['console', 'file'],
+            'level': 'DEBUG',
+            'propagate': False,
+        },
+        'django': {
+            'handlers': ['queue'],
             'level': 'INFO',
             'propagate': True,
         },
         'api': {  # Your app name
-            'handlers': ['console', 'file'],
+            'handlers': ['queue'],
             'level': 'INFO',
             'propagate': True,
         },
+        'api.services.hits': {
+            'filters': ['sample_hits'],
+        },
         'core': {  # Middleware
-            'handlers': ['console', 'file'],
+            'handlers': ['queue'],
             'level': 'INFO',
             'propagate': True,
         },
@@ -18,9 +18,12 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 
+from api.views import MetricsView
+
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("api/", include("api.urls")),
     path("auth/", include("authorization.urls")),
+    path("metrics", MetricsView.as_view(), name="metrics"),  # Prometheus scrape target
 ]
 